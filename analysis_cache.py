@@ -0,0 +1,121 @@
+# analysis_cache.py
+# Gemini 分析结果的持久化缓存 (SQLite)。
+# 键为 hash(模型名, Prompt 模板版本, 对话文本)，同一份对话再次上传时直接复用之前的分析结果。
+# 支持 TTL 过期和按最近访问时间的 LRU 淘汰，并统计命中/未命中次数。
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+class AnalysisCache:
+    """基于 SQLite 的内容寻址分析结果缓存"""
+
+    def __init__(self, path, ttl_seconds=None, max_entries=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache ("
+            " key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_accessed ON analysis_cache(last_accessed)")
+        self._conn.commit()
+
+    @classmethod
+    def from_env(cls, default_dir):
+        """
+        根据环境变量创建缓存：
+        ANALYSIS_CACHE_PATH (为 'off' 时禁用)、ANALYSIS_CACHE_TTL_DAYS、ANALYSIS_CACHE_MAX_ENTRIES
+        打开失败时返回 None，分析流程照常进行只是不使用缓存。
+        """
+        path = os.environ.get('ANALYSIS_CACHE_PATH', os.path.join(default_dir, 'analysis_cache.sqlite3'))
+        if not path or path.lower() == 'off':
+            return None
+        ttl_days = float(os.environ.get('ANALYSIS_CACHE_TTL_DAYS', '30'))
+        max_entries = int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', '50000'))
+        try:
+            cache = cls(path, ttl_seconds=ttl_days * 86400 if ttl_days > 0 else None,
+                        max_entries=max_entries if max_entries > 0 else None)
+            cache.evict()
+            return cache
+        except Exception as e:
+            print(f"PYTHON_WARNING: Could not open analysis cache {path}: {e}. Caching disabled.", file=sys.stderr)
+            return None
+
+    @staticmethod
+    def make_key(model_name, prompt_version, transcript):
+        """由模型名、Prompt 模板版本和对话文本计算缓存键"""
+        digest = hashlib.sha256()
+        for part in (model_name, str(prompt_version), transcript):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\x00')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """命中返回缓存的分析结果 dict，未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT result, created_at FROM analysis_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analysis_cache SET last_accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """写入一条分析结果"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, result, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+
+    def evict(self):
+        """删除过期条目，并在超出容量时按最近访问时间淘汰最旧的条目，返回删除数量"""
+        removed = 0
+        with self._lock:
+            if self.ttl_seconds is not None:
+                cursor = self._conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+                removed += cursor.rowcount
+            if self.max_entries is not None:
+                count = self._conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+                if count > self.max_entries:
+                    cursor = self._conn.execute(
+                        "DELETE FROM analysis_cache WHERE key IN ("
+                        " SELECT key FROM analysis_cache ORDER BY last_accessed ASC LIMIT ?)",
+                        (count - self.max_entries,)
+                    )
+                    removed += cursor.rowcount
+            self._conn.commit()
+        return removed
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats_line(self):
+        """命中统计，供 PYTHON_STATUS 输出"""
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"Analysis cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
@@ -0,0 +1,56 @@
+# analysis_journal.py
+# 分析结果的检查点日志 (JSONL)。每条对话的结果一产生就追加写入并 fsync，
+# 子进程崩溃、重启或 OOM 后可以用 resume 选项跳过日志中已成功分析的 chat_id，只损失进行中的对话。
+
+import json
+import os
+import sys
+
+
+class AnalysisJournal:
+    """追加写入的 JSONL 结果日志"""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # resume 时保留已有内容继续追加，否则从空日志开始
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # 上次崩溃时最后一行只写了一半，先换行避免新记录接在坏行后面
+                    self._file.write('\n')
+                    self._file.flush()
+
+    def load_completed(self):
+        """读取日志中已成功分析的结果，返回 {chat_id: 结果行}；末尾写了一半的行会被忽略"""
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"PYTHON_WARNING: Ignoring unreadable journal line {line_number} in {self.path}.", file=sys.stderr)
+                    continue
+                if entry.get('succeeded'):
+                    completed[entry['chat_id']] = entry['row']
+                else:
+                    completed.pop(entry['chat_id'], None)
+        return completed
+
+    def append(self, chat_id, chat_analysis, succeeded):
+        """追加一条结果并立即刷到磁盘"""
+        entry = {'chat_id': chat_id, 'succeeded': succeeded, 'row': chat_analysis}
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,103 @@
+# analysis_worker.py
+# 常驻 Python worker：由 server.js 启动一次并保持运行，通过 stdin 逐行接收 JSON 任务，
+# 避免每次上传都重新导入 pandas / openpyxl / google.genai 并重新创建 Gemini 客户端，
+# 同一个客户端（及其 HTTP 连接池）在多个任务之间复用。
+#
+# 协议 (每行一个 JSON):
+#   stdin  <- {"id": "<任务 id>", "args": [<与 run_analysis_workflow.py 命令行相同的参数>]}
+#   stdout -> PYTHON_WORKER_READY                      模块加载完成，可以接收任务
+#   stdout -> 任务运行期间的 PYTHON_STATUS 等输出（与单独运行 run_analysis_workflow.py 相同）
+#   stderr -> 任务运行期间的每一行加上前缀 PYTHON_JOB_STDERR:<任务 id>:
+#   stdout 和 stderr 各一行 -> PYTHON_WORKER_JOB_DONE: {"id": "<任务 id>", "exit_code": 0}
+# stdout 和 stderr 是两个管道，到达 server.js 的先后顺序不确定；server.js 按任务 id 归属 stderr 输出，
+# 两个管道都收到完成标记后才结束任务。任务按接收顺序逐个执行，server.js 可以同时启动多个 worker。
+
+import json
+import os
+import sys
+import threading
+import traceback
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+if script_dir not in sys.path:
+    sys.path.insert(0, script_dir)
+
+# 导入失败时 run_analysis_workflow 会打印 PYTHON_FATAL_ERROR 并退出，server.js 随后改用逐次启动进程的方式
+import run_analysis_workflow
+
+
+class JobStderr:
+    """任务运行期间代替 sys.stderr，给每一行加上任务 id 前缀；不完整的行先缓存，finish() 时补上换行写出"""
+
+    def __init__(self, stream, job_id):
+        self.stream = stream
+        self._prefix = f"PYTHON_JOB_STDERR:{job_id}:"
+        self._pending = ''
+        self._lock = threading.Lock()  # 部分结果快照等后台线程也会写 stderr
+
+    def write(self, text):
+        with self._lock:
+            self._pending += text
+            *lines, self._pending = self._pending.split('\n')
+            for line in lines:
+                self.stream.write(f"{self._prefix}{line}\n")
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self):
+        with self._lock:
+            if self._pending:
+                self.stream.write(f"{self._prefix}{self._pending}\n")
+                self._pending = ''
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_job(job):
+    """执行一个任务，返回与命令行运行时相同的退出码"""
+    options = run_analysis_workflow.parse_workflow_args([str(arg) for arg in job.get('args', [])])
+    if options is None:
+        return 1
+    try:
+        return run_analysis_workflow.main(**options)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print("PYTHON_FATAL_ERROR: Unhandled exception in analysis worker job.", file=sys.stderr)
+        print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return 1
+
+def main():
+    # pandas、google.genai 等在单次运行时延迟导入；常驻 worker 在报告就绪前先全部加载并创建客户端，任务开始时不再等待
+    timings = run_analysis_workflow.warm_up()
+    print(f"PYTHON_STATUS: Worker warm-up finished: {json.dumps(timings)}", flush=True)
+    print("PYTHON_WORKER_READY", flush=True)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"PYTHON_WARNING: Ignoring malformed worker job line: {e}", file=sys.stderr, flush=True)
+            continue
+
+        job_stderr = JobStderr(sys.stderr, job.get('id'))
+        sys.stderr = job_stderr
+        try:
+            exit_code = run_job(job)
+        finally:
+            sys.stderr = job_stderr.stream
+            job_stderr.finish()
+        # 先把任务的所有输出刷出去，再在两个管道上各发送一次完成标记
+        done = f"PYTHON_WORKER_JOB_DONE: {json.dumps({'id': job.get('id'), 'exit_code': exit_code})}"
+        print(done, file=sys.stderr, flush=True)
+        print(done, flush=True)
+
+
+if __name__ == "__main__":
+    main()
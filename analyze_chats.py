@@ -1,30 +1,96 @@
 # analyze_chats.py
 
+import asyncio
+import itertools
 import json
 import os
 import sys
-from google import genai
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta, timezone
 import time
-from dotenv import load_dotenv
-import pandas as pd
+from rate_limiter import AdaptiveRateLimiter
+from retry_policy import RATE_LIMIT, TERMINAL, RetryPolicy, classify_error
+from analysis_cache import AnalysisCache
+from analysis_journal import AnalysisJournal
+from instrumentation import LatencyRecorder, stage
+from json_stream import is_ndjson_path, iter_json_records, strip_data_extensions, write_json_records
+from partial_report import PartialReportWriter
+from transcript_builder import build_transcript, describe_truncation, estimate_tokens
+
+# pandas、google.genai、pyarrow、xlsxwriter 等导入较慢的依赖都在第一次用到时才导入，
+# 只做清洗、limit 为 0 或没有 API Key 的运行不需要付出这部分启动开销。
+
+def _load_dotenv_if_present():
+    """
+    与 load_dotenv() 相同：从本文件所在目录向上查找第一个 .env 文件并加载（不覆盖已有的环境变量）。
+    没有 .env 文件时（例如部署环境直接设置了环境变量）不导入 python-dotenv。
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        env_path = os.path.join(directory, '.env')
+        if os.path.isfile(env_path):
+            from dotenv import load_dotenv
+            load_dotenv(env_path)
+            return
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return
+        directory = parent
 
 # --- 在脚本开头加载 .env 文件 ---
-load_dotenv()
+_load_dotenv_if_present()
 # -------------------------------
 
 # --- 配置你的 Gemini API Key ---
 API_KEY = os.environ.get('GOOGLE_API_KEY')
 
 # --- API Key 和客户端/模型加载 ---
+# Gemini 客户端由 get_client() 在第一次需要时创建，创建后保存在这里供后续任务复用
 client = None
+_client_initialized = False
 MODEL_NAME = 'gemini-2.5-flash-lite'
 
-if not API_KEY:
-    print("PYTHON_WARNING: GOOGLE_API_KEY not set. API calls will be skipped.", file=sys.stderr)
-else:
+# 同时进行中的 API 请求数量上限，可通过环境变量 ANALYSIS_CONCURRENCY 调整
+DEFAULT_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', '8'))
+# 批量模式：把多条短对话合并到一个请求，每个请求的对话文本 token 预算；0 表示关闭批量模式
+DEFAULT_BATCH_TOKEN_BUDGET = int(os.environ.get('ANALYSIS_BATCH_TOKEN_BUDGET', '0'))
+
+# 所有 Gemini 调用（单条分析和整体总结）共用的自适应限流器
+api_rate_limiter = AdaptiveRateLimiter.from_env()
+# 限流和临时故障的重试策略：指数退避 + 抖动，整次运行共享一个重试预算
+api_retry_policy = RetryPolicy.from_env()
+# 每完成多少条对话输出一次限流器状态
+RATE_STATUS_EVERY = 10
+# 运行指标（见 instrumentation.py）：每次 API 请求的耗时、每条对话时间指标的计算耗时，分析结束时各输出一行汇总
+api_call_latency = LatencyRecorder('api_call')
+timing_metrics_latency = LatencyRecorder('timing_metrics')
+
+# 单条对话文本的 token 预算，超出时保留开头和结尾、省略中间消息；0 表示不截断
+TRANSCRIPT_TOKEN_BUDGET = int(os.environ.get('ANALYSIS_TRANSCRIPT_TOKEN_BUDGET', '6000'))
+
+# Prompt 模板版本号，修改 build_analysis_prompt 或结果格式时递增，使旧缓存失效
+PROMPT_TEMPLATE_VERSION = 2
+# 结构化输出模式：通过 response_schema 让 API 直接返回固定字段的 JSON，设置 ANALYSIS_STRUCTURED_OUTPUT=0 可回到纯文本 JSON 解析
+STRUCTURED_OUTPUT = os.environ.get('ANALYSIS_STRUCTURED_OUTPUT', '1') != '0'
+# 分析结果持久化缓存 (SQLite)，设置 ANALYSIS_CACHE_PATH=off 可禁用
+analysis_cache = AnalysisCache.from_env(os.path.dirname(os.path.abspath(__file__)))
+
+def get_client():
+    """
+    返回 Gemini 客户端：第一次调用时才导入 google.genai 并创建，之后返回同一个客户端。
+    未设置 GOOGLE_API_KEY 或创建失败时返回 None，分析时会跳过 API 调用。
+    """
+    global client, _client_initialized
+    if _client_initialized:
+        return client
+    _client_initialized = True
+
+    if not API_KEY:
+        print("PYTHON_WARNING: GOOGLE_API_KEY not set. API calls will be skipped.", file=sys.stderr)
+        return None
     try:
         print(f"PYTHON_STATUS: Attempting to create Gemini client with model: {MODEL_NAME}...")
+        from google import genai
         client = genai.Client(api_key=API_KEY)
         print(f"PYTHON_STATUS: Successfully created Gemini client.")
 
@@ -33,12 +99,13 @@ else:
         print(f"PYTHON_FATAL_ERROR: Failed to create Gemini client or initialize API.", file=sys.stderr)
         print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
         print("PYTHON_STATUS: API calls will be skipped.")
+    return client
 
-def format_chat_transcript(messages):
-    transcript = []
-    for message in messages:
-        transcript.append(f"[{message.get('time', '未知时间')}] {message.get('sender', '未知发送者')}: {message.get('content', '')}")
-    return "\n".join(transcript)
+def format_chat_transcript(messages, token_budget=None):
+    """返回 (对话文本, 截断统计)，详见 transcript_builder.build_transcript"""
+    if token_budget is None:
+        token_budget = TRANSCRIPT_TOKEN_BUDGET
+    return build_transcript(messages, token_budget)
 
 def calculate_timing_metrics(messages):
     first_customer_time = None
@@ -86,15 +153,127 @@ def calculate_timing_metrics(messages):
         "初始对话时间段": first_message_time.strftime('%Y-%m-%d %H:%M:%S') if first_message_time else None
     }
 
-def analyze_chat_with_gemini(transcript, client, model_name, chat_id):
-    """调用 Gemini API 分析单个对话"""
-    if client is None:
-        return {
-            "API分析错误": "API Key 未设置或客户端创建失败，跳过API分析。",
-            "客户意图总结": "", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+# 清洗后消息时间的固定格式（年份 >= 1000，strftime 的结果与原字符串相同），可以交给 pandas 批量解析
+_MESSAGE_TIME_PATTERN = r'[1-9][0-9]{3}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}'
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+def _parse_message_time_fallback(time_str):
+    """逐条解析不是固定格式的时间，返回 (微秒时间戳, 是否带时区, 格式化后的时间)；无法解析时返回 None"""
+    try:
+        msg_time = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+    except (ValueError, TypeError):
+        return None
+    if msg_time.tzinfo is None:
+        micros = (msg_time - _EPOCH_NAIVE) // _ONE_MICROSECOND
+    else:
+        micros = (msg_time - _EPOCH_UTC) // _ONE_MICROSECOND
+    return micros, msg_time.tzinfo is not None, msg_time.strftime('%Y-%m-%d %H:%M:%S')
+
+def calculate_timing_metrics_batch(message_lists):
+    """
+    一次计算多条对话的时间指标，结果与逐条调用 calculate_timing_metrics 完全相同（顺序与输入一致）。
+    把所有消息展开成一张 (对话序号, 消息序号, 发送者, 微秒时间戳) 的表，用 pandas 批量解析时间，
+    再按对话分组找出第一条客户消息和之后第一条客服回复，不再逐条消息调用 datetime.fromisoformat。
+    时间戳使用整数微秒，回复时长与 timedelta.total_seconds() 的结果逐位相同。
+    """
+    import pandas as pd
+
+    results = [None] * len(message_lists)
+    table = pd.DataFrame([(position, index, message.get('sender'), message.get('time'))
+                          for position, messages in enumerate(message_lists)
+                          for index, message in enumerate(messages)],
+                         columns=['chat', 'index', 'sender', 'time'])
+    table = table[table['time'].astype(bool)]
+
+    # 时间字段不是字符串的对话走逐条计算的原函数，保持其异常行为
+    non_string = ~table['time'].map(lambda value: isinstance(value, str)).astype(bool)
+    for position in table.loc[non_string, 'chat'].unique():
+        results[position] = calculate_timing_metrics(message_lists[position])
+    table = table[~table['chat'].isin(table.loc[non_string, 'chat'])]
+
+    response_micros, start_times = {}, {}
+    if not table.empty:
+        fixed_format = table['time'].str.fullmatch(_MESSAGE_TIME_PATTERN)
+        parsed = pd.to_datetime(table['time'].where(fixed_format), format='%Y-%m-%d %H:%M:%S', errors='coerce')
+        table['valid'] = parsed.notna()
+        table['micros'] = parsed.to_numpy(dtype='datetime64[us]').astype('int64')
+        table['aware'] = False
+        table['formatted'] = table['time']
+
+        # 其他格式（带时区、带小数秒、超出 pandas 时间范围等）逐条解析
+        for row in table.index[~table['valid']]:
+            fallback = _parse_message_time_fallback(table.at[row, 'time'])
+            if fallback is not None:
+                table.loc[row, ['micros', 'aware', 'formatted', 'valid']] = [fallback[0], fallback[1], fallback[2], True]
+        table = table[table['valid']]
+
+        start_times = table[table['index'] == 0].set_index('chat')['formatted'].to_dict()
+        first_customer = table[table['sender'] == 'Customer'].groupby('chat').first()
+
+        # 第一条客户消息之后、时间不早于它的第一条客服消息；带时区与不带时区的时间无法比较，与原函数一样跳过
+        agents = table[table['sender'] == 'Agent'].join(first_customer[['index', 'micros', 'aware']], on='chat', rsuffix='_customer', how='inner')
+        agents = agents[(agents['index'] > agents['index_customer']) & (agents['aware'] == agents['aware_customer'])
+                        & (agents['micros'] >= agents['micros_customer'])]
+        # 没有任何客服回复时 join 结果为空，此时 groupby('chat') 会因 chat 同时是索引名和列名而报错
+        if not agents.empty:
+            first_reply = agents.groupby('chat').first()
+            response_micros = (first_reply['micros'] - first_reply['micros_customer']).to_dict()
+
+    for position in range(len(message_lists)):
+        if results[position] is not None:
+            continue
+        response_time_seconds = None
+        is_qualified = "无回复"
+        if position in response_micros:
+            response_time_seconds = int(response_micros[position]) / 10**6
+            is_qualified = "合格" if response_time_seconds <= 30 else "不合格"
+        results[position] = {
+            "首次回复时长 (秒)": round(response_time_seconds, 2) if response_time_seconds is not None else None,
+            "是否合格 (30秒内合格)": is_qualified,
+            "初始对话时间段": start_times.get(position)
         }
+    return results
+
+# 模型需要输出的分析字段（按输出顺序）及说明
+ANALYSIS_FIELDS = {
+    "客户意图总结": "简洁概括客户联系客服的主要目的或问题。",
+    "聊天质量点评 (基于内容)": "基于对话内容，评价客服代表的沟通、问题解决、专业性等质量，提供具体例子支持评价。",
+    "改进建议 (具体动作)": "基于聊天质量点评，提出具体、可操作的改进措施或培训建议。",
+    "潜在成交机会": "分析对话中是否存在销售、升级或其他成交的机会，并说明原因或类型。",
+    "情绪负面评价": "评价客户在对话中是否表现出负面情绪（如不满、生气、沮丧等），并简要说明原因或程度。",
+}
+
+# 结构化输出模式下传给 API 的 response_schema，保证返回的 JSON 一定包含全部字段
+ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {key: {"type": "STRING", "description": description} for key, description in ANALYSIS_FIELDS.items()},
+    "required": list(ANALYSIS_FIELDS),
+    "propertyOrdering": list(ANALYSIS_FIELDS),
+}
+
+def _analysis_items_text():
+    return "\n".join(f"{i}. {key}: {description}" for i, (key, description) in enumerate(ANALYSIS_FIELDS.items(), start=1))
+
+def build_analysis_prompt(transcript, structured=None):
+    """构造单个对话的分析 Prompt；结构化输出模式下格式由 response_schema 约束，不再在文本里描述 JSON 要求"""
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    if structured:
+        return f"""你是一个专业的聊天分析师。请分析以下客户服务对话文本，按要求提取和总结信息。
+如果某个信息无法从对话中提取或不适用，请输出空字符串。
+
+分析项及要求：
+{_analysis_items_text()}
+
+以下是对话文本：
+---对话开始---
+{transcript}
+---对话结束---
+"""
 
-    prompt = f"""你是一个专业的聊天分析师。请分析以下客户服务对话文本，并严格按照以下 JSON 格式提取和总结信息。
+    return f"""你是一个专业的聊天分析师。请分析以下客户服务对话文本，并严格按照以下 JSON 格式提取和总结信息。
 
 请确保你的输出是一个完全有效的 JSON 对象，不要包含任何额外的文本说明、markdown 格式（如 ```json```）或其他非 JSON 内容。
 
@@ -103,11 +282,7 @@ JSON 对象的键（key）必须完全按照提供的中文名称。
 "首次回复时长 (秒)" 和 "是否合格 (30秒内合格)" 这两项请忽略，我会在外部计算并填充。
 
 分析项及要求（请严格按照此顺序在JSON中输出）：
-1. 客户意图总结: 简洁概括客户联系客服的主要目的或问题。
-2. 聊天质量点评 (基于内容): 基于对话内容，评价客服代表的沟通、问题解决、专业性等质量，提供具体例子支持评价。
-3. 改进建议 (具体动作): 基于聊天质量点评，提出具体、可操作的改进措施或培训建议。
-4. 潜在成交机会: 分析对话中是否存在销售、升级或其他成交的机会，并说明原因或类型。
-5. 情绪负面评价: 评价客户在对话中是否表现出负面情绪（如不满、生气、沮丧等），并简要说明原因或程度。
+{_analysis_items_text()}
 
 
 以下是对话文本：
@@ -118,220 +293,786 @@ JSON 对象的键（key）必须完全按照提供的中文名称。
 请输出 JSON 结果：
 """
 
-    response = None
-    analysis_result = None
+def analysis_generation_config(structured=None):
+    """结构化输出模式下返回 generate_content 的 config (JSON MIME 类型 + response_schema)，否则返回 None"""
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    if not structured:
+        return None
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": ANALYSIS_RESPONSE_SCHEMA,
+    }
+
+def _skipped_analysis_result():
+    return {
+        "API分析错误": "API Key 未设置或客户端创建失败，跳过API分析。",
+        "客户意图总结": "", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+    }
+
+def _response_feedback_error(response, chat_id, response_text):
+    """检查 prompt 被拦截或生成提前结束的情况，需要作为错误结果返回时返回对应 dict，否则返回 None"""
+    # --- Check prompt feedback or candidate finish reason ---
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback is not None:
+         prompt_feedback = response.prompt_feedback
+         if hasattr(prompt_feedback, 'block_reason') and prompt_feedback.block_reason:
+             block_reason = prompt_feedback.block_reason.name
+             print(f"PYTHON_ERROR: Prompt blocked for chat {chat_id}. Reason: {block_reason}", file=sys.stderr)
+             safety_info = ""
+             if hasattr(prompt_feedback, 'safety_ratings') and prompt_feedback.safety_ratings:
+                  safety_info = ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings])
+                  print(f"PYTHON_ERROR: Prompt safety ratings: {safety_info}", file=sys.stderr)
+             return {
+                 "API分析错误": f"Prompt blocked: {block_reason}" + (f" ({safety_info})" if safety_info else ""),
+                 "客户意图总结": "Prompt blocked", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+             }
+         if hasattr(prompt_feedback, 'safety_ratings') and prompt_feedback.safety_ratings:
+             safety_info = ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings])
+             print(f"PYTHON_WARNING: Prompt safety ratings received for chat {chat_id}: {safety_info}", file=sys.stderr)
+
+    if hasattr(response, 'candidates') and response.candidates and response.candidates[0] is not None:
+         candidate = response.candidates[0]
+         if hasattr(candidate, 'finish_reason') and candidate.finish_reason and candidate.finish_reason.name != 'STOP':
+              finish_reason = candidate.finish_reason.name
+              print(f"PYTHON_WARNING: Model finished with reason: {finish_reason} for chat {chat_id}.", file=sys.stderr)
+              reason_detail = ""
+              if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
+                   reason_detail = " Safety Ratings: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in candidate.safety_ratings])
+                   print(f"PYTHON_WARNING: Candidate safety ratings: {reason_detail}", file=sys.stderr)
+
+              if not response_text:
+                  return {
+                     "API分析错误": f"Model finished with reason: {finish_reason}" + (f" ({reason_detail})" if reason_detail else "") + ". No text generated.",
+                     "客户意图总结": "Generation failed", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+                 }
+
+    return None
+
+def _process_analysis_response(response, chat_id, structured=False):
+    """检查 API 回复的安全/完成信息并解析 JSON 结果，解析失败时抛出异常"""
+    response_text = (response.text or "").strip()
+
+    feedback_error = _response_feedback_error(response, chat_id, response_text)
+    if feedback_error is not None:
+        return feedback_error
+
+    # --- JSON Parsing Attempt ---
+    if not response_text:
+        print(f"PYTHON_ERROR: API call successful but returned empty text for chat {chat_id}.", file=sys.stderr)
+        return {
+            "API分析错误": "API returned empty text.",
+            "客户意图总结": "Empty response", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+        }
+
+    if structured:
+        # 结构化输出：API 已按 response_schema 返回 JSON，不需要清理和补齐字段
+        analysis_result = response.parsed if isinstance(getattr(response, 'parsed', None), dict) else json.loads(response_text)
+        if not isinstance(analysis_result, dict):
+             raise ValueError("Parsed JSON result is not a valid dictionary.")
+        _print_parsed_chat_result(analysis_result, chat_id)
+        return analysis_result
 
     try:
-        print(f"PYTHON_STATUS: Calling API for chat {chat_id} (Prompt len: {len(prompt)})...")
-        start_time = time.time()
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt
-        )
-        end_time = time.time()
-        print(f"PYTHON_STATUS: API call successful for chat {chat_id}, took {end_time - start_time:.2f} seconds.")
+        # First attempt: direct parse
+        analysis_result = json.loads(response_text)
+    except json.JSONDecodeError as json_e:
+        # If direct parse fails, print error and snippet
+        print(f"PYTHON_ERROR: JSON Decode Error for chat {chat_id}: {json_e}", file=sys.stderr)
+        print(f"PYTHON_ERROR_SNIPPET: Attempted to parse: {response_text[:500]}...", file=sys.stderr)
+        # Try robust parsing as a fallback
+        try:
+            clean_text = response_text.replace('```json', '').replace('```', '').strip()
+            analysis_result = json.loads(clean_text)
+            print(f"PYTHON_WARNING: Successfully parsed after cleanup for chat {chat_id}.", file=sys.stderr)
+        except json.JSONDecodeError:
+             print(f"PYTHON_FATAL_ERROR: Robust JSON parsing failed for chat {chat_id}.", file=sys.stderr)
+             raise # Re-raise if robust parsing fails
+
+
+    # --- Validate parsed result ---
+    if not isinstance(analysis_result, dict):
+         raise ValueError("Parsed JSON result is not a valid dictionary.")
 
-        response_text = response.text.strip()
+    for key in ANALYSIS_FIELDS:
+        if analysis_result.get(key) is None:
+             analysis_result[key] = ""
 
-        # --- Check prompt feedback or candidate finish reason ---
-        if hasattr(response, 'prompt_feedback') and response.prompt_feedback is not None:
+    _print_parsed_chat_result(analysis_result, chat_id)
+    return analysis_result # Return the successfully parsed result
+
+def _print_parsed_chat_result(analysis_result, chat_id):
+    # This is the data for the *current* chat displayed in the frontend
+    try:
+         print(f"PYTHON_PARSED_CHAT_RESULT: {json.dumps(analysis_result, ensure_ascii=False)}")
+    except Exception as e:
+         print(f"PYTHON_ERROR: Failed to serialize parsed result for stream for chat {chat_id}: {e}", file=sys.stderr)
+         # Still return the parsed result even if streaming fails
+
+def _analysis_exception_result(e, response, chat_id):
+    """把分析过程中的异常转换为带 API分析错误 的结果"""
+    print(f"PYTHON_ERROR: Exception caught during analysis for chat {chat_id}: {type(e).__name__} - {e}", file=sys.stderr)
+    # Try to include any available safety/finish info
+    safety_info_parts = []
+    if response is not None:
+         if hasattr(response, 'prompt_feedback') and response.prompt_feedback is not None:
              prompt_feedback = response.prompt_feedback
-             if hasattr(prompt_feedback, 'block_reason') and prompt_feedback.block_reason:
-                 block_reason = prompt_feedback.block_reason.name
-                 print(f"PYTHON_ERROR: Prompt blocked for chat {chat_id}. Reason: {block_reason}", file=sys.stderr)
-                 safety_info = ""
-                 if hasattr(prompt_feedback, 'safety_ratings') and prompt_feedback.safety_ratings:
-                      safety_info = ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings])
-                      print(f"PYTHON_ERROR: Prompt safety ratings: {safety_info}", file=sys.stderr)
-                 return {
-                     "API分析错误": f"Prompt blocked: {block_reason}" + (f" ({safety_info})" if safety_info else ""),
-                     "客户意图总结": "Prompt blocked", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
-                 }
              if hasattr(prompt_feedback, 'safety_ratings') and prompt_feedback.safety_ratings:
-                 safety_info = ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings])
-                 print(f"PYTHON_WARNING: Prompt safety ratings received for chat {chat_id}: {safety_info}", file=sys.stderr)
-
-        if hasattr(response, 'candidates') and response.candidates and response.candidates[0] is not None:
-             candidate = response.candidates[0]
-             if hasattr(candidate, 'finish_reason') and candidate.finish_reason and candidate.finish_reason.name != 'STOP':
-                  finish_reason = candidate.finish_reason.name
-                  print(f"PYTHON_WARNING: Model finished with reason: {finish_reason} for chat {chat_id}.", file=sys.stderr)
-                  reason_detail = ""
-                  if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
-                       reason_detail = " Safety Ratings: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in candidate.safety_ratings])
-                       print(f"PYTHON_WARNING: Candidate safety ratings: {reason_detail}", file=sys.stderr)
-
-                  if not response_text:
-                      return {
-                         "API分析错误": f"Model finished with reason: {finish_reason}" + (f" ({reason_detail})" if reason_detail else "") + ". No text generated.",
-                         "客户意图总结": "Generation failed", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
-                     }
-
-        # --- JSON Parsing Attempt ---
-        if not response_text:
-            print(f"PYTHON_ERROR: API call successful but returned empty text for chat {chat_id}.", file=sys.stderr)
-            return {
-                "API分析错误": "API returned empty text.",
-                "客户意图总结": "Empty response", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
-            }
+                  safety_info_parts.append("Prompt Safety: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings]))
+             if hasattr(prompt_feedback, 'block_reason') and prompt_feedback.block_reason:
+                   safety_info_parts.append(f"Prompt Blocked: {prompt_feedback.block_reason.name}")
 
-        try:
-            # First attempt: direct parse
-            analysis_result = json.loads(response_text)
-        except json.JSONDecodeError as json_e:
-            # If direct parse fails, print error and snippet
-            print(f"PYTHON_ERROR: JSON Decode Error for chat {chat_id}: {json_e}", file=sys.stderr)
-            print(f"PYTHON_ERROR_SNIPPET: Attempted to parse: {response_text[:500]}...", file=sys.stderr)
-            # Try robust parsing as a fallback
-            try:
-                clean_text = response_text.replace('```json', '').replace('```', '').strip()
-                analysis_result = json.loads(clean_text)
-                print(f"PYTHON_WARNING: Successfully parsed after cleanup for chat {chat_id}.", file=sys.stderr)
-            except json.JSONDecodeError:
-                 print(f"PYTHON_FATAL_ERROR: Robust JSON parsing failed for chat {chat_id}.", file=sys.stderr)
-                 raise # Re-raise if robust parsing fails
+         if hasattr(response, 'candidates') and response.candidates and response.candidates[0] is not None:
+              candidate = response.candidates[0]
+              if hasattr(candidate, 'finish_reason') and candidate.finish_reason and candidate.finish_reason.name != 'STOP':
+                   finish_reason = candidate.finish_reason.name
+                   safety_info_parts.append(f"Finish Reason: {finish_reason}")
+                   if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
+                       safety_info_parts.append("Candidate Safety: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in candidate.safety_ratings]))
 
+    safety_info = "; ".join(safety_info_parts) if safety_info_parts else ""
 
-        # --- Validate parsed result ---
-        if not isinstance(analysis_result, dict):
-             raise ValueError("Parsed JSON result is not a valid dictionary.")
+    error_message_detail = str(e)
+    if safety_info:
+         error_message_detail = f"{error_message_detail} ({safety_info})"
 
-        expected_keys = ["客户意图总结", "聊天质量点评 (基于内容)", "改进建议 (具体动作)", "潜在成交机会", "情绪负面评价"]
-        for key in expected_keys:
-            if analysis_result.get(key) is None:
-                 analysis_result[key] = ""
+    # Print traceback for unexpected errors (not handled JSONDecodeErrors)
+    if not (isinstance(e, json.JSONDecodeError) and 'Successfully parsed after cleanup' in str(e)):
+         import traceback
+         traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
 
-        # --- NEW: Print parsed result here if successful ---
-        # This is the data for the *current* chat displayed in the frontend
+
+    result = {
+        "API分析错误": f"{type(e).__name__}: {error_message_detail}",
+        "客户意图总结": "Analysis error", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+    }
+    if classify_error(e) != TERMINAL:
+        # 标记为可重试，并发引擎会在第二轮中重新分析该对话；该键不会写入结果行
+        result["_retryable"] = True
+    return result
+
+def _response_token_count(response):
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None) if usage is not None else None
+
+def _retry_delay_after_error(e, label, attempt):
+    """
+    按错误类别决定是否重试：429 时通知限流器降速（等待由限流器负责），临时故障按指数退避等待。
+    应重试时返回等待秒数，否则返回 None。
+    """
+    kind = classify_error(e)
+    if kind == RATE_LIMIT:
+        api_rate_limiter.record_rate_limited()
+        print(f"PYTHON_WARNING: Rate limited (429/RESOURCE_EXHAUSTED) for {label}. {api_rate_limiter.status_line()}", file=sys.stderr)
+    if not api_retry_policy.should_retry(kind, attempt):
+        return None
+    delay = 0.0 if kind == RATE_LIMIT else api_retry_policy.backoff_delay(attempt)
+    print(f"PYTHON_WARNING: Retrying {label} after {kind} error ({type(e).__name__}: {e}), "
+          f"attempt {attempt + 1}/{api_retry_policy.max_retries}, waiting {delay:.1f}s. {api_retry_policy.status_line()}", file=sys.stderr)
+    return delay
+
+def generate_content_rate_limited(client, model_name, prompt, label, config=None):
+    """经过共享限流器发起一次同步 generate_content 调用，限流或临时故障时按重试策略重试"""
+    estimated_tokens = estimate_tokens(prompt)
+    attempt = 0
+    while True:
+        api_rate_limiter.acquire(estimated_tokens)
         try:
-             print(f"PYTHON_PARSED_CHAT_RESULT: {json.dumps(analysis_result, ensure_ascii=False)}")
+            with api_call_latency.measure():
+                response = client.models.generate_content(
+                    model=model_name,
+                    contents=prompt,
+                    config=config
+                )
         except Exception as e:
-             print(f"PYTHON_ERROR: Failed to serialize parsed result for stream for chat {chat_id}: {e}", file=sys.stderr)
-             # Still return the parsed result even if streaming fails
-        # ---------------------------------------------------
+            delay = _retry_delay_after_error(e, label, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        api_rate_limiter.record_success(estimated_tokens, _response_token_count(response))
+        return response
+
+async def generate_content_rate_limited_async(client, model_name, prompt, label, config=None):
+    """generate_content_rate_limited 的异步版本，使用 client.aio"""
+    estimated_tokens = estimate_tokens(prompt)
+    attempt = 0
+    while True:
+        await api_rate_limiter.acquire_async(estimated_tokens)
+        try:
+            with api_call_latency.measure():
+                response = await client.aio.models.generate_content(
+                    model=model_name,
+                    contents=prompt,
+                    config=config
+                )
+        except Exception as e:
+            delay = _retry_delay_after_error(e, label, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        api_rate_limiter.record_success(estimated_tokens, _response_token_count(response))
+        return response
+
+def _lookup_cached_analysis(transcript, model_name, chat_id):
+    """在缓存中查找对话的分析结果，返回 (缓存键, 命中的结果或 None)"""
+    if analysis_cache is None:
+        return None, None
+    prompt_version = f"{PROMPT_TEMPLATE_VERSION}-{'schema' if STRUCTURED_OUTPUT else 'text'}"
+    cache_key = AnalysisCache.make_key(model_name, prompt_version, transcript)
+    cached_result = analysis_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"PYTHON_STATUS: Cache hit for chat {chat_id}, skipping API call.")
+        _print_parsed_chat_result(cached_result, chat_id)
+    return cache_key, cached_result
+
+def _store_cached_analysis(cache_key, analysis_result):
+    """只缓存成功的分析结果，失败的结果下次仍会重新调用 API"""
+    if analysis_cache is None or cache_key is None or "API分析错误" in analysis_result:
+        return
+    try:
+        analysis_cache.put(cache_key, analysis_result)
+    except Exception as e:
+        print(f"PYTHON_WARNING: Failed to write analysis cache: {e}", file=sys.stderr)
+
+def analyze_chat_with_gemini(transcript, client, model_name, chat_id):
+    """调用 Gemini API 分析单个对话"""
+    cache_key, cached_result = _lookup_cached_analysis(transcript, model_name, chat_id)
+    if cached_result is not None:
+        return cached_result
+
+    if client is None:
+        return _skipped_analysis_result()
 
-        return analysis_result # Return the successfully parsed result
+    prompt = build_analysis_prompt(transcript)
+    response = None
+
+    try:
+        print(f"PYTHON_STATUS: Calling API for chat {chat_id} (Prompt len: {len(prompt)})...")
+        start_time = time.time()
+        response = generate_content_rate_limited(client, model_name, prompt, f"chat {chat_id}", config=analysis_generation_config())
+        end_time = time.time()
+        print(f"PYTHON_STATUS: API call successful for chat {chat_id}, took {end_time - start_time:.2f} seconds.")
+
+        analysis_result = _process_analysis_response(response, chat_id, structured=STRUCTURED_OUTPUT)
+        _store_cached_analysis(cache_key, analysis_result)
+        return analysis_result
 
     except Exception as e:
-        print(f"PYTHON_ERROR: Exception caught during analysis for chat {chat_id}: {type(e).__name__} - {e}", file=sys.stderr)
-        # Try to include any available safety/finish info
-        safety_info_parts = []
-        if 'response' in locals() and response is not None:
-             if hasattr(response, 'prompt_feedback') and response.prompt_feedback is not None:
-                 prompt_feedback = response.prompt_feedback
-                 if hasattr(prompt_feedback, 'safety_ratings') and prompt_feedback.safety_ratings:
-                      safety_info_parts.append("Prompt Safety: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in prompt_feedback.safety_ratings]))
-                 if hasattr(prompt_feedback, 'block_reason') and prompt_feedback.block_reason:
-                       safety_info_parts.append(f"Prompt Blocked: {prompt_feedback.block_reason.name}")
+        return _analysis_exception_result(e, response, chat_id)
 
-             if hasattr(response, 'candidates') and response.candidates and response.candidates[0] is not None:
-                  candidate = response.candidates[0]
-                  if hasattr(candidate, 'finish_reason') and candidate.finish_reason and candidate.finish_reason.name != 'STOP':
-                       finish_reason = candidate.finish_reason.name
-                       safety_info_parts.append(f"Finish Reason: {finish_reason}")
-                       if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
-                           safety_info_parts.append("Candidate Safety: " + ", ".join([f"{s.category.name}: {s.probability.name}" for s in candidate.safety_ratings]))
+async def analyze_chat_with_gemini_async(transcript, client, model_name, chat_id):
+    """analyze_chat_with_gemini 的异步版本，使用 client.aio 发起请求"""
+    cache_key, cached_result = _lookup_cached_analysis(transcript, model_name, chat_id)
+    if cached_result is not None:
+        return cached_result
 
-        safety_info = "; ".join(safety_info_parts) if safety_info_parts else ""
+    if client is None:
+        return _skipped_analysis_result()
 
-        error_message_detail = str(e)
-        if safety_info:
-             error_message_detail = f"{error_message_detail} ({safety_info})"
+    prompt = build_analysis_prompt(transcript)
+    response = None
+
+    try:
+        print(f"PYTHON_STATUS: Calling API for chat {chat_id} (Prompt len: {len(prompt)})...")
+        start_time = time.time()
+        response = await generate_content_rate_limited_async(client, model_name, prompt, f"chat {chat_id}", config=analysis_generation_config())
+        end_time = time.time()
+        print(f"PYTHON_STATUS: API call successful for chat {chat_id}, took {end_time - start_time:.2f} seconds.")
 
-        # Print traceback for unexpected errors (not handled JSONDecodeErrors)
-        if not (isinstance(e, json.JSONDecodeError) and 'Successfully parsed after cleanup' in str(e)):
-             import traceback
-             traceback.print_exc(file=sys.stderr)
+        analysis_result = _process_analysis_response(response, chat_id, structured=STRUCTURED_OUTPUT)
+        _store_cached_analysis(cache_key, analysis_result)
+        return analysis_result
 
+    except Exception as e:
+        return _analysis_exception_result(e, response, chat_id)
+
+
+# 批量模式下每个请求最多包含的对话数量
+BATCH_MAX_CHATS = int(os.environ.get('ANALYSIS_BATCH_MAX_CHATS', '10'))
+# 流水线各阶段之间队列的容量，0 表示使用并发数的两倍
+PIPELINE_QUEUE_SIZE = int(os.environ.get('ANALYSIS_QUEUE_SIZE', '0'))
+
+# 批量模式的 response_schema：每条对话一个对象，通过 chat_id 对应回原对话
+BATCH_ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"chat_id": {"type": "STRING"}, **ANALYSIS_RESPONSE_SCHEMA["properties"]},
+        "required": ["chat_id"] + list(ANALYSIS_FIELDS),
+        "propertyOrdering": ["chat_id"] + list(ANALYSIS_FIELDS),
+    },
+}
+
+def build_batch_analysis_prompt(items):
+    """构造多条对话合并分析的 Prompt，要求按 chat_id 返回 JSON 数组"""
+    transcripts = "\n\n".join(
+        f"=== chat_id: {item['chat_id']} ===\n{item['transcript']}" for item in items
+    )
+    return f"""你是一个专业的聊天分析师。下面有 {len(items)} 段相互独立的客户服务对话，每段以 "=== chat_id: ... ===" 开头。
+请分别分析每一段对话，输出一个 JSON 数组，数组中每个元素对应一段对话，包含该对话的 "chat_id"（与原文完全一致）以及以下分析项。
+不要合并或遗漏任何对话，不要输出 JSON 以外的内容。
+如果某个信息无法从对话中提取或不适用，请输出空字符串。
+
+分析项及要求：
+{_analysis_items_text()}
 
-        return {
-            "API分析错误": f"{type(e).__name__}: {error_message_detail}",
-            "客户意图总结": "Analysis error", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
-        }
+以下是对话文本：
+{transcripts}
+"""
 
+def _parse_batch_analysis_response(response, expected_chat_ids):
+    """解析批量分析的 JSON 数组，返回 {chat_id: 分析结果}；只保留请求中存在且字段完整的条目"""
+    response_text = (response.text or "").strip()
+    parsed = getattr(response, 'parsed', None)
+    if not isinstance(parsed, list):
+        parsed = json.loads(response_text.replace('```json', '').replace('```', '').strip())
+    if not isinstance(parsed, list):
+        raise ValueError("Batch response is not a JSON array.")
+
+    batch_results = {}
+    for entry in parsed:
+        if not isinstance(entry, dict):
+            continue
+        chat_id = str(entry.get('chat_id', ''))
+        if chat_id not in expected_chat_ids or chat_id in batch_results:
+            continue
+        if any(not isinstance(entry.get(key), str) for key in ANALYSIS_FIELDS):
+            continue
+        batch_results[chat_id] = {key: entry[key] for key in ANALYSIS_FIELDS}
+    return batch_results
+
+async def analyze_chat_batch_with_gemini_async(items, client, model_name):
+    """
+    用一个请求分析多条对话。返回 {chat_id: 分析结果}，
+    请求失败或无法解析时返回 None，由调用方对缺失的对话回退到单条分析。
+    """
+    prompt = build_batch_analysis_prompt(items)
+    config = {"response_mime_type": "application/json", "response_schema": BATCH_ANALYSIS_RESPONSE_SCHEMA} if STRUCTURED_OUTPUT else None
+    label = f"batch of {len(items)} chats"
 
-# --- 将核心分析和保存逻辑封装到函数中 ---
-def run_analysis_process(cleaned_input_file, final_output_file_excel, client_instance, model_name_str, limit=None, print_results_to_console=True):
-    print(f"PYTHON_STATUS: Loading cleaned data from {cleaned_input_file}...")
     try:
-        with open(cleaned_input_file, 'r', encoding='utf-8') as f:
-            cleaned_chats = json.load(f)
-        print(f"PYTHON_STATUS: Successfully loaded cleaned data. Found {len(cleaned_chats)} chats.")
-    except FileNotFoundError:
-        print(f"PYTHON_FATAL_ERROR: Cleaned data file not found: {cleaned_input_file}.", file=sys.stderr)
-        return []
-    except json.JSONDecodeError:
-        print(f"PYTHON_FATAL_ERROR: Failed to parse cleaned data file {cleaned_input_file}. Check JSON format.", file=sys.stderr)
-        return []
+        print(f"PYTHON_STATUS: Calling API for {label} (Prompt len: {len(prompt)})...")
+        start_time = time.time()
+        response = await generate_content_rate_limited_async(client, model_name, prompt, label, config=config)
+        end_time = time.time()
+        print(f"PYTHON_STATUS: API call successful for {label}, took {end_time - start_time:.2f} seconds.")
+
+        batch_results = _parse_batch_analysis_response(response, {item['chat_id'] for item in items})
     except Exception as e:
-        print(f"PYTHON_FATAL_ERROR: Unknown error loading cleaned data: {e}", file=sys.stderr)
-        return []
+        print(f"PYTHON_WARNING: Batch analysis failed for {label}: {type(e).__name__} - {e}", file=sys.stderr)
+        return None
+
+    for chat_id, analysis_result in batch_results.items():
+        _print_parsed_chat_result(analysis_result, chat_id)
+    return batch_results
+
+
+def _build_chat_analysis_row(chat, chat_id, timing_metrics, analysis_content, transcript_stats=None):
+    """合并时间指标、API 分析内容和对话文本截断情况，生成 Excel 中的一行"""
+    chat_analysis = {
+        "chat_id": chat_id, # --- Ensure chat_id is included here ---
+        "客户姓名": chat.get('customer', {}).get('name', '') if chat.get('customer', {}).get('name', '') else '[无信息]',
+        "初始对话时间段": timing_metrics.get("初始对话时间段"),
+        "客户意图总结": analysis_content.get("客户意图总结", "") if analysis_content.get("客户意图总结", "") else "[无信息]",
+        "聊天质量点评 (基于内容)": analysis_content.get("聊天质量点评 (基于内容)", "") if analysis_content.get("聊天质量点评 (基于内容)", "") else "[无信息]",
+        "改进建议 (具体动作)": analysis_content.get("改进建议 (具体动作)", "") if analysis_content.get("改进建议 (具体动作)", "") else "[无信息]",
+        "潜在成交机会": analysis_content.get("潜在成交机会", "") if analysis_content.get("潜在成交机会", "") else "[无信息]",
+        "情绪负面评价": analysis_content.get("情绪负面评价", "") if analysis_content.get("情绪负面评价", "") else "[无信息]",
+        "首次回复时长 (秒)": timing_metrics["首次回复时长 (秒)"],
+        "是否合格 (30秒内合格)": timing_metrics["是否合格 (30秒内合格)"]
+    }
 
-    analyzed_results = []
-    chats_to_process = cleaned_chats[:limit] if limit is not None else cleaned_chats
-    total_chats_to_process = len(chats_to_process)
-    print(f"PYTHON_STATUS: Starting analysis for {total_chats_to_process} chats.")
+    # Include API error info if present
+    if "API分析错误" in analysis_content:
+         chat_analysis["API分析错误"] = analysis_content["API分析错误"]
 
-    successful_api_calls = 0
-    skipped_api_calls = 0
+    truncation_note = describe_truncation(transcript_stats)
+    if truncation_note:
+        chat_analysis["对话文本截断"] = truncation_note
 
-    print("PYTHON_STATUS: Beginning chat analysis loop...")
-    for i, chat in enumerate(chats_to_process):
-        chat_id = chat.get('chat_id', f'UnknownID_{i+1}')
+    return chat_analysis
 
-        # 打印总体进度 (更精确地报告当前处理的是第几条总共多少条)
-        print(f"PYTHON_STATUS: Processing chat [{i + 1}/{total_chats_to_process}] (ID: {chat_id})")
+def _empty_chat_row(chat_id):
+    return {
+         "chat_id": chat_id,
+         "客户意图总结": "", "聊天质量点评 (基于内容)": "无有效消息", "改进建议 (具体动作)": "", "首次回复时长 (秒)": None, "是否合格 (30秒内合格)": "无回复", "潜在成交机会": "", "情绪负面评价": ""
+    }
 
+def _iter_work_units(chats, model_name_str, batch_mode, resumed_rows):
+    """
+    流水线第一阶段：遍历对话（可以是边读边清洗的生成器），为每条对话准备分析所需的数据。产出的工作单元：
+      ('analyze', [item])             需要调用 API 的对话
+      ('cached', item, 分析结果)       批量模式下已命中缓存的对话
+      ('row', index, 结果行, 是否成功)  无需分析的对话（无有效消息 / 检查点日志中已有结果）
+    """
+    for index, chat in enumerate(chats):
+        chat_id = chat.get('chat_id', f'UnknownID_{index+1}')
         messages = chat.get('messages', [])
 
         if not messages:
             print(f"PYTHON_STATUS: Chat {chat_id} has no valid messages, skipping analysis.")
-            analyzed_results.append({
-                 "chat_id": chat_id,
-                 "客户意图总结": "", "聊天质量点评 (基于内容)": "无有效消息", "改进建议 (具体动作)": "", "首次回复时长 (秒)": None, "是否合格 (30秒内合格)": "无回复", "潜在成交机会": "", "情绪负面评价": ""
-            })
-            skipped_api_calls += 1
+            yield ('row', index, _empty_chat_row(chat_id), False)
+            continue
+
+        if resumed_rows and chat_id in resumed_rows:
+            print(f"PYTHON_STATUS: Chat {chat_id} already analyzed in journal, skipping.")
+            yield ('row', index, resumed_rows[chat_id], True)
             continue
 
-        timing_metrics = calculate_timing_metrics(messages)
-        transcript = format_chat_transcript(messages)
-
-        # 调用 API 分析函数
-        analysis_content = analyze_chat_with_gemini(transcript, client_instance, model_name_str, chat_id)
-        # analyze_chat_with_gemini function now prints the parsed JSON with PYTHON_PARSED_CHAT_RESULT prefix
-
-        # Combine results for the final Excel/JSON list
-        chat_analysis = {
-            "chat_id": chat_id, # --- Ensure chat_id is included here ---
-            "客户姓名": chat.get('customer', {}).get('name', '') if chat.get('customer', {}).get('name', '') else '[无信息]',
-            "初始对话时间段": timing_metrics.get("初始对话时间段"),
-            "客户意图总结": analysis_content.get("客户意图总结", "") if analysis_content.get("客户意图总结", "") else "[无信息]",
-            "聊天质量点评 (基于内容)": analysis_content.get("聊天质量点评 (基于内容)", "") if analysis_content.get("聊天质量点评 (基于内容)", "") else "[无信息]",
-            "改进建议 (具体动作)": analysis_content.get("改进建议 (具体动作)", "") if analysis_content.get("改进建议 (具体动作)", "") else "[无信息]",
-            "潜在成交机会": analysis_content.get("潜在成交机会", "") if analysis_content.get("潜在成交机会", "") else "[无信息]",
-            "情绪负面评价": analysis_content.get("情绪负面评价", "") if analysis_content.get("情绪负面评价", "") else "[无信息]",
-            "首次回复时长 (秒)": timing_metrics["首次回复时长 (秒)"],
-            "是否合格 (30秒内合格)": timing_metrics["是否合格 (30秒内合格)"]
+        transcript, transcript_stats = format_chat_transcript(messages)
+        with timing_metrics_latency.measure():
+            timing_metrics = calculate_timing_metrics(messages)
+        item = {
+            'index': index,
+            'chat': chat,
+            'chat_id': chat_id,
+            'timing_metrics': timing_metrics,
+            'transcript': transcript,
+            'transcript_stats': transcript_stats,
         }
+        if batch_mode:
+            # 批量模式：先查缓存，只有未命中的对话参与分组
+            item['cache_key'], cached_result = _lookup_cached_analysis(transcript, model_name_str, chat_id)
+            if cached_result is not None:
+                yield ('cached', item, cached_result)
+                continue
+        yield ('analyze', [item])
+
+def _iter_chat_batches(units, token_budget, max_chats):
+    """按输入顺序贪心地把待分析的对话分组，使每组对话文本的估算 token 数不超过预算；单条超预算的对话单独成组，其他工作单元原样透传"""
+    current, current_tokens, current_ids = [], 0, set()
+    for unit in units:
+        if unit[0] != 'analyze':
+            yield unit
+            continue
+        item = unit[1][0]
+        item_tokens = estimate_tokens(item['transcript'])
+        if current and (current_tokens + item_tokens > token_budget or len(current) >= max_chats or item['chat_id'] in current_ids):
+            yield ('analyze', current)
+            current, current_tokens, current_ids = [], 0, set()
+        current.append(item)
+        current_tokens += item_tokens
+        current_ids.add(item['chat_id'])
+    if current:
+        yield ('analyze', current)
+
+async def _analyze_chats_concurrently(chats_to_process, client_instance, model_name_str, concurrency, batch_token_budget=0,
+                                     journal=None, resumed_rows=None, report_sink=None):
+    """
+    流水线分析引擎，三个阶段同时运行，阶段之间用有界队列连接（队列满时上游等待，形成背压）：
+      1. 准备阶段：在后台线程中遍历 chats_to_process（可以是边读边清洗的生成器），生成对话文本、时间指标，批量模式下查缓存并分组
+      2. 分析阶段：concurrency 个 worker 从队列中取工作单元，最多保持 concurrency 个 API 请求同时进行
+      3. 结果阶段：按完成顺序生成结果行、写入检查点日志并输出进度，结果按输入顺序写回，保证 Excel 行顺序不变
+    batch_token_budget > 0 时把多条短对话合并到一个请求中分析（批量模式）。
+    journal 不为空时每条结果产生后立即写入检查点日志；resumed_rows 中已有结果的 chat_id 直接复用、不再调用 API。
+    report_sink 不为空时每条结果（包括复用的结果）立即交给部分结果报告 (PartialReportWriter)。
+    因可重试错误（超时、5xx、JSON 解析失败等）失败的对话会在所有对话处理完后重新排队，进行第二轮分析。
+    结果阶段出错（如检查点日志或部分结果写入时的 OSError）时停止其余阶段并抛出该异常，不会因为结果队列无人读取而一直等待。
+    返回 (结果行, 是否调用成功) 列表，顺序与输入一致。
+    """
+    loop = asyncio.get_running_loop()
+    concurrency = max(1, concurrency)
+    queue_size = PIPELINE_QUEUE_SIZE if PIPELINE_QUEUE_SIZE > 0 else concurrency * 2
+    work_queue = asyncio.Queue(maxsize=queue_size)
+    result_queue = asyncio.Queue(maxsize=queue_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    batch_mode = bool(batch_token_budget and batch_token_budget > 0 and client_instance is not None)
+
+    results_by_index = {}
+    requeued_items = []
+    progress = {'total': len(chats_to_process) if hasattr(chats_to_process, '__len__') else None, 'seen': 0, 'completed': 0}
+
+    def total_label():
+        # 流式输入时总数要等读取阶段结束才知道，此前显示为 "已读取数+"
+        return str(progress['total']) if progress['total'] is not None else f"{progress['seen']}+"
+
+    # --- 阶段 1：在线程中运行，CPU 密集的清洗/文本构造与 API 等待重叠 ---
+    # 流水线提前结束时 stop_producer() 取消读取线程正在等待的 put，读取线程随之退出
+    producer_stopped = threading.Event()
+    pending_puts = set()
+
+    def stop_producer():
+        producer_stopped.set()
+        for future in list(pending_puts):
+            future.cancel()
+
+    def produce():
+        def put(queue, message):
+            future = asyncio.run_coroutine_threadsafe(queue.put(message), loop)
+            pending_puts.add(future)
+            if producer_stopped.is_set():
+                future.cancel()
+            try:
+                future.result()
+            finally:
+                pending_puts.discard(future)
+
+        units = _iter_work_units(chats_to_process, model_name_str, batch_mode, resumed_rows)
+        if batch_mode:
+            units = _iter_chat_batches(units, batch_token_budget, BATCH_MAX_CHATS)
+        for unit in units:
+            if unit[0] == 'analyze':
+                progress['seen'] = max(progress['seen'], unit[1][-1]['index'] + 1)
+                put(work_queue, unit[1])
+            elif unit[0] == 'cached':
+                progress['seen'] = max(progress['seen'], unit[1]['index'] + 1)
+                put(result_queue, ('analysis', unit[1], unit[2], False))
+            else:
+                progress['seen'] = max(progress['seen'], unit[1] + 1)
+                put(result_queue, unit)
+
+    # --- 阶段 2：分析 worker ---
+    async def analyze_single(item, allow_requeue=True):
+        async with semaphore:
+            # 打印总体进度 (报告当前开始处理的是第几条总共多少条)
+            print(f"PYTHON_STATUS: Processing chat [{item['index'] + 1}/{total_label()}] (ID: {item['chat_id']})")
+            analysis_content = await analyze_chat_with_gemini_async(item['transcript'], client_instance, model_name_str, item['chat_id'])
+        await result_queue.put(('analysis', item, analysis_content, allow_requeue))
+
+    async def analyze_batch(items):
+        async with semaphore:
+            print(f"PYTHON_STATUS: Processing batch of {len(items)} chats [{items[0]['index'] + 1}..{items[-1]['index'] + 1}/{total_label()}]")
+            batch_contents = await analyze_chat_batch_with_gemini_async(items, client_instance, model_name_str)
+
+        fallback_items = []
+        for item in items:
+            analysis_content = batch_contents.get(item['chat_id']) if batch_contents else None
+            if analysis_content is None:
+                fallback_items.append(item)
+            else:
+                _store_cached_analysis(item['cache_key'], analysis_content)
+                await result_queue.put(('analysis', item, analysis_content, True))
+        if fallback_items:
+            print(f"PYTHON_WARNING: Batch result missing {len(fallback_items)} of {len(items)} chats, falling back to single-chat calls.", file=sys.stderr)
+            await asyncio.gather(*(analyze_single(item) for item in fallback_items))
+
+    async def worker():
+        while True:
+            items = await work_queue.get()
+            try:
+                if items is None:
+                    return
+                if len(items) == 1:
+                    await analyze_single(items[0])
+                else:
+                    await analyze_batch(items)
+            finally:
+                work_queue.task_done()
+
+    # --- 阶段 3：结果 ---
+    def record(index, chat_analysis, succeeded):
+        results_by_index[index] = (chat_analysis, succeeded)
+        if report_sink is not None:
+            report_sink.add(index, chat_analysis)
+        progress['completed'] += 1
+        completed = progress['completed']
+        print(f"PYTHON_STATUS: Completed [{completed}/{total_label()}] chats.")
+        if client_instance is not None and (completed % RATE_STATUS_EVERY == 0 or completed == progress['total']):
+            print(f"PYTHON_STATUS: {api_rate_limiter.status_line()}")
+
+    def finish(item, analysis_content, allow_requeue):
+        if allow_requeue and analysis_content.get("_retryable") and api_retry_policy.reserve_retry():
+            print(f"PYTHON_STATUS: Chat {item['chat_id']} failed with a retryable error, queued for a second pass.")
+            requeued_items.append(item)
+            return
+        chat_analysis = _build_chat_analysis_row(item['chat'], item['chat_id'], item['timing_metrics'], analysis_content, item['transcript_stats'])
+        succeeded = "API分析错误" not in analysis_content
+        if journal is not None:
+            journal.append(item['chat_id'], chat_analysis, succeeded)
+
+        if "API分析错误" in chat_analysis:
+             print(f"PYTHON_STATUS: Analysis failed for chat {item['chat_id']} with error: {chat_analysis['API分析错误']}.", file=sys.stderr) # Log error status
+        else:
+            print(f"PYTHON_STATUS: Analysis result processed for chat {item['chat_id']}.") # Log success status
+        record(item['index'], chat_analysis, succeeded)
+
+    async def sink():
+        while True:
+            message = await result_queue.get()
+            try:
+                if message is None:
+                    return
+                if message[0] == 'analysis':
+                    finish(*message[1:])
+                else:
+                    record(*message[1:])
+            finally:
+                result_queue.task_done()
+
+    sink_task = asyncio.create_task(sink())
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    async def unless_sink_failed(awaitable):
+        # 结果阶段异常退出后上游会阻塞在已满的结果队列上，此时直接抛出结果阶段的异常
+        task = asyncio.ensure_future(awaitable)
+        await asyncio.wait({task, sink_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            sink_task.result()
+            raise RuntimeError("Result stage stopped before the analysis finished.")
+        return task.result()
+
+    try:
+        await unless_sink_failed(loop.run_in_executor(None, produce))
+        progress['total'] = progress['seen']
+        for _ in workers:
+            await unless_sink_failed(work_queue.put(None))
+        await unless_sink_failed(asyncio.gather(*workers))
+        await unless_sink_failed(result_queue.join())
+
+        if requeued_items:
+            # 第二轮：等待一段时间让临时故障恢复，再逐条重新分析，这一轮的失败直接记录为错误
+            print(f"PYTHON_STATUS: Second pass: retrying {len(requeued_items)} chats in {api_retry_policy.second_pass_delay:.0f}s. {api_retry_policy.status_line()}")
+            await asyncio.sleep(api_retry_policy.second_pass_delay)
+            retry_items, requeued_items[:] = list(requeued_items), []
+            await unless_sink_failed(asyncio.gather(*(analyze_single(item, allow_requeue=False) for item in retry_items)))
+
+        await unless_sink_failed(result_queue.put(None))
+        await sink_task
+    finally:
+        # 读取阶段出错（如原始文件中途格式错误）或结果阶段出错时停止其余阶段，异常继续向上抛出
+        stop_producer()
+        for task in workers + [sink_task]:
+            task.cancel()
+        await asyncio.gather(*workers, sink_task, return_exceptions=True)
+
+    return [results_by_index[index] for index in range(progress['total'])]
+
+
+_event_loop = None
+
+def run_async(coro):
+    """
+    在模块级的持久事件循环中运行协程。
+    client.aio 的 HTTP 连接池绑定在创建它的事件循环上，常驻 worker 连续处理多个任务时
+    复用同一个循环，连接可以跨任务复用，也不会因为旧循环已关闭而报错。
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_event_loop)
+    return _event_loop.run_until_complete(coro)
 
-        # Include API error info if present
-        if "API分析错误" in analysis_content:
-             chat_analysis["API分析错误"] = analysis_content["API分析错误"]
-             skipped_api_calls += 1
-             print(f"PYTHON_STATUS: Analysis failed for chat {chat_id} with error: {analysis_content['API分析错误']}.", file=sys.stderr) # Log error status
+
+# --- 将核心分析和保存逻辑封装到函数中 ---
+def load_cleaned_chats(cleaned_input_file):
+    """
+    读取清洗后的对话，失败时打印 PYTHON_FATAL_ERROR 并返回 None。
+    cleaned_input_file 可以是清洗结果文件的路径（JSON 数组或 NDJSON，可用 .gz / .zst 压缩），也可以是清洗步骤在进程内直接传入的对话列表或迭代器。
+    """
+    if not isinstance(cleaned_input_file, (str, bytes, os.PathLike)):
+        cleaned_chats = list(cleaned_input_file)
+        print(f"PYTHON_STATUS: Received {len(cleaned_chats)} cleaned chats from the cleaning step.")
+        return cleaned_chats
+
+    print(f"PYTHON_STATUS: Loading cleaned data from {cleaned_input_file}...")
+    try:
+        cleaned_chats = list(iter_json_records(cleaned_input_file))
+        print(f"PYTHON_STATUS: Successfully loaded cleaned data. Found {len(cleaned_chats)} chats.")
+        return cleaned_chats
+    except FileNotFoundError:
+        print(f"PYTHON_FATAL_ERROR: Cleaned data file not found: {cleaned_input_file}.", file=sys.stderr)
+    except json.JSONDecodeError:
+        print(f"PYTHON_FATAL_ERROR: Failed to parse cleaned data file {cleaned_input_file}. Check JSON format.", file=sys.stderr)
+    except Exception as e:
+        print(f"PYTHON_FATAL_ERROR: Unknown error loading cleaned data: {e}", file=sys.stderr)
+    return None
+
+def run_analysis_process(cleaned_input_file, final_output_file_excel, client_instance, model_name_str, limit=None, print_results_to_console=True, concurrency=None, batch_token_budget=None,
+                         journal_path=None, resume=False, partial_report=False, export_formats=None):
+    if isinstance(cleaned_input_file, (str, bytes, os.PathLike, list)):
+        cleaned_chats = load_cleaned_chats(cleaned_input_file)
+        if cleaned_chats is None:
+            return []
+        chats_to_process = cleaned_chats[:limit] if limit is not None else cleaned_chats
+        print(f"PYTHON_STATUS: Starting analysis for {len(chats_to_process)} chats.")
+    else:
+        # 清洗步骤传入的迭代器：边清洗边分析，不先把全部对话收集到内存中
+        chats_to_process = itertools.islice(cleaned_input_file, limit) if limit is not None else cleaned_input_file
+        print("PYTHON_STATUS: Starting streaming analysis, chats are analyzed as soon as they are cleaned.")
+
+    analyzed_results = []
+
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY
+    if batch_token_budget is None:
+        batch_token_budget = DEFAULT_BATCH_TOKEN_BUDGET
+    if analysis_cache is not None:
+        analysis_cache.reset_stats()
+    api_retry_policy.reset()
+    api_call_latency.reset()
+    timing_metrics_latency.reset()
+
+    # 检查点日志：每条结果立即落盘，resume 时跳过日志中已成功的对话
+    journal = None
+    resumed_rows = None
+    if journal_path:
+        journal = AnalysisJournal(journal_path, resume=resume)
+        if resume:
+            resumed_rows = journal.load_completed()
+            print(f"PYTHON_STATUS: Resuming from journal {journal_path}: {len(resumed_rows)} chats already analyzed.")
         else:
-            successful_api_calls += 1
-            print(f"PYTHON_STATUS: Analysis result processed for chat {chat_id}.") # Log success status
+            print(f"PYTHON_STATUS: Writing per-chat results to journal {journal_path}.")
 
+    # 部分结果报告：分析进行中就可以下载已完成的结果
+    report_sink = None
+    if partial_report:
+        report_sink = PartialReportWriter(final_output_file_excel, REPORT_COLUMN_ORDER, write_partial_report_snapshot)
+        print(f"PYTHON_STATUS: Writing partial results to {report_sink.csv_path} as chats complete.")
 
-        analyzed_results.append(chat_analysis)
+    print(f"PYTHON_STATUS: Beginning concurrent chat analysis (max {concurrency} requests in flight)...")
+    try:
+        with stage('analyze', concurrency=concurrency, batch_token_budget=batch_token_budget) as analyze_stage:
+            ordered_results = run_async(
+                _analyze_chats_concurrently(chats_to_process, client_instance, model_name_str, concurrency, batch_token_budget,
+                                            journal=journal, resumed_rows=resumed_rows, report_sink=report_sink)
+            )
+            analyze_stage.count('chats', len(ordered_results))
+            analyze_stage.count('succeeded', sum(1 for _, succeeded in ordered_results if succeeded))
+    except BaseException:
+        if report_sink is not None:
+            report_sink.close(keep_files=True)
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        api_call_latency.emit()
+        timing_metrics_latency.emit()
+    total_chats_to_process = len(ordered_results)
 
-        if client_instance and "API分析错误" not in analysis_content:
-             time.sleep(6.0) # Delay to respect rate limits
+    successful_api_calls = 0
+    skipped_api_calls = 0
+    for chat_analysis, succeeded in ordered_results:
+        analyzed_results.append(chat_analysis)
+        if succeeded:
+            successful_api_calls += 1
+        else:
+            skipped_api_calls += 1
 
     print(f"\nPYTHON_STATUS: Finished analysis loop for {total_chats_to_process} chats.")
     print(f"PYTHON_STATUS: Summary: Successful API calls: {successful_api_calls}, Skipped/Failed: {skipped_api_calls}, Total Processed: {total_chats_to_process}")
+    print(f"PYTHON_STATUS: {api_retry_policy.status_line()}")
+    if analysis_cache is not None:
+        print(f"PYTHON_STATUS: {analysis_cache.stats_line()}")
+        analysis_cache.evict()
 
+    finalize_analysis_results(analyzed_results, total_chats_to_process, successful_api_calls, skipped_api_calls,
+                              final_output_file_excel, client_instance, model_name_str, export_formats=export_formats)
+    if report_sink is not None:
+        # 最终报告写出后部分结果已无用；保存失败时保留，仍可下载
+        report_sink.close(keep_files=not os.path.exists(final_output_file_excel))
+
+    return analyzed_results # Optionally return summary_data and overall_summary_text as well if needed by caller
+
+def finalize_analysis_results(analyzed_results, total_chats_to_process, successful_api_calls, skipped_api_calls,
+                              final_output_file_excel, client_instance, model_name_str, export_formats=None):
+    """
+    计算整体指标、生成 AI 整体总结并保存 Excel，返回整体总结文本。
+    export_formats 中的格式（见 REPORT_EXPORTERS）额外写在输出文件旁边，整体指标和总结写入 <输出文件名>.summary.json。
+    """
     # --- NEW: Calculate Overall Summary Metrics ---
     print("\nPYTHON_STATUS: Calculating overall analysis metrics...")
     total_chats_analyzed = len(analyzed_results)
@@ -417,10 +1158,8 @@ def run_analysis_process(cleaned_input_file, final_output_file_excel, client_ins
 
             print(f"PYTHON_STATUS: Calling AI for overall summary (Prompt len: {len(overall_summary_prompt)})...")
             start_time = time.time()
-            overall_response = client_instance.models.generate_content(
-                model=model_name_str,
-                contents=overall_summary_prompt
-            )
+            with stage('overall_summary'):
+                overall_response = generate_content_rate_limited(client_instance, model_name_str, overall_summary_prompt, "overall summary")
             end_time = time.time()
             print(f"PYTHON_STATUS: Overall summary AI call successful, took {end_time - start_time:.2f} seconds.")
 
@@ -465,76 +1204,189 @@ def run_analysis_process(cleaned_input_file, final_output_file_excel, client_ins
         print(f"PYTHON_OVERALL_SUMMARY:{overall_summary_text}")
 
 
+    report_format = 'ndjson' if is_ndjson_path(final_output_file_excel) else 'xlsx'
+    with stage('report_write', format=report_format) as write_stage:
+        write_stage.count('rows', len(analyzed_results))
+        if report_format == 'ndjson':
+            save_analysis_results_to_ndjson(analyzed_results, overall_summary_text, final_output_file_excel)
+        else:
+            save_analysis_results_to_excel(analyzed_results, overall_summary_text, final_output_file_excel)
+    if export_formats:
+        export_analysis_results(analyzed_results, overall_summary_text, summary_data, final_output_file_excel, export_formats)
+    return overall_summary_text
+
+# 报告中结果列的顺序
+REPORT_COLUMN_ORDER = [
+    "chat_id",
+    "客户姓名",
+    "初始对话时间段",
+    "客户意图总结",
+    "聊天质量点评 (基于内容)",
+    "改进建议 (具体动作)",
+    "首次回复时长 (秒)",
+    "是否合格 (30秒内合格)",
+    "潜在成交机会",
+    "情绪负面评价",
+    "API分析错误",
+    "对话文本截断"
+]
+# 数值列：Parquet 中保存为 float64，其余列均为字符串
+REPORT_NUMERIC_COLUMNS = ["首次回复时长 (秒)"]
+
+def _write_report_jsonl(analyzed_results, output_file):
+    """每行一条结果，键按报告列顺序排列，结果行中没有的列不写出"""
+    write_json_records(output_file, ({column: row[column] for column in REPORT_COLUMN_ORDER if column in row} for row in analyzed_results))
+
+def save_analysis_results_to_ndjson(analyzed_results, overall_summary_text, output_file):
+    """把逐条分析结果写成 NDJSON（每行一条，列与 Excel 相同，可加 .gz / .zst 压缩），整体总结写入旁边的 .summary.txt"""
+    print(f"\nPYTHON_STATUS: Attempting to save analysis results to NDJSON file: {output_file}...")
+    try:
+        _write_report_jsonl(analyzed_results, output_file)
+        with open(f"{output_file}.summary.txt", 'w', encoding='utf-8') as f:
+            f.write(overall_summary_text)
+        print(f"PYTHON_STATUS: Analysis results and overall summary successfully saved to NDJSON file: {output_file}")
+    except (OSError, ImportError) as e:
+        print(f"PYTHON_FATAL_ERROR: IO error writing file {output_file}: {e}", file=sys.stderr)
+
+def _excel_column_widths(df):
+    """
+    按 DataFrame 中字符串长度计算每列宽度：取表头和所有非空值的最长字符数，
+    公式与原来逐个单元格统计时相同：min((最长字符数 + 2) * 0.9, 30)
+    """
+    widths = []
+    for column in df.columns:
+        values = df[column]
+        lengths = values.astype(str).str.len().where(values.astype(bool), 0)
+        max_length = max(len(str(column)), int(lengths.max()) if len(lengths) else 0)
+        # 设置较小的基础宽度，适合自动换行
+        widths.append(min((max_length + 2) * 0.9, 30))  # 限制最大宽度为30
+    return widths
+
+def _summary_column_width(summary_lines):
+    """整体总结工作表 A 列宽度：尽量大，适合长文本，最大 120"""
+    max_length = max([len('Overall Analysis Summary')] + [len(line) for line in summary_lines])
+    return min((max_length + 8) * 1.2, 120)
+
+def _excel_width_to_pixels(width):
+    """
+    Excel 显示列宽时的像素换算（默认字体数字宽 7 像素）。xlsxwriter 的 set_column 会在宽度上再加边距，
+    这里换算成像素后用 set_column_pixels 设置，使显示宽度与 openpyxl 直接写入的宽度一致。
+    """
+    return int((256 * width + int(128 / 7)) / 256 * 7)
+
+def _write_excel_xlsxwriter(df, summary_lines, final_output_file_excel):
+    """
+    用 xlsxwriter 的 constant_memory 模式逐行写出：格式对象只创建一次、按行套用，列宽由 DataFrame 预先算好，
+    不再逐个单元格创建 Alignment，内存占用与行数无关。外观与 openpyxl 版本相同。
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(final_output_file_excel, {
+        'constant_memory': True,
+        # 模型输出的文本原样写入，不要被识别为公式、链接或数字
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'strings_to_numbers': False,
+    })
+    try:
+        # --- 第一个工作表：逐条分析结果 ---
+        worksheet = workbook.add_worksheet('Detailed Analysis')
+        cell_format = workbook.add_format({'text_wrap': True, 'align': 'center', 'valign': 'vcenter'})
+        for column_index, width in enumerate(_excel_column_widths(df)):
+            worksheet.set_column_pixels(column_index, column_index, _excel_width_to_pixels(width))
+        worksheet.set_row(0, 28)  # 表头行高
+        worksheet.write_row(0, 0, list(df.columns), cell_format)
+        for row_index, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_index, 0, row, cell_format)
+
+        # --- 第二个工作表：AI 整体总结 ---
+        summary_ws = workbook.add_worksheet('Overall Summary')
+        summary_header_format = workbook.add_format({'bold': True, 'font_size': 13, 'bg_color': '#D9E1F2', 'pattern': 1})
+        summary_cell_format = workbook.add_format({'font_size': 12, 'text_wrap': True, 'align': 'left', 'valign': 'top'})
+        summary_ws.set_column_pixels(0, 0, _excel_width_to_pixels(_summary_column_width(summary_lines)))
+        summary_ws.write(0, 0, 'Overall Analysis Summary', summary_header_format)
+        for row_index, line in enumerate(summary_lines, start=1):
+            summary_ws.set_row(row_index, 38)
+            summary_ws.write(row_index, 0, line, summary_cell_format)
+    finally:
+        workbook.close()
+
+def _write_excel_openpyxl(df, summary_lines, final_output_file_excel):
+    """未安装 xlsxwriter 时的备用写法：pandas + openpyxl，逐个单元格设置对齐方式"""
+    import pandas as pd
+    from openpyxl.styles import Alignment, Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    # Use ExcelWriter to write multiple sheets
+    with pd.ExcelWriter(final_output_file_excel, engine='openpyxl') as writer:
+        # Write the detailed analysis results to the first sheet
+        df.to_excel(writer, sheet_name='Detailed Analysis', index=False)
+
+        # 优化列宽和行高（自动换行，宽度适中）
+        worksheet = writer.sheets['Detailed Analysis']
+        for column_index, width in enumerate(_excel_column_widths(df), start=1):
+            worksheet.column_dimensions[get_column_letter(column_index)].width = width
+        worksheet.row_dimensions[1].height = 28  # 表头行高
+
+        # 设置自动换行和内容居中
+        alignment = Alignment(wrap_text=True, vertical='center', horizontal='center')
+        for row in worksheet.iter_rows():
+            for cell in row:
+                cell.alignment = alignment
+
+        # --- NEW: Write the AI-generated overall summary to a second sheet ---
+        summary_df = pd.DataFrame(summary_lines, columns=['Overall Analysis Summary'])
+        summary_df.to_excel(writer, sheet_name='Overall Summary', index=False)
+
+        # 美化 Overall Summary 工作表
+        summary_ws = writer.sheets['Overall Summary']
+        # 设置表头加粗、底色
+        header_cell = summary_ws['A1']
+        header_cell.font = Font(bold=True, size=13)
+        header_cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
+        # 设置内容区域字体、行高、适当列宽
+        for row in summary_ws.iter_rows(min_row=2):
+            for cell in row:
+                cell.font = Font(size=12)
+                cell.alignment = Alignment(wrap_text=True, vertical='top', horizontal='left')
+        # 自动调整列宽（尽量大，适合长文本）
+        summary_ws.column_dimensions['A'].width = _summary_column_width(summary_lines)  # 最大宽度120
+        # 设置每行高度更大，适合长文本自动换行
+        for row in range(2, summary_ws.max_row + 1):
+            summary_ws.row_dimensions[row].height = 38
+
+def _write_excel(df, summary_lines, output_file):
+    """安装了可选依赖 xlsxwriter 时用它逐行写出，否则使用 openpyxl"""
+    try:
+        import xlsxwriter  # noqa: F401
+    except ImportError:
+        _write_excel_openpyxl(df, summary_lines, output_file)
+    else:
+        _write_excel_xlsxwriter(df, summary_lines, output_file)
+
+def _report_dataframe(analyzed_results):
+    """结果行 -> 按报告列顺序排列、空值填为空字符串的 DataFrame"""
+    import pandas as pd
+
+    df = pd.DataFrame(analyzed_results)
+    df = df.reindex(columns=REPORT_COLUMN_ORDER)
+    return df.fillna("")
+
+def write_partial_report_snapshot(analyzed_results, output_file):
+    """部分结果的 xlsx 快照：格式与最终报告相同，整体总结工作表只说明分析仍在进行中；出错时直接抛出异常"""
+    df = _report_dataframe(analyzed_results)
+    summary_lines = [f"部分结果：已完成 {len(analyzed_results)} 条对话的分析，分析仍在进行中，整体总结将在全部完成后生成。"]
+    _write_excel(df, summary_lines, output_file)
+
+def save_analysis_results_to_excel(analyzed_results, overall_summary_text, final_output_file_excel):
+    """把逐条分析结果和整体总结写入 Excel（两个工作表）；安装了 xlsxwriter 时使用更快的逐行写法"""
     # --- 保存分析结果到 Excel 文件 ---
     print(f"\nPYTHON_STATUS: Attempting to save analysis results to Excel file: {final_output_file_excel}...")
     try:
-        df = pd.DataFrame(analyzed_results)
-        column_order = [
-            "chat_id",
-            "客户姓名",
-            "初始对话时间段",
-            "客户意图总结",
-            "聊天质量点评 (基于内容)",
-            "改进建议 (具体动作)",
-            "首次回复时长 (秒)",
-            "是否合格 (30秒内合格)",
-            "潜在成交机会",
-            "情绪负面评价",
-            "API分析错误"
-        ]
-        df = df.reindex(columns=column_order)
-        df = df.fillna("")
-
-        # Use ExcelWriter to write multiple sheets
-        with pd.ExcelWriter(final_output_file_excel, engine='openpyxl') as writer:
-            # Write the detailed analysis results to the first sheet
-            df.to_excel(writer, sheet_name='Detailed Analysis', index=False)
-
-            # 优化列宽和行高（自动换行，宽度适中）
-            worksheet = writer.sheets['Detailed Analysis']
-            for col in worksheet.columns:
-                max_length = 0
-                column = col[0].column_letter # 获取列字母
-                for cell in col:
-                    try:
-                        if cell.value:
-                            max_length = max(max_length, len(str(cell.value)))
-                    except:
-                        pass
-                # 设置较小的基础宽度，适合自动换行
-                adjusted_width = min((max_length + 2) * 0.9, 30)  # 限制最大宽度为30
-                worksheet.column_dimensions[column].width = adjusted_width
-            worksheet.row_dimensions[1].height = 28  # 表头行高
-
-            # 设置自动换行和内容居中
-            from openpyxl.styles import Alignment
-            for row in worksheet.iter_rows():
-                for cell in row:
-                    cell.alignment = Alignment(wrap_text=True, vertical='center', horizontal='center')
-
-            # --- NEW: Write the AI-generated overall summary to a second sheet ---
-            summary_lines = overall_summary_text.split('\n')
-            summary_df = pd.DataFrame(summary_lines, columns=['Overall Analysis Summary'])
-            summary_df.to_excel(writer, sheet_name='Overall Summary', index=False)
-
-            # 美化 Overall Summary 工作表
-            summary_ws = writer.sheets['Overall Summary']
-            from openpyxl.styles import Alignment, Font, PatternFill
-            # 设置表头加粗、底色
-            header_cell = summary_ws['A1']
-            header_cell.font = Font(bold=True, size=13)
-            header_cell.fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-            # 设置内容区域字体、行高、适当列宽
-            for row in summary_ws.iter_rows(min_row=2):
-                for cell in row:
-                    cell.font = Font(size=12)
-                    cell.alignment = Alignment(wrap_text=True, vertical='top', horizontal='left')
-            # 自动调整列宽（尽量大，适合长文本）
-            max_length = max(len(str(cell.value)) if cell.value else 0 for cell in summary_ws['A'])
-            summary_ws.column_dimensions['A'].width = min((max_length + 8) * 1.2, 120)  # 最大宽度120
-            # 设置每行高度更大，适合长文本自动换行
-            for row in range(2, summary_ws.max_row + 1):
-                summary_ws.row_dimensions[row].height = 38
+        df = _report_dataframe(analyzed_results)
+        summary_lines = overall_summary_text.split('\n')
+
+        _write_excel(df, summary_lines, final_output_file_excel)
 
         print(f"PYTHON_STATUS: Analysis results and overall summary successfully saved to Excel file: {final_output_file_excel}")
     except ImportError:
@@ -547,7 +1399,86 @@ def run_analysis_process(cleaned_input_file, final_output_file_excel, client_ins
         import traceback
         traceback.print_exc(file=sys.stderr)
 
-    return analyzed_results # Optionally return summary_data and overall_summary_text as well if needed by caller
+
+# --- 额外导出格式 ---
+# 与主报告使用相同的结果行，列顺序 (REPORT_COLUMN_ORDER) 和 "[无信息]" 占位符在所有格式中一致；
+# 每个导出函数接收 (结果行, report_frame, 整体总结文本, 输出路径)；
+# report_frame() 返回按报告列排列的 DataFrame，第一次调用时才构造（导入 pandas），不需要的格式不受其影响
+def _export_xlsx(analyzed_results, report_frame, overall_summary_text, output_file):
+    save_analysis_results_to_excel(analyzed_results, overall_summary_text, output_file)
+
+def _export_csv(analyzed_results, report_frame, overall_summary_text, output_file):
+    # utf-8-sig 让 Excel 直接打开时正确识别中文
+    report_frame().to_csv(output_file, index=False, encoding='utf-8-sig')
+
+def _export_jsonl(analyzed_results, report_frame, overall_summary_text, output_file):
+    _write_report_jsonl(analyzed_results, output_file)
+
+def _export_parquet(analyzed_results, report_frame, overall_summary_text, output_file):
+    from columnar_store import write_report_table  # 导入时加载 pyarrow，只在需要 Parquet 时导入
+    write_report_table(output_file, analyzed_results, REPORT_COLUMN_ORDER, REPORT_NUMERIC_COLUMNS)
+
+# 格式名 -> (扩展名, 导出函数)
+REPORT_EXPORTERS = {
+    'xlsx': ('.xlsx', _export_xlsx),
+    'csv': ('.csv', _export_csv),
+    'jsonl': ('.jsonl', _export_jsonl),
+    'parquet': ('.parquet', _export_parquet),
+}
+
+def parse_export_formats(value):
+    """'csv,parquet' 或列表 -> 去重后的格式名列表；不认识的格式打印警告后忽略"""
+    if isinstance(value, str):
+        value = value.split(',')
+    formats = []
+    for name in value or []:
+        name = name.strip().lower().lstrip('.')
+        if not name or name in formats:
+            continue
+        if name not in REPORT_EXPORTERS:
+            print(f"PYTHON_WARNING: Unknown export format '{name}' ignored (supported: {', '.join(REPORT_EXPORTERS)}).", file=sys.stderr)
+            continue
+        formats.append(name)
+    return formats
+
+def export_analysis_results(analyzed_results, overall_summary_text, summary_data, final_output_file, export_formats):
+    """
+    把结果额外导出为 export_formats 中的各个格式，文件名为 <输出文件名去掉扩展名>.<格式扩展名>，
+    与主报告相同的文件不再重复写出。整体指标和总结写入 <输出文件名去掉扩展名>.summary.json。
+    每写出一个文件输出一行 PYTHON_EXPORT_FILE:{json}；某个格式失败时只打印错误，不影响其他格式。
+    """
+    root = strip_data_extensions(final_output_file)
+    frames = []
+
+    def report_frame():
+        # 在各格式自己的 try 中构造，构造失败只影响用到它的格式；多个格式共用同一个 DataFrame
+        if not frames:
+            frames.append(_report_dataframe(analyzed_results))
+        return frames[0]
+
+    for name in parse_export_formats(export_formats):
+        extension, exporter = REPORT_EXPORTERS[name]
+        output_file = f"{root}{extension}"
+        if os.path.abspath(output_file) == os.path.abspath(final_output_file):
+            continue
+        print(f"PYTHON_STATUS: Exporting analysis results as {name}: {output_file}...")
+        try:
+            with stage('export', format=name):
+                exporter(analyzed_results, report_frame, overall_summary_text, output_file)
+        except Exception as e:
+            print(f"PYTHON_ERROR: Failed to export analysis results as {name} to {output_file}: {type(e).__name__} - {e}", file=sys.stderr)
+            continue
+        if os.path.exists(output_file):
+            print(f"PYTHON_EXPORT_FILE:{json.dumps({'format': name, 'path': output_file}, ensure_ascii=False)}")
+
+    summary_file = f"{root}.summary.json"
+    try:
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump({'metrics': summary_data, 'overall_summary': overall_summary_text}, f, ensure_ascii=False, indent=2)
+        print(f"PYTHON_EXPORT_FILE:{json.dumps({'format': 'summary', 'path': summary_file}, ensure_ascii=False)}")
+    except OSError as e:
+        print(f"PYTHON_ERROR: Failed to write summary file {summary_file}: {e}", file=sys.stderr)
+
 
 # --- 原来的 __main__ 块修改为独立运行时的逻辑 ---
 if __name__ == '__main__':
@@ -570,6 +1501,6 @@ if __name__ == '__main__':
     # When running independently, we might want pretty JSON print
     # Setting print_results_to_console=True will trigger the JSON dump with prefix
     # If you want pretty print in the terminal, you might need conditional print logic in run_analysis_process
-    run_analysis_process(input_file, output_file, client, MODEL_NAME, limit=limit_value, print_results_to_console=True)
+    run_analysis_process(input_file, output_file, get_client(), MODEL_NAME, limit=limit_value, print_results_to_console=True)
 
     print("\n--- analyze_chats.py independent run finished ---")
\ No newline at end of file
@@ -0,0 +1,356 @@
+# batch_analysis.py
+# 离线 Batch API 模式：把所有对话的分析请求写入一个 JSONL 批处理任务，提交后轮询直到完成，
+# 再把结果合并成与 run_analysis_process 相同格式的 Excel。适合整月导出这类不需要实时进度的大任务。
+#
+# 后端:
+#   GeminiBatchBackend - 通过 google-genai 的 files/batches 接口提交真实任务
+#   FileBatchBackend   - 基于本地目录的模拟批处理端点，用于本地测试
+
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+from analysis_journal import AnalysisJournal
+from instrumentation import stage
+from analyze_chats import (
+    STRUCTURED_OUTPUT,
+    analysis_generation_config,
+    build_analysis_prompt,
+    calculate_timing_metrics,
+    calculate_timing_metrics_batch,
+    finalize_analysis_results,
+    format_chat_transcript,
+    load_cleaned_chats,
+    _build_chat_analysis_row,
+    _empty_chat_row,
+    _lookup_cached_analysis,
+    _process_analysis_response,
+    _store_cached_analysis,
+)
+
+# 批处理任务的终止状态
+JOB_SUCCEEDED_STATES = ('JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED')
+JOB_FAILED_STATES = ('JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED')
+
+DEFAULT_POLL_SECONDS = float(os.environ.get('GEMINI_BATCH_POLL_SECONDS', '30'))
+# 设为 1 时按表一次计算全部对话的时间指标 (calculate_timing_metrics_batch)；
+# 逐条计算在找到第一条客服回复后就停止，在现有导出数据上比按表计算更快，默认逐条计算
+TABLE_TIMING_METRICS = os.environ.get('ANALYSIS_TABLE_TIMING_METRICS', '0') == '1'
+
+
+class GeminiBatchBackend:
+    """通过 Gemini Batch API 提交和查询批处理任务"""
+
+    def __init__(self, client):
+        self.client = client
+        self._jobs = {}
+
+    def submit(self, requests_path, model_name, display_name):
+        uploaded = self.client.files.upload(
+            file=requests_path,
+            config={'display_name': display_name, 'mime_type': 'jsonl'}
+        )
+        job = self.client.batches.create(model=model_name, src=uploaded.name, config={'display_name': display_name})
+        self._jobs[job.name] = job
+        return job.name
+
+    def poll(self, job_name):
+        job = self.client.batches.get(name=job_name)
+        self._jobs[job_name] = job
+        return job.state.name
+
+    def fetch_results(self, job_name, destination_path):
+        job = self._jobs[job_name]
+        content = self.client.files.download(file=job.dest.file_name)
+        with open(destination_path, 'wb') as f:
+            f.write(content)
+
+
+class FileBatchBackend:
+    """
+    基于本地目录的批处理端点模拟。
+    提交时把请求文件复制到 <root>/<job_id>/input.jsonl，第一次轮询时生成 output.jsonl 并标记完成。
+    如果 <root>/responses.jsonl 存在（每行 {"key": ..., "response": {...}} 或 {"key": ..., "error": {...}}），
+    按 key 返回其中的内容；否则按请求中的 response_schema 返回所有字段为空字符串的结果。
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _job_dir(self, job_name):
+        return os.path.join(self.root_dir, job_name.split('/')[-1])
+
+    def submit(self, requests_path, model_name, display_name):
+        job_name = f"batches/stub-{uuid.uuid4().hex}"
+        job_dir = self._job_dir(job_name)
+        os.makedirs(job_dir)
+        shutil.copyfile(requests_path, os.path.join(job_dir, 'input.jsonl'))
+        with open(os.path.join(job_dir, 'state.json'), 'w', encoding='utf-8') as f:
+            json.dump({'state': 'JOB_STATE_PENDING', 'model': model_name, 'display_name': display_name}, f)
+        return job_name
+
+    def poll(self, job_name):
+        job_dir = self._job_dir(job_name)
+        with open(os.path.join(job_dir, 'state.json'), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['state'] == 'JOB_STATE_PENDING':
+            self._run_job(job_dir)
+            state['state'] = 'JOB_STATE_SUCCEEDED'
+            with open(os.path.join(job_dir, 'state.json'), 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+        return state['state']
+
+    def fetch_results(self, job_name, destination_path):
+        shutil.copyfile(os.path.join(self._job_dir(job_name), 'output.jsonl'), destination_path)
+
+    def _run_job(self, job_dir):
+        canned = {}
+        canned_path = os.path.join(self.root_dir, 'responses.jsonl')
+        if os.path.exists(canned_path):
+            with open(canned_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        canned[entry['key']] = entry
+
+        with open(os.path.join(job_dir, 'input.jsonl'), 'r', encoding='utf-8') as src, \
+             open(os.path.join(job_dir, 'output.jsonl'), 'w', encoding='utf-8') as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request_line = json.loads(line)
+                key = request_line['key']
+                result = canned.get(key) or {'key': key, 'response': self._placeholder_response(request_line['request'])}
+                dst.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def _placeholder_response(request):
+        schema = request.get('generation_config', {}).get('response_schema') or {}
+        fields = schema.get('required') or list(schema.get('properties', {}))
+        return {
+            'candidates': [{
+                'content': {'role': 'model', 'parts': [{'text': json.dumps({key: "" for key in fields}, ensure_ascii=False)}]},
+                'finishReason': 'STOP'
+            }]
+        }
+
+
+def _batch_request_line(key, prompt):
+    """构造 Batch API JSONL 中的一行请求"""
+    request = {'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]}
+    generation_config = analysis_generation_config()
+    if generation_config:
+        request['generation_config'] = generation_config
+    return {'key': key, 'request': request}
+
+def _batch_error_result(message):
+    return {
+        "API分析错误": message,
+        "客户意图总结": "Analysis error", "聊天质量点评 (基于内容)": "", "改进建议 (具体动作)": "", "潜在成交机会": "", "情绪负面评价": ""
+    }
+
+def _batch_job_path(journal_path):
+    """记录已提交批处理任务的旁路文件，与检查点日志放在一起，如 <输出Excel路径>.journal.batch_job.json"""
+    return f"{os.path.splitext(journal_path)[0]}.batch_job.json"
+
+def _save_submitted_batch_job(path, job_name, pending):
+    """任务提交后立即记录任务名和每个请求 key 对应的 chat_id，进程中途退出后 resume 时据此重新连接"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'job_name': job_name, 'requests': {key: chat_id for key, (_, chat_id, _) in pending.items()}},
+                  f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def _load_submitted_batch_job(path, pending):
+    """读取上次提交的任务名；只有本次待分析的请求都包含在那个任务中时才复用，否则返回 None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            submitted = json.load(f)
+        job_name = submitted['job_name']
+        submitted_requests = submitted.get('requests', {})
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"PYTHON_WARNING: Could not read submitted batch job from {path}: {type(e).__name__} - {e}", file=sys.stderr)
+        return None
+    if any(submitted_requests.get(key) != chat_id for key, (_, chat_id, _) in pending.items()):
+        print(f"PYTHON_WARNING: Batch job {job_name} in {path} does not cover the chats of this run, submitting a new job.",
+              file=sys.stderr)
+        return None
+    return job_name
+
+def _remove_submitted_batch_job(path):
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"PYTHON_WARNING: Could not remove {path}: {e}", file=sys.stderr)
+
+def _parse_batch_result_line(result_line, chat_id):
+    """把批处理结果中的一行转换为分析结果 dict"""
+    from google.genai import types
+
+    if result_line.get('error'):
+        return _batch_error_result(f"Batch request failed: {json.dumps(result_line['error'], ensure_ascii=False)}")
+    try:
+        response = types.GenerateContentResponse.model_validate(result_line.get('response') or {})
+        return _process_analysis_response(response, chat_id, structured=STRUCTURED_OUTPUT)
+    except Exception as e:
+        print(f"PYTHON_ERROR: Failed to parse batch result for chat {chat_id}: {type(e).__name__} - {e}", file=sys.stderr)
+        return _batch_error_result(f"{type(e).__name__}: {e}")
+
+def run_batch_analysis_process(cleaned_input_file, final_output_file_excel, backend, client_instance, model_name_str,
+                               limit=None, poll_interval=None, journal_path=None, resume=False, export_formats=None):
+    """
+    Batch API 版本的 run_analysis_process：提交一个批处理任务分析所有未命中缓存的对话，
+    轮询直到完成后按输入顺序生成与交互模式相同的 Excel。
+    journal_path / resume / export_formats 的含义与 run_analysis_process 相同。
+    提交后任务名记录在检查点日志旁的 .batch_job.json 中；resume 时如果该任务仍覆盖所有待分析的对话，
+    直接继续轮询这个任务，不重新提交（避免重复计费和重新排队）。
+    """
+    cleaned_chats = load_cleaned_chats(cleaned_input_file)
+    if cleaned_chats is None:
+        return []
+    if poll_interval is None:
+        poll_interval = DEFAULT_POLL_SECONDS
+
+    chats_to_process = cleaned_chats[:limit] if limit is not None else cleaned_chats
+    total_chats_to_process = len(chats_to_process)
+    print(f"PYTHON_STATUS: Preparing batch job for {total_chats_to_process} chats.")
+
+    work_dir = os.path.dirname(os.path.abspath(final_output_file_excel))
+    run_id = uuid.uuid4().hex
+    requests_path = os.path.join(work_dir, f"temp_batch_requests_{run_id}.jsonl")
+    results_path = os.path.join(work_dir, f"temp_batch_results_{run_id}.jsonl")
+
+    journal = AnalysisJournal(journal_path, resume=resume) if journal_path else None
+    batch_job_path = _batch_job_path(journal_path) if journal_path else None
+    resumed_rows = journal.load_completed() if journal is not None and resume else {}
+    if resumed_rows:
+        print(f"PYTHON_STATUS: Resuming from journal {journal_path}: {len(resumed_rows)} chats already analyzed.")
+
+    analysis_contents = [None] * total_chats_to_process
+    transcript_stats = [None] * total_chats_to_process
+    # 时间指标只计算一次，写检查点日志和生成结果行时共用
+    with stage('timing_metrics', table=TABLE_TIMING_METRICS) as metrics_stage:
+        timing_metrics = None
+        if TABLE_TIMING_METRICS:
+            # 按表计算只是可选的加速，出错时回退为逐条计算，不影响批处理任务
+            try:
+                timing_metrics = calculate_timing_metrics_batch([chat.get('messages', []) for chat in chats_to_process])
+            except Exception as e:
+                print(f"PYTHON_WARNING: Table timing metrics failed, falling back to per-chat calculation: {type(e).__name__} - {e}",
+                      file=sys.stderr)
+        if timing_metrics is None:
+            timing_metrics = [calculate_timing_metrics(chat.get('messages', [])) for chat in chats_to_process]
+        metrics_stage.count('chats', len(timing_metrics))
+    pending = {}
+    with open(requests_path, 'w', encoding='utf-8') as f:
+        for index, chat in enumerate(chats_to_process):
+            chat_id = chat.get('chat_id', f'UnknownID_{index+1}')
+            messages = chat.get('messages', [])
+            if not messages or chat_id in resumed_rows:
+                continue
+            transcript, transcript_stats[index] = format_chat_transcript(messages)
+            cache_key, cached_result = _lookup_cached_analysis(transcript, model_name_str, chat_id)
+            if cached_result is not None:
+                analysis_contents[index] = cached_result
+                continue
+            key = str(index)
+            pending[key] = (index, chat_id, cache_key)
+            f.write(json.dumps(_batch_request_line(key, build_analysis_prompt(transcript)), ensure_ascii=False) + '\n')
+
+    try:
+        if pending:
+            print(f"PYTHON_STATUS: Submitting batch job with {len(pending)} requests...")
+            # 运行指标：提交到任务结束（包括排队和轮询等待）的总耗时
+            with stage('batch_job') as job_stage:
+                job_stage.count('requests', len(pending))
+                job_name = _load_submitted_batch_job(batch_job_path, pending) if resume and batch_job_path else None
+                if job_name is not None:
+                    print(f"PYTHON_STATUS: Re-attaching to batch job {job_name} submitted by the interrupted run.")
+                else:
+                    job_name = backend.submit(requests_path, model_name_str, f"chat-analysis-{run_id}")
+                    print(f"PYTHON_STATUS: Batch job submitted: {job_name}")
+                    if batch_job_path:
+                        _save_submitted_batch_job(batch_job_path, job_name, pending)
+
+                start_time = time.time()
+                while True:
+                    state = backend.poll(job_name)
+                    print(f"PYTHON_STATUS: Batch job {job_name} state: {state} (elapsed {time.time() - start_time:.0f}s)")
+                    if state in JOB_SUCCEEDED_STATES or state in JOB_FAILED_STATES:
+                        break
+                    time.sleep(poll_interval)
+
+            if state in JOB_SUCCEEDED_STATES:
+                backend.fetch_results(job_name, results_path)
+                with open(results_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        result_line = json.loads(line)
+                        if result_line.get('key') not in pending:
+                            continue
+                        index, chat_id, cache_key = pending[result_line['key']]
+                        analysis_content = _parse_batch_result_line(result_line, chat_id)
+                        _store_cached_analysis(cache_key, analysis_content)
+                        analysis_contents[index] = analysis_content
+                        if journal is not None:
+                            chat = chats_to_process[index]
+                            journal.append(chat_id, _build_chat_analysis_row(chat, chat_id, timing_metrics[index], analysis_content,
+                                                                            transcript_stats[index]),
+                                           "API分析错误" not in analysis_content)
+            else:
+                print(f"PYTHON_ERROR: Batch job {job_name} ended with state {state}.", file=sys.stderr)
+            # 任务已结束、结果已写入检查点日志，之后的 resume 不再连接这个任务
+            if batch_job_path:
+                _remove_submitted_batch_job(batch_job_path)
+        elif batch_job_path:
+            _remove_submitted_batch_job(batch_job_path)
+    finally:
+        if journal is not None:
+            journal.close()
+        for temp_path in (requests_path, results_path):
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    analyzed_results = []
+    successful_api_calls = 0
+    skipped_api_calls = 0
+    for index, chat in enumerate(chats_to_process):
+        chat_id = chat.get('chat_id', f'UnknownID_{index+1}')
+        messages = chat.get('messages', [])
+        if not messages:
+            analyzed_results.append(_empty_chat_row(chat_id))
+            skipped_api_calls += 1
+            continue
+        if chat_id in resumed_rows:
+            analyzed_results.append(resumed_rows[chat_id])
+            successful_api_calls += 1
+            continue
+        analysis_content = analysis_contents[index]
+        if analysis_content is None:
+            analysis_content = _batch_error_result("Batch job returned no result for this chat.")
+        analyzed_results.append(_build_chat_analysis_row(chat, chat_id, timing_metrics[index], analysis_content,
+                                                         transcript_stats[index]))
+        if "API分析错误" in analysis_content:
+            skipped_api_calls += 1
+        else:
+            successful_api_calls += 1
+
+    print(f"\nPYTHON_STATUS: Finished batch analysis for {total_chats_to_process} chats.")
+    print(f"PYTHON_STATUS: Summary: Successful API calls: {successful_api_calls}, Skipped/Failed: {skipped_api_calls}, Total Processed: {total_chats_to_process}")
+
+    finalize_analysis_results(analyzed_results, total_chats_to_process, successful_api_calls, skipped_api_calls,
+                              final_output_file_excel, client_instance, model_name_str, export_formats=export_formats)
+    return analyzed_results
@@ -1,34 +1,37 @@
 import json
 import re
-from datetime import datetime, timezone, timedelta
 import sys
 
-# 定义香港时区 (UTC+8)
-HKT = timezone(timedelta(hours=8))
-
-def clean_chat_data(input_file, output_file):
-    # 读取输入文件
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        print(f"成功读取文件: {input_file}")
-        # 打印读取到的对话总数
-        initial_chat_count = len(data)
-        print(f"输入文件中包含 {initial_chat_count} 条原始对话记录。")
-
-    except FileNotFoundError:
-        print(f"错误：找不到文件 {input_file}")
-        return
-    except json.JSONDecodeError:
-        print(f"错误：无法解析文件 {input_file}，请检查文件格式是否为有效的JSON。")
-        return
-    except Exception as e:
-        print(f"读取文件时发生未知错误: {e}")
-        return
-
-    cleaned_chats = []
-
-    for chat in data:
+from instrumentation import IterationTimer
+from json_stream import JsonRecordWriter, iter_json_records
+from time_utils import format_hkt_time
+
+def iter_cleaned_chats(input_file, stats=None):
+    """
+    流式读取原始导出文件，逐条产出清洗后的对话（只保留包含客户消息的对话）。
+    输入可以是 JSON 数组或 NDJSON（.ndjson / .jsonl），均可用 .gz / .zst 压缩，见 json_stream.py。
+    stats 不为 None 时，读取完成后在其中记录 raw_chats（原始对话数）和 cleaned_chats（保留的对话数）；
+    另外一开始就放入 counts（各条清洗规则的计数）和 load_timer（读取、解析原始文件所花的时间），
+    读取过程中随时更新，提前停止读取（设置了 limit）时也可以用于运行指标。
+    文件不存在时抛出 FileNotFoundError，格式错误时抛出 json.JSONDecodeError（可能在已经产出部分对话之后）。
+    """
+    raw_chat_count = 0
+    cleaned_chat_count = 0
+    counts = {
+        'events': 0,
+        'messages_kept': 0,
+        'events_dropped_system_or_form': 0,
+        'events_dropped_empty_text': 0,
+        'chats_dropped_no_messages': 0,
+        'chats_dropped_no_customer_message': 0,
+    }
+    records = IterationTimer(iter_json_records(input_file))
+    if stats is not None:
+        stats['counts'] = counts
+        stats['load_timer'] = records
+
+    for chat in records:
+        raw_chat_count += 1
         # 提取基本信息
         chat_id = chat.get('id', '')
         users = chat.get('users', [])
@@ -44,33 +47,16 @@ def clean_chat_data(input_file, output_file):
 
         # 提取对话内容
         messages = []
+        counts['events'] += len(events)
         for event in events:
             event_type = event.get('type', '')
             created_at = event.get('created_at', '')
             author_id = event.get('author_id', '')
             text = event.get('text', '')
 
-            # 格式化时间
+            # 格式化时间（LiveChat 固定格式走快速路径并缓存，见 time_utils.py）
             try:
-                # 兼容 'Z' 和非 'Z' 的ISO格式
-                if created_at:
-                    # 尝试解析时间字符串
-                    dt_original = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-
-                    # 如果是 naive datetime (无时区信息)，假设它是 UTC 并标记
-                    if dt_original.tzinfo is None:
-                        dt_utc = dt_original.replace(tzinfo=timezone.utc) # 标记为 UTC
-                    else:
-                        dt_utc = dt_original
-
-                    # 将时间转换为香港时间 (HKT)
-                    dt_hkt = dt_utc.astimezone(HKT)
-
-                    # 格式化为不带时区信息的字符串 (保持原有输出格式)
-                    formatted_time = dt_hkt.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    formatted_time = '' # 处理 None 或空字符串
-
+                formatted_time = format_hkt_time(created_at)
             except (ValueError, TypeError) as e: # 捕获解析错误
                 print(f"WARNING: Could not parse or convert time \'{created_at}\' for chat ID {chat_id}: {e}. Using original string.", file=sys.stderr) # 打印警告到 stderr
                 formatted_time = created_at # 解析失败时使用原始字符串
@@ -85,9 +71,11 @@ def clean_chat_data(input_file, output_file):
 
             # 跳过系统消息、表单消息和无效消息
             if event_type in ['system_message', 'form']:
+                counts['events_dropped_system_or_form'] += 1
                 continue
             # 进一步清理文本，移除仅包含空白字符的文本
             if not text or not text.strip():
+                counts['events_dropped_empty_text'] += 1
                 continue
 
             messages.append({
@@ -110,23 +98,58 @@ def clean_chat_data(input_file, output_file):
                 },
                 'messages': messages
             }
-            cleaned_chats.append(cleaned_chat)
+            cleaned_chat_count += 1
+            counts['messages_kept'] += len(messages)
+            yield cleaned_chat
+        elif not messages:
+            counts['chats_dropped_no_messages'] += 1
+        else:
+            counts['chats_dropped_no_customer_message'] += 1
         # ==================
 
-    # 打印清洗后保留的对话数量
-    cleaned_chat_count = len(cleaned_chats)
-    print(f"清洗后保留了 {cleaned_chat_count} 条包含有效客户消息的对话记录。")
+    if stats is not None:
+        stats['raw_chats'] = raw_chat_count
+        stats['cleaned_chats'] = cleaned_chat_count
 
-    # 保存清洗后的数据
+def clean_chat_data(input_file, output_file):
+    # 流式读取输入文件，边解析边清洗边写出，不需要把整个导出文件或清洗结果载入内存
+    stats = {}
+    read_errors = []
+
+    def read_cleaned_chats():
+        # 记录读取阶段的异常，与写入时的异常分开报告
+        try:
+            yield from iter_cleaned_chats(input_file, stats)
+        except (OSError, ImportError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            read_errors.append(e)
+            raise
+
+    # 输出格式由扩展名决定：.json 为 indent=2 的 JSON 数组，.ndjson / .jsonl 每行一条对话；
+    # 出错时 JsonRecordWriter 丢弃临时文件，不会留下写了一半的输出
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(cleaned_chats, f, ensure_ascii=False, indent=2)
-        print(f"清洗后的数据已保存到文件: {output_file}")
-    except IOError as e:
-        print(f"写入文件 {output_file} 时发生IO错误: {e}")
+        with JsonRecordWriter(output_file) as writer:
+            for cleaned_chat in read_cleaned_chats():
+                writer.write(cleaned_chat)
     except Exception as e:
-        print(f"写入文件时发生未知错误: {e}")
+        if not read_errors:
+            if isinstance(e, (IOError, ImportError)):
+                print(f"写入文件 {output_file} 时发生IO错误: {e}")
+            else:
+                print(f"写入文件时发生未知错误: {e}")
+        elif isinstance(e, FileNotFoundError):
+            print(f"错误：找不到文件 {input_file}")
+        elif isinstance(e, json.JSONDecodeError):
+            print(f"错误：无法解析文件 {input_file}，请检查文件格式是否为有效的JSON。")
+        else:
+            print(f"读取文件时发生未知错误: {e}")
+        return
 
+    print(f"成功读取文件: {input_file}")
+    # 打印读取到的对话总数
+    print(f"输入文件中包含 {stats['raw_chats']} 条原始对话记录。")
+    # 打印清洗后保留的对话数量
+    print(f"清洗后保留了 {writer.count} 条包含有效客户消息的对话记录。")
+    print(f"清洗后的数据已保存到文件: {output_file}")
 
 if __name__ == '__main__':
     input_file = 'chats20250430.json'  # 输入文件路径
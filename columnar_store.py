@@ -0,0 +1,213 @@
+# columnar_store.py
+# 清洗结果的列式存储 (Parquet)：与 indent=2 的嵌套 JSON 不同，后续统计、筛选和重新分析
+# 可以只读取需要的列（内存映射），不必解析整个 JSON 树。
+# 每个月份写出两个文件：
+#   <前缀>.chats.parquet     每条对话一行，客户和来源字段展开为列
+#   <前缀>.messages.parquet  每条消息一行，通过 chat_id 关联对话
+# 分析报告也可以导出为单个 Parquet 表（write_report_table），供 BI 工具按类型读取，不必再解析 xlsx。
+# 依赖可选的 pyarrow，未安装时 pa / pq 为 None，由调用方决定是否跳过。
+
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 每个 row group 包含的对话数，写入时只在内存中保留这么多行
+DEFAULT_ROW_GROUP_CHATS = 10000
+
+# 对话表中展开的字段：(列名, 取值路径)
+_CHAT_TEXT_COLUMNS = [
+    ('chat_id', ('chat_id',)),
+    ('created_at', ('created_at',)),
+    ('customer_name', ('customer', 'name')),
+    ('customer_email', ('customer', 'email')),
+    ('customer_phone', ('customer', 'phone')),
+    ('source_referrer', ('source', 'referrer')),
+    ('source_start_url', ('source', 'start_url')),
+    ('source_ip', ('source', 'ip')),
+    ('source_user_agent', ('source', 'user_agent')),
+    ('source_country', ('source', 'geolocation', 'country')),
+    ('source_visit_started_at', ('source', 'visit_started_at')),
+    ('source_visit_ended_at', ('source', 'visit_ended_at')),
+]
+# 结构不固定的嵌套字段以 JSON 字符串保存
+_CHAT_JSON_COLUMNS = [
+    ('source_geolocation', ('source', 'geolocation')),
+    ('source_session_fields', ('source', 'session_fields')),
+    ('source_last_pages', ('source', 'last_pages')),
+]
+_MESSAGE_COLUMNS = ['chat_id', 'message_index', 'time', 'sender', 'content']
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for Parquet output (pip install pyarrow).")
+
+def _chats_schema():
+    fields = [pa.field(name, pa.string()) for name, _ in _CHAT_TEXT_COLUMNS + _CHAT_JSON_COLUMNS]
+    fields.append(pa.field('messages_count', pa.int32()))
+    return pa.schema(fields)
+
+def _messages_schema():
+    return pa.schema([
+        pa.field('chat_id', pa.string()),
+        pa.field('message_index', pa.int32()),
+        pa.field('time', pa.string()),
+        pa.field('sender', pa.string()),
+        pa.field('content', pa.string()),
+    ])
+
+def _get_path(chat, path):
+    value = chat
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def _as_text(value):
+    """字符串列的值：非字符串（如导出中偶尔出现的数字电话）按 JSON 文本保存"""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+class CleanedChatParquetWriter:
+    """
+    逐条接收清洗后的对话（与 cleaned_chats_*.json 中的元素格式相同），分批写入对话表和消息表。
+    文件先写到 .tmp 路径，close() 时才替换为正式文件；abort() 丢弃已写入的部分。
+    """
+
+    def __init__(self, chats_path, messages_path, row_group_chats=DEFAULT_ROW_GROUP_CHATS):
+        _require_pyarrow()
+        self.chats_path = chats_path
+        self.messages_path = messages_path
+        self.row_group_chats = row_group_chats
+        self.chat_count = 0
+        self.message_count = 0
+        self._chats_writer = pq.ParquetWriter(f"{chats_path}.tmp", _chats_schema())
+        self._messages_writer = pq.ParquetWriter(f"{messages_path}.tmp", _messages_schema())
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        self._chat_rows = {name: [] for name in _chats_schema().names}
+        self._message_rows = {name: [] for name in _MESSAGE_COLUMNS}
+        self._buffered_chats = 0
+
+    def add(self, chat):
+        chat_id = _as_text(chat.get('chat_id'))
+        for name, path in _CHAT_TEXT_COLUMNS:
+            self._chat_rows[name].append(_as_text(_get_path(chat, path)))
+        for name, path in _CHAT_JSON_COLUMNS:
+            value = _get_path(chat, path)
+            self._chat_rows[name].append(json.dumps(value, ensure_ascii=False) if value is not None else None)
+
+        messages = chat.get('messages', [])
+        self._chat_rows['messages_count'].append(len(messages))
+        for index, message in enumerate(messages):
+            self._message_rows['chat_id'].append(chat_id)
+            self._message_rows['message_index'].append(index)
+            self._message_rows['time'].append(_as_text(message.get('time')))
+            self._message_rows['sender'].append(_as_text(message.get('sender')))
+            self._message_rows['content'].append(_as_text(message.get('content')))
+
+        self.chat_count += 1
+        self.message_count += len(messages)
+        self._buffered_chats += 1
+        if self._buffered_chats >= self.row_group_chats:
+            self._flush()
+
+    def _flush(self):
+        if self._buffered_chats == 0:
+            return
+        self._chats_writer.write_table(pa.table(self._chat_rows, schema=_chats_schema()))
+        self._messages_writer.write_table(pa.table(self._message_rows, schema=_messages_schema()))
+        self._reset_buffers()
+
+    def close(self):
+        self._flush()
+        self._chats_writer.close()
+        self._messages_writer.close()
+        os.replace(f"{self.chats_path}.tmp", self.chats_path)
+        os.replace(f"{self.messages_path}.tmp", self.messages_path)
+
+    def abort(self):
+        for writer in (self._chats_writer, self._messages_writer):
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for path in (f"{self.chats_path}.tmp", f"{self.messages_path}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def parquet_paths(prefix):
+    """返回 (对话表路径, 消息表路径)"""
+    return f"{prefix}.chats.parquet", f"{prefix}.messages.parquet"
+
+def read_table(path, columns=None):
+    """以内存映射方式读取 Parquet 表，columns 指定时只读取这些列"""
+    _require_pyarrow()
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+def iter_cleaned_chats_from_parquet(chats_path, messages_path):
+    """把两张表还原为与 cleaned_chats_*.json 相同结构的对话，按写入顺序逐条产出"""
+    chats = read_table(chats_path).to_pylist()
+    messages = read_table(messages_path).to_pylist()
+    message_pos = 0
+    for row in chats:
+        source = {
+            'referrer': row['source_referrer'],
+            'start_url': row['source_start_url'],
+            'ip': row['source_ip'],
+            'user_agent': row['source_user_agent'],
+            'geolocation': json.loads(row['source_geolocation']) if row['source_geolocation'] is not None else None,
+            'visit_started_at': row['source_visit_started_at'],
+            'visit_ended_at': row['source_visit_ended_at'],
+            'session_fields': json.loads(row['source_session_fields']) if row['source_session_fields'] is not None else None,
+            'last_pages': json.loads(row['source_last_pages']) if row['source_last_pages'] is not None else None,
+        }
+        # 消息表与对话表按相同顺序写入，每条对话的消息是连续的 messages_count 行
+        chat_messages = messages[message_pos:message_pos + row['messages_count']]
+        message_pos += row['messages_count']
+        yield {
+            'chat_id': row['chat_id'],
+            'customer': {
+                'name': row['customer_name'],
+                'email': row['customer_email'],
+                'phone': row['customer_phone'],
+            },
+            'source': source,
+            'messages': [{'time': m['time'], 'sender': m['sender'], 'content': m['content']} for m in chat_messages],
+            'created_at': row['created_at'],
+        }
+
+
+def _as_float(value):
+    """数值列的值：None 和空字符串为 null"""
+    if value is None or value == '':
+        return None
+    return float(value)
+
+def write_report_table(path, rows, columns, numeric_columns=()):
+    """
+    把分析报告的结果行写成一个 Parquet 表，列顺序与 columns 相同。
+    numeric_columns 中的列为 float64（缺失为 null），其余列为字符串，缺失的值与 Excel 报告一样写成空字符串。
+    """
+    _require_pyarrow()
+    fields = []
+    arrays = {}
+    for column in columns:
+        if column in numeric_columns:
+            fields.append(pa.field(column, pa.float64()))
+            arrays[column] = [_as_float(row.get(column)) for row in rows]
+        else:
+            fields.append(pa.field(column, pa.string()))
+            arrays[column] = [_as_text(row.get(column)) if row.get(column) is not None else '' for row in rows]
+    pq.write_table(pa.table(arrays, schema=pa.schema(fields)), path)
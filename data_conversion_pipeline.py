@@ -12,13 +12,81 @@
 
 import json
 import re
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 import sys
 import os
+import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-# 定义香港时区 (UTC+8)
-HKT = timezone(timedelta(hours=8))
+from json_stream import JsonRecordWriter, is_compressed_path, is_ndjson_path, iter_json_records, write_json_records
+from columnar_store import CleanedChatParquetWriter, parquet_paths, pa
+from time_utils import HKT, format_hkt_time
+
+# 分片清洗：JSON 数组（及压缩的 NDJSON）导出每片包含的对话数，以及未压缩 NDJSON 导出每片的字节数
+SHARD_CHATS = 2000
+SHARD_BYTES = 32 << 20
+
+def _clean_chat_shard(chats):
+    """进程池任务：清洗一片对话，返回 (原始对话数, 有效咨询列表)"""
+    processor = ChatDataProcessor()
+    cleaned_chats = [processor.clean_chat(chat) for chat in chats]
+    return len(chats), [chat for chat in cleaned_chats if chat is not None]
+
+def _clean_ndjson_range(input_file, start, end):
+    """
+    进程池任务：解析并清洗 NDJSON 文件中首字节位于 [start, end) 的行，返回 (原始对话数, 有效咨询列表)。
+    解析也在子进程中完成，主进程只负责按字节划分文件。
+    """
+    chats = []
+    with open(input_file, 'rb') as f:
+        if start > 0:
+            # 从 start 前一个字节开始跳到下一个换行之后，跨越 start 的行属于上一片
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                chats.append(json.loads(line))
+    return _clean_chat_shard(chats)
+
+def _iter_record_chunks(input_file, chunk_size):
+    """把导出文件按 chunk_size 条对话一片依次产出"""
+    chunk = []
+    for chat in iter_json_records(input_file):
+        chunk.append(chat)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _iter_sharded_shards(input_file, workers, shard_chats=SHARD_CHATS, shard_bytes=SHARD_BYTES):
+    """
+    在 ProcessPoolExecutor 中并行清洗各分片，按原始顺序产出 (原始对话数, 有效咨询列表)。
+    未压缩的 NDJSON 导出按字节范围分片，每个子进程自己读取和解析；
+    JSON 数组和压缩文件（无法随机访问）由主进程流式解析后按条数分片。
+    同时提交的分片数有上限，内存占用不随文件大小增长。
+    """
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if is_ndjson_path(input_file) and not is_compressed_path(input_file):
+            file_size = os.path.getsize(input_file)
+            tasks = ((_clean_ndjson_range, input_file, start, min(start + shard_bytes, file_size))
+                     for start in range(0, file_size, shard_bytes))
+        else:
+            tasks = ((_clean_chat_shard, chunk) for chunk in _iter_record_chunks(input_file, shard_chats))
+
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(*task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 class ChatDataProcessor:
     """聊天数据处理器"""
@@ -28,7 +96,157 @@ class ChatDataProcessor:
         self.test_keywords = ['test', 'testing', '测试', 'demo']
         self.invalid_names = ['', 'Anonymous', 'Guest', '匿名用户', '游客']
     
-    def clean_chat_data(self, input_file, output_file):
+    def iter_cleaned_chats(self, input_file, stats=None, workers=1):
+        """
+        流式读取原始导出文件，逐条产出有效咨询（清洗后的对话）
+        输入可以是 JSON 数组或 NDJSON（.ndjson / .jsonl），均可用 .gz / .zst 压缩，见 json_stream.py。
+        
+        stats 不为 None 时，读取完成后在其中记录 raw_chats（原始对话数）和 cleaned_chats（有效咨询数）。
+        workers 大于 1 时把对话分片交给进程池并行清洗（见 _iter_sharded_shards），产出顺序与单进程时相同。
+        文件不存在或格式错误时抛出 OSError / json.JSONDecodeError。
+        """
+        raw_chat_count = 0
+        cleaned_chat_count = 0
+
+        if workers and workers > 1:
+            for shard_raw_count, shard_cleaned_chats in _iter_sharded_shards(input_file, workers):
+                raw_chat_count += shard_raw_count
+                cleaned_chat_count += len(shard_cleaned_chats)
+                yield from shard_cleaned_chats
+        else:
+            for chat in iter_json_records(input_file):
+                raw_chat_count += 1
+                cleaned_chat = self.clean_chat(chat)
+                if cleaned_chat is not None:
+                    cleaned_chat_count += 1
+                    yield cleaned_chat
+
+        if stats is not None:
+            stats['raw_chats'] = raw_chat_count
+            stats['cleaned_chats'] = cleaned_chat_count
+
+    def clean_chat(self, chat):
+        """清洗一条原始对话，是有效咨询时返回清洗后的对话，否则返回 None"""
+        # 提取基本信息
+        chat_id = chat.get('id', '')
+        users = chat.get('users', [])
+        events = chat.get('events', [])
+        created_at = chat.get('created_at', '')
+
+        # 提取客户信息
+        customer = next((user for user in users if user.get('type') == 'customer'), None)
+        if not customer:
+            return None
+            
+        customer_id = customer.get('id', '')
+        customer_name = customer.get('name', '')
+        customer_email = customer.get('email', '')
+        customer_phone = customer.get('phone', '')
+        
+        # 从session_fields中提取邮箱和电话
+        session_fields = customer.get('session_fields', [])
+        for field in session_fields:
+            if isinstance(field, dict):
+                for key, value in field.items():
+                    if 'email' in key.lower() and value and not customer_email:
+                        customer_email = value
+                    # 更严格的电话号码字段匹配，避免产品名称被误认为电话号码
+                    elif (key.lower() in ['phone', 'phone_number', 'mobile', 'mobile_number', 'telephone'] 
+                          and value and not customer_phone):
+                        customer_phone = value
+        
+        # 从events中提取表单数据（包括prechat表单）
+        for event in events:
+            if event.get('type') == 'form':
+                # 处理标准form_data格式
+                form_data = event.get('properties', {}).get('form_data', {})
+                if 'email' in form_data and form_data['email'] and not customer_email:
+                    customer_email = form_data['email']
+                if 'phone' in form_data and form_data['phone'] and not customer_phone:
+                    customer_phone = form_data['phone']
+                
+                # 处理prechat表单格式
+                if event.get('properties', {}).get('form_type') == 'prechat':
+                    fields = event.get('properties', {}).get('fields', [])
+                    for field in fields:
+                        if isinstance(field, dict):
+                            field_name = field.get('name', '')
+                            field_answer = field.get('answer', '')
+                            
+                            # 提取Phone Number字段
+                            if field_name == 'Phone Number' and field_answer and not customer_phone:
+                                customer_phone = field_answer
+                            
+                            # 提取Email字段
+                            elif 'email' in field_name.lower() and field_answer and not customer_email:
+                                customer_email = field_answer
+        
+        # 提取用户来源信息
+        visit_info = customer.get('visit', {})
+        
+        # 提取起始URL
+        start_url = ''
+        last_pages = visit_info.get('last_pages', [])
+        if last_pages:
+            start_url = last_pages[0].get('url', '')
+        
+        # 构建来源数据
+        source_data = {
+            'referrer': visit_info.get('referrer', ''),
+            'start_url': start_url,
+            'ip': visit_info.get('ip', ''),
+            'user_agent': visit_info.get('user_agent', ''),
+            'geolocation': visit_info.get('geolocation', {}),
+            'visit_started_at': visit_info.get('started_at', ''),
+            'visit_ended_at': visit_info.get('ended_at', ''),
+            'session_fields': session_fields,
+            'last_pages': last_pages
+        }
+
+        # 提取对话内容
+        messages = []
+        for event in events:
+            event_type = event.get('type', '')
+            event_created_at = event.get('created_at', '')
+            author_id = event.get('author_id', '')
+            text = event.get('text', '')
+
+            # 格式化时间
+            formatted_time = self._format_time(event_created_at, chat_id)
+
+            # 判断消息发送者
+            sender = 'Customer' if customer_id and author_id == customer_id else 'Agent'
+
+            # 跳过系统消息、表单消息和无效消息
+            if event_type in ['system_message', 'form']:
+                continue
+            if not text or not text.strip():
+                continue
+
+            messages.append({
+                'time': formatted_time,
+                'sender': sender,
+                'content': text.strip()
+            })
+
+        # 判断是否为有效咨询（必须有邮箱或电话）
+        referrer = source_data.get('referrer', '')
+        if self._is_valid_consultation(customer_name, customer_email, customer_phone, referrer):
+            cleaned_chat = {
+                'chat_id': chat_id,
+                'customer': {
+                    'name': customer_name,
+                    'email': customer_email,
+                    'phone': customer_phone
+                },
+                'source': source_data,
+                'messages': messages,
+                'created_at': created_at
+            }
+            return cleaned_chat
+        return None
+
+    def clean_chat_data(self, input_file, output_file, workers=1, parquet_writer=None):
         """
         第一步：清洗原始聊天数据，提取有效咨询
         
@@ -36,148 +254,31 @@ class ChatDataProcessor:
         - 必须有有效的邮箱或电话号码
         - 电话号码不限制位数
         - 排除测试邮箱和测试姓名
+
+        parquet_writer 不为 None 时同时把清洗结果写入列式存储（见 columnar_store.py）。
         """
         print(f"开始清洗聊天数据: {input_file}")
         
-        # 读取输入文件
+        # 流式读取输入文件，边解析边清洗
+        stats = {}
         try:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            cleaned_chats = list(self._tee_to_parquet(self.iter_cleaned_chats(input_file, stats, workers), parquet_writer))
             print(f"成功读取文件: {input_file}")
-            initial_chat_count = len(data)
+            initial_chat_count = stats['raw_chats']
             print(f"输入文件中包含 {initial_chat_count} 条原始对话记录。")
-        except Exception as e:
+        except (OSError, ImportError, json.JSONDecodeError, UnicodeDecodeError) as e:
             print(f"读取文件失败: {e}")
+            if parquet_writer is not None:
+                parquet_writer.abort()
             return 0, 0
-
-        cleaned_chats = []
-
-        for chat in data:
-            # 提取基本信息
-            chat_id = chat.get('id', '')
-            users = chat.get('users', [])
-            events = chat.get('events', [])
-            created_at = chat.get('created_at', '')
-
-            # 提取客户信息
-            customer = next((user for user in users if user.get('type') == 'customer'), None)
-            if not customer:
-                continue
-                
-            customer_id = customer.get('id', '')
-            customer_name = customer.get('name', '')
-            customer_email = customer.get('email', '')
-            customer_phone = customer.get('phone', '')
-            
-            # 从session_fields中提取邮箱和电话
-            session_fields = customer.get('session_fields', [])
-            for field in session_fields:
-                if isinstance(field, dict):
-                    for key, value in field.items():
-                        if 'email' in key.lower() and value and not customer_email:
-                            customer_email = value
-                        # 更严格的电话号码字段匹配，避免产品名称被误认为电话号码
-                        elif (key.lower() in ['phone', 'phone_number', 'mobile', 'mobile_number', 'telephone'] 
-                              and value and not customer_phone):
-                            customer_phone = value
-            
-            # 从events中提取表单数据（包括prechat表单）
-            for event in events:
-                if event.get('type') == 'form':
-                    # 处理标准form_data格式
-                    form_data = event.get('properties', {}).get('form_data', {})
-                    if 'email' in form_data and form_data['email'] and not customer_email:
-                        customer_email = form_data['email']
-                    if 'phone' in form_data and form_data['phone'] and not customer_phone:
-                        customer_phone = form_data['phone']
-                    
-                    # 处理prechat表单格式
-                    if event.get('properties', {}).get('form_type') == 'prechat':
-                        fields = event.get('properties', {}).get('fields', [])
-                        for field in fields:
-                            if isinstance(field, dict):
-                                field_name = field.get('name', '')
-                                field_answer = field.get('answer', '')
-                                
-                                # 提取Phone Number字段
-                                if field_name == 'Phone Number' and field_answer and not customer_phone:
-                                    customer_phone = field_answer
-                                
-                                # 提取Email字段
-                                elif 'email' in field_name.lower() and field_answer and not customer_email:
-                                    customer_email = field_answer
-            
-            # 提取用户来源信息
-            visit_info = customer.get('visit', {})
-            
-            # 提取起始URL
-            start_url = ''
-            last_pages = visit_info.get('last_pages', [])
-            if last_pages:
-                start_url = last_pages[0].get('url', '')
-            
-            # 构建来源数据
-            source_data = {
-                'referrer': visit_info.get('referrer', ''),
-                'start_url': start_url,
-                'ip': visit_info.get('ip', ''),
-                'user_agent': visit_info.get('user_agent', ''),
-                'geolocation': visit_info.get('geolocation', {}),
-                'visit_started_at': visit_info.get('started_at', ''),
-                'visit_ended_at': visit_info.get('ended_at', ''),
-                'session_fields': session_fields,
-                'last_pages': last_pages
-            }
-
-            # 提取对话内容
-            messages = []
-            for event in events:
-                event_type = event.get('type', '')
-                event_created_at = event.get('created_at', '')
-                author_id = event.get('author_id', '')
-                text = event.get('text', '')
-
-                # 格式化时间
-                formatted_time = self._format_time(event_created_at, chat_id)
-
-                # 判断消息发送者
-                sender = 'Customer' if customer_id and author_id == customer_id else 'Agent'
-
-                # 跳过系统消息、表单消息和无效消息
-                if event_type in ['system_message', 'form']:
-                    continue
-                if not text or not text.strip():
-                    continue
-
-                messages.append({
-                    'time': formatted_time,
-                    'sender': sender,
-                    'content': text.strip()
-                })
-
-            # 判断是否为有效咨询（必须有邮箱或电话）
-            referrer = source_data.get('referrer', '')
-            if self._is_valid_consultation(customer_name, customer_email, customer_phone, referrer):
-                cleaned_chat = {
-                    'chat_id': chat_id,
-                    'customer': {
-                        'name': customer_name,
-                        'email': customer_email,
-                        'phone': customer_phone
-                    },
-                    'source': source_data,
-                    'messages': messages,
-                    'created_at': created_at
-                }
-                cleaned_chats.append(cleaned_chat)
+        self._close_parquet(parquet_writer)
 
         # 保存清洗后的数据
         cleaned_chat_count = len(cleaned_chats)
         print(f"清洗后保留了 {cleaned_chat_count} 条有效咨询记录。")
 
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(cleaned_chats, f, ensure_ascii=False, indent=2)
+            write_json_records(output_file, cleaned_chats)
             print(f"清洗后的数据已保存到文件: {output_file}")
             return initial_chat_count, cleaned_chat_count
         except Exception as e:
@@ -191,56 +292,18 @@ class ChatDataProcessor:
         print(f"开始转换为简化格式: {cleaned_file}")
         
         try:
-            with open(cleaned_file, 'r', encoding='utf-8') as f:
-                cleaned_data = json.load(f)
+            cleaned_data = list(iter_json_records(cleaned_file))
         except Exception as e:
             print(f"读取清洗后的数据失败: {e}")
             return 0
 
-        simplified_records = []
-
-        for chat in cleaned_data:
-            chat_id = chat.get('chat_id', '')
-            customer = chat.get('customer', {})
-            source = chat.get('source', {})
-            messages = chat.get('messages', [])
-
-            # 提取客户信息
-            email = customer.get('email', '').strip()
-            phone = customer.get('phone', '').strip()
-            name = customer.get('name', '').strip()
-            
-            # 提取来源信息
-            referrer = source.get('referrer', '')
-            start_url = source.get('start_url', '')
-            geolocation = source.get('geolocation', {})
-            
-            # 提取创建时间（使用第一条消息的时间）
-            created_at = ''
-            if messages:
-                created_at = messages[0].get('time', '')
-
-            # 构建简化记录，只保留需要的字段
-            simplified_record = {
-                'id': chat_id,
-                'name': name,
-                'email': email,
-                'phone': phone,
-                'start_url': start_url,
-                'referrer': referrer,
-                'country': geolocation.get('country', ''),
-                'created_at': created_at,
-                'messages_count': len(messages)
-            }
-            
-            simplified_records.append(simplified_record)
+        simplified_records = [self._simplify_chat(chat) for chat in cleaned_data]
 
         # 按创建时间排序（降序）
         simplified_records.sort(key=lambda x: x.get('created_at', ''), reverse=True)
 
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(simplified_records, f, ensure_ascii=False, indent=2)
+            write_json_records(output_file, simplified_records)
             print(f"简化格式数据已保存到文件: {output_file}")
             print(f"转换了 {len(simplified_records)} 条记录")
             return len(simplified_records)
@@ -248,19 +311,111 @@ class ChatDataProcessor:
             print(f"保存简化格式数据失败: {e}")
             return 0
 
+    def clean_and_simplify(self, input_file, cleaned_file, output_file, workers=1, parquet_writer=None):
+        """
+        融合模式：只遍历一次原始数据，同时完成第一步（清洗）和第二步（简化）
+
+        每条清洗后的对话只序列化一次、边清洗边写入 cleaned_file（格式由扩展名决定，见 json_stream.JsonRecordWriter），
+        简化记录在同一次遍历中生成，不再重新读取并解析 cleaned_file。
+        parquet_writer 不为 None 时同一次遍历中也写入列式存储（见 columnar_store.py）。
+        返回 (原始对话数, 有效咨询数, 输出记录数)。
+        """
+        print(f"开始清洗聊天数据并转换为简化格式: {input_file}")
+
+        # JsonRecordWriter 先写入临时文件，读取中途失败时不留下不完整的清洗结果
+        stats = {}
+        simplified_records = []
+        try:
+            with JsonRecordWriter(cleaned_file) as writer:
+                for chat in self._tee_to_parquet(self.iter_cleaned_chats(input_file, stats, workers), parquet_writer):
+                    writer.write(chat)
+                    simplified_records.append(self._simplify_chat(chat))
+        except (OSError, ImportError, json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"读取文件失败: {e}")
+            if parquet_writer is not None:
+                parquet_writer.abort()
+            return 0, 0, 0
+        self._close_parquet(parquet_writer)
+
+        initial_chat_count = stats['raw_chats']
+        cleaned_chat_count = len(simplified_records)
+        print(f"成功读取文件: {input_file}")
+        print(f"输入文件中包含 {initial_chat_count} 条原始对话记录。")
+        print(f"清洗后保留了 {cleaned_chat_count} 条有效咨询记录。")
+        print(f"清洗后的数据已保存到文件: {cleaned_file}")
+        if cleaned_chat_count == 0:
+            return initial_chat_count, 0, 0
+
+        # 按创建时间排序（降序）
+        simplified_records.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+
+        try:
+            write_json_records(output_file, simplified_records)
+            print(f"简化格式数据已保存到文件: {output_file}")
+            print(f"转换了 {len(simplified_records)} 条记录")
+            return initial_chat_count, cleaned_chat_count, len(simplified_records)
+        except Exception as e:
+            print(f"保存简化格式数据失败: {e}")
+            return initial_chat_count, cleaned_chat_count, 0
+
+    def _tee_to_parquet(self, cleaned_chats, parquet_writer):
+        """把流经的每条清洗结果同时交给 parquet_writer"""
+        for chat in cleaned_chats:
+            if parquet_writer is not None:
+                parquet_writer.add(chat)
+            yield chat
+
+    def _close_parquet(self, parquet_writer):
+        """完成列式存储的写入；失败只打印提示，不影响 JSON 输出"""
+        if parquet_writer is None:
+            return
+        try:
+            parquet_writer.close()
+            print(f"列式存储已保存到文件: {parquet_writer.chats_path}, {parquet_writer.messages_path}"
+                  f"（{parquet_writer.chat_count} 条对话，{parquet_writer.message_count} 条消息）")
+        except Exception as e:
+            print(f"写入 Parquet 文件失败: {e}")
+            parquet_writer.abort()
+
+    def _simplify_chat(self, chat):
+        """把一条清洗后的对话转换为简化记录，只保留需要的字段"""
+        chat_id = chat.get('chat_id', '')
+        customer = chat.get('customer', {})
+        source = chat.get('source', {})
+        messages = chat.get('messages', [])
+
+        # 提取客户信息
+        email = customer.get('email', '').strip()
+        phone = customer.get('phone', '').strip()
+        name = customer.get('name', '').strip()
+
+        # 提取来源信息
+        referrer = source.get('referrer', '')
+        start_url = source.get('start_url', '')
+        geolocation = source.get('geolocation', {})
+
+        # 提取创建时间（使用第一条消息的时间）
+        created_at = ''
+        if messages:
+            created_at = messages[0].get('time', '')
+
+        # 构建简化记录，只保留需要的字段
+        return {
+            'id': chat_id,
+            'name': name,
+            'email': email,
+            'phone': phone,
+            'start_url': start_url,
+            'referrer': referrer,
+            'country': geolocation.get('country', ''),
+            'created_at': created_at,
+            'messages_count': len(messages)
+        }
+
     def _format_time(self, created_at, chat_id):
-        """格式化时间"""
+        """格式化时间（LiveChat 固定格式走快速路径并缓存，见 time_utils.py）"""
         try:
-            if created_at:
-                dt_original = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                if dt_original.tzinfo is None:
-                    dt_utc = dt_original.replace(tzinfo=timezone.utc)
-                else:
-                    dt_utc = dt_original
-                dt_hkt = dt_utc.astimezone(HKT)
-                return dt_hkt.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                return ''
+            return format_hkt_time(created_at)
         except Exception as e:
             print(f"WARNING: Could not parse time '{created_at}' for chat ID {chat_id}: {e}", file=sys.stderr)
             return created_at
@@ -377,30 +532,65 @@ class ChatDataProcessor:
         else:
             return 'website_' + domain.replace('www.', '') if domain else 'direct'
 
-    def process_pipeline(self, input_file, month_name):
-        """完整的数据处理管道"""
+    def process_pipeline(self, input_file, month_name, fused=True, workers=1, parquet=False, output_suffix='.json'):
+        """
+        完整的数据处理管道
+
+        fused 为 True 时只遍历一次原始数据（见 clean_and_simplify），输出文件与分两步处理时完全相同；
+        为 False 时按原来的方式先写出清洗结果，再读回转换为简化格式。
+        workers 大于 1 时用多个进程分片清洗这一个文件。
+        parquet 为 True 时额外把清洗结果写成列式存储 cleaned_chats_<month>.chats.parquet / .messages.parquet（需要 pyarrow）。
+        output_suffix 决定输出文件的格式：'.json' 为 indent=2 的 JSON 数组，'.ndjson' / '.jsonl' 每行一条记录，可再加 '.gz' / '.zst' 压缩。
+        返回本次处理的统计信息 dict（供 main 汇总），清洗失败时 status 为 'failed'。
+        """
         # 生成文件名
-        cleaned_file = f"cleaned_chats_{month_name}.json"
-        output_file = f"filtered_conversations_{month_name}.json"
+        cleaned_file = f"cleaned_chats_{month_name}{output_suffix}"
+        output_file = f"filtered_conversations_{month_name}{output_suffix}"
+        result = {
+            'input': input_file,
+            'month': month_name,
+            'status': 'failed',
+            'original_count': 0,
+            'cleaned_count': 0,
+            'output_count': 0,
+            'output_file': output_file
+        }
         
         print("=" * 80)
         print(f"开始处理 {month_name} 的数据处理管道")
         print("=" * 80)
+
+        parquet_writer = None
+        if parquet:
+            if pa is None:
+                print("未安装 pyarrow，跳过 Parquet 输出（pip install pyarrow）")
+            else:
+                parquet_writer = CleanedChatParquetWriter(*parquet_paths(f"cleaned_chats_{month_name}"))
         
-        # 第一步：清洗数据
-        print("\n步骤1: 清洗原始聊天数据")
-        print("-" * 50)
-        original_count, cleaned_count = self.clean_chat_data(input_file, cleaned_file)
-        
-        if cleaned_count == 0:
-            print(f"清洗步骤失败，跳过后续处理")
-            return
-        
-        # 第二步：转换为简化格式
-        print("\n步骤2: 转换为简化JSON格式")
-        print("-" * 50)
-        output_count = self.convert_to_simplified_format(cleaned_file, output_file)
-        
+        if fused:
+            print("\n步骤1+2: 清洗原始聊天数据并转换为简化JSON格式（单次遍历）")
+            print("-" * 50)
+            original_count, cleaned_count, output_count = self.clean_and_simplify(input_file, cleaned_file, output_file, workers, parquet_writer)
+            if cleaned_count == 0:
+                print(f"清洗步骤失败，跳过后续处理")
+                result['original_count'] = original_count
+                return result
+        else:
+            # 第一步：清洗数据
+            print("\n步骤1: 清洗原始聊天数据")
+            print("-" * 50)
+            original_count, cleaned_count = self.clean_chat_data(input_file, cleaned_file, workers, parquet_writer)
+
+            if cleaned_count == 0:
+                print(f"清洗步骤失败，跳过后续处理")
+                result['original_count'] = original_count
+                return result
+
+            # 第二步：转换为简化格式
+            print("\n步骤2: 转换为简化JSON格式")
+            print("-" * 50)
+            output_count = self.convert_to_simplified_format(cleaned_file, output_file)
+
         # 总结
         print("\n" + "=" * 80)
         print(f"{month_name} 数据处理完成")
@@ -413,27 +603,151 @@ class ChatDataProcessor:
         print(f"输出文件: {output_file}")
         print("=" * 80)
 
-def main():
-    """主函数"""
-    processor = ChatDataProcessor()
-    
+        result.update(status='ok', original_count=original_count, cleaned_count=cleaned_count, output_count=output_count)
+        return result
+
+# 默认处理的文件（不带命令行参数运行时使用）
+DEFAULT_FILES_TO_PROCESS = [
+    {
+        'input': 'chats_8月1-5.json',
+        'month': 'august_1_5'
+    },
+    {
+        'input': 'chats_9月1-5.json',
+        'month': 'september_1_5'
+    }
+]
+
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june',
+               'july', 'august', 'september', 'october', 'november', 'december']
+
+# 目录参数中会处理的导出文件
+INPUT_FILE_PATTERNS = ['*.json', '*.ndjson', '*.jsonl', '*.json.gz', '*.ndjson.gz', '*.jsonl.gz',
+                       '*.json.zst', '*.ndjson.zst', '*.jsonl.zst']
+
+def month_name_for_file(input_file):
+    """
+    根据导出文件名生成输出文件名中的月份标识：
+    chats_8月1-5.json -> august_1_5，其他文件名去掉 chats_ 前缀和扩展名（含压缩扩展名）后原样使用
+    """
+    stem = os.path.basename(input_file)
+    if is_compressed_path(stem):
+        stem = os.path.splitext(stem)[0]
+    stem = os.path.splitext(stem)[0]
+    match = re.fullmatch(r'chats_(\d{1,2})月(\d+)-(\d+)', stem)
+    if match and 1 <= int(match.group(1)) <= 12:
+        return f"{MONTH_NAMES[int(match.group(1)) - 1]}_{match.group(2)}_{match.group(3)}"
+    return stem[len('chats_'):] if stem.startswith('chats_') and len(stem) > len('chats_') else stem
+
+def collect_input_files(patterns):
+    """把命令行中的文件、目录（取其中的 JSON / NDJSON 导出，见 INPUT_FILE_PATTERNS）和 glob 模式展开为去重后的文件列表，保持参数顺序"""
+    input_files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(path for file_pattern in INPUT_FILE_PATTERNS for path in glob.glob(os.path.join(pattern, file_pattern)))
+        else:
+            matches = sorted(glob.glob(pattern)) or [pattern]
+        for path in matches:
+            if path not in input_files:
+                input_files.append(path)
+    return input_files
+
+def _run_pipeline_job(input_file, month_name, shard_workers=1, parquet=False, output_suffix='.json'):
+    """进程池中执行的任务：处理一个导出文件，异常也转换为统计信息返回，不影响其他文件"""
+    try:
+        return ChatDataProcessor().process_pipeline(input_file, month_name, workers=shard_workers, parquet=parquet,
+                                                        output_suffix=output_suffix)
+    except Exception as e:
+        print(f"处理 {input_file} 失败: {e}")
+        return {'input': input_file, 'month': month_name, 'status': 'failed', 'original_count': 0,
+                'cleaned_count': 0, 'output_count': 0, 'output_file': f"filtered_conversations_{month_name}{output_suffix}"}
+
+def print_summary_table(results):
+    """打印所有文件的汇总表"""
+    print("\n" + "=" * 80)
+    print("全部文件处理汇总")
+    print("=" * 80)
+    print(f"{'输入文件':<28}{'状态':<8}{'原始对话':>10}{'有效咨询':>10}{'输出记录':>10}{'有效率':>9}")
+    print("-" * 80)
+    for result in results:
+        rate = f"{result['cleaned_count']/result['original_count']*100:.1f}%" if result['original_count'] > 0 else '-'
+        print(f"{os.path.basename(result['input']):<28}{result['status']:<8}{result['original_count']:>10}"
+              f"{result['cleaned_count']:>10}{result['output_count']:>10}{rate:>9}")
+    print("-" * 80)
+    total_original = sum(r['original_count'] for r in results)
+    total_cleaned = sum(r['cleaned_count'] for r in results)
+    total_output = sum(r['output_count'] for r in results)
+    total_rate = f"{total_cleaned/total_original*100:.1f}%" if total_original > 0 else '-'
+    print(f"{'合计':<28}{'':<8}{total_original:>10}{total_cleaned:>10}{total_output:>10}{total_rate:>9}")
+    print("=" * 80)
+
+def main(argv=None):
+    """
+    主函数
+
+    用法: python data_conversion_pipeline.py [文件 | 目录 | glob 模式 ...] [--workers=N] [--shard-workers=N] [--parquet] [--output-suffix=.ndjson.gz]
+    不带参数时处理 DEFAULT_FILES_TO_PROCESS；多个文件在进程池中并行处理（默认进程数为 CPU 核数）。
+    --shard-workers=N 让每个文件内部再分片用 N 个进程清洗，适合单个超大导出（默认 1，不分片）。
+    --parquet 额外输出清洗结果的列式存储（Parquet，需要 pyarrow）。
+    --output-suffix 指定输出文件的扩展名（默认 .json；.ndjson / .jsonl 每行一条记录，可加 .gz / .zst 压缩）。
+    """
+    args = sys.argv[1:] if argv is None else argv
+    patterns = [arg for arg in args if not arg.startswith('--')]
+    max_workers = os.cpu_count() or 1
+    shard_workers = 1
+    parquet = False
+    output_suffix = '.json'
+    for option in (arg for arg in args if arg.startswith('--')):
+        if option.startswith('--workers='):
+            try:
+                max_workers = max(1, int(option.split('=', 1)[1]))
+            except ValueError:
+                print(f"无效的进程数: {option}，使用默认值 {max_workers}")
+        elif option.startswith('--shard-workers='):
+            try:
+                shard_workers = max(1, int(option.split('=', 1)[1]))
+            except ValueError:
+                print(f"无效的分片进程数: {option}，不分片")
+        elif option == '--parquet':
+            parquet = True
+        elif option.startswith('--output-suffix='):
+            output_suffix = option.split('=', 1)[1]
+        else:
+            print(f"忽略未知参数: {option}")
+
     # 配置要处理的文件
-    files_to_process = [
-        {
-            'input': 'chats_8月1-5.json',
-            'month': 'august_1_5'
-        },
-        {
-            'input': 'chats_9月1-5.json',
-            'month': 'september_1_5'
-        }
-    ]
-    
+    if patterns:
+        files_to_process = [{'input': path, 'month': month_name_for_file(path)} for path in collect_input_files(patterns)]
+    else:
+        files_to_process = DEFAULT_FILES_TO_PROCESS
+
+    jobs = []
+    months_seen = {}
     for file_info in files_to_process:
-        if os.path.exists(file_info['input']):
-            processor.process_pipeline(file_info['input'], file_info['month'])
-        else:
+        if not os.path.exists(file_info['input']):
             print(f"文件不存在: {file_info['input']}")
+        elif file_info['month'] in months_seen:
+            # 两个输入会写到同一个输出文件，并行时结果不确定
+            print(f"跳过 {file_info['input']}：输出文件名与 {months_seen[file_info['month']]} 相同 ({file_info['month']})")
+        else:
+            months_seen[file_info['month']] = file_info['input']
+            jobs.append(file_info)
+
+    if not jobs:
+        return
+
+    max_workers = min(max_workers, len(jobs))
+    if max_workers == 1:
+        results = [_run_pipeline_job(job['input'], job['month'], shard_workers, parquet, output_suffix) for job in jobs]
+    else:
+        print(f"使用 {max_workers} 个进程并行处理 {len(jobs)} 个文件")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_run_pipeline_job, job['input'], job['month'], shard_workers, parquet, output_suffix)
+                       for job in jobs]
+            # 按输入顺序汇总，汇总表与串行处理时一致
+            results = [future.result() for future in futures]
+
+    print_summary_table(results)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,156 @@
+# instrumentation.py
+# 运行耗时和资源使用的机器可读指标：每个阶段结束时输出一行 PYTHON_METRIC:{json}，
+# Node.js 通过 SSE 转发给前端，用来查看一次慢的运行究竟把时间花在了哪里。
+#   with stage('report_write') as s: ...; s.count('rows', n)   一个阶段：墙钟时间、CPU 时间、峰值内存和计数
+#   LatencyRecorder('api_call')                                多次调用的耗时分布（次数、平均、p50 / p95 / 最大值）
+#   IterationTimer(iterable)                                   累计在迭代器 next() 中花费的时间（与分析交错进行的流式清洗）
+# 设置 ANALYSIS_METRICS=0 不输出指标。
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，峰值内存记为 null
+    resource = None
+
+METRICS_ENABLED = os.environ.get('ANALYSIS_METRICS', '1') != '0'
+METRIC_PREFIX = 'PYTHON_METRIC:'
+
+
+def peak_rss_mb():
+    """进程启动以来的峰值常驻内存 (MB)，无法获取时返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 的单位是 KB，macOS 是字节
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+def emit_metric(kind, name, **fields):
+    """输出一行指标：{"kind": 类型, "name": 名称, ...}"""
+    if not METRICS_ENABLED:
+        return
+    record = {'kind': kind, 'name': name}
+    record.update(fields)
+    print(f"{METRIC_PREFIX}{json.dumps(record, ensure_ascii=False, default=str)}", flush=True)
+
+
+class stage:
+    """
+    记录一个阶段的墙钟时间、整个进程的 CPU 时间（包括其他线程）和阶段结束时的峰值内存，退出时输出一行指标。
+    count() 累加计数，随指标一起输出；阶段中抛出异常时同样输出，并带上 error 字段。
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.counts = {}
+
+    def count(self, key, amount=1):
+        self.counts[key] = self.counts.get(key, 0) + amount
+
+    def __enter__(self):
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fields = dict(self.fields)
+        fields['wall_s'] = round(time.perf_counter() - self._wall_start, 4)
+        fields['cpu_s'] = round(time.process_time() - self._cpu_start, 4)
+        fields['peak_rss_mb'] = peak_rss_mb()
+        if self.counts:
+            fields['counts'] = self.counts
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__
+        emit_metric('stage', self.name, **fields)
+        return False
+
+
+class LatencyRecorder:
+    """
+    收集多次调用的耗时（如每次 API 请求、每条对话的指标计算），emit() 时输出一行汇总并清空。
+    可以在多个线程中同时记录。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._samples = []
+            self._errors = 0
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self._samples.append(seconds)
+            if error:
+                self._errors += 1
+
+    @contextmanager
+    def measure(self):
+        """记录 with 块的耗时；块中抛出异常时计为一次错误，异常继续向上抛出"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(time.perf_counter() - start, error=True)
+            raise
+        self.record(time.perf_counter() - start)
+
+    def emit(self, **fields):
+        """输出次数、错误次数、总计、平均、p50、p95 和最大耗时（秒）；没有记录时不输出"""
+        with self._lock:
+            samples = sorted(self._samples)
+            errors = self._errors
+        self.reset()
+        if not samples:
+            return
+
+        def percentile(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 4)
+
+        total = sum(samples)
+        emit_metric('latency', self.name, count=len(samples), errors=errors, total_s=round(total, 4),
+                    mean_s=round(total / len(samples), 4), p50_s=percentile(0.5), p95_s=percentile(0.95),
+                    max_s=round(samples[-1], 4), **fields)
+
+
+class IterationTimer:
+    """
+    包装迭代器，累计调用方在 next() 中花费的墙钟时间和所在线程的 CPU 时间，以及产出的条数。
+    适合清洗这类与分析交错进行、无法用一个 with 块包住的流式阶段。
+    """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.items = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            item = next(self._iterator)
+        finally:
+            self.wall_s += time.perf_counter() - wall_start
+            self.cpu_s += time.thread_time() - cpu_start
+        self.items += 1
+        return item
+
+    def emit(self, name, **fields):
+        """以 stage 指标的格式输出累计的耗时"""
+        emit_metric('stage', name, wall_s=round(self.wall_s, 4), cpu_s=round(self.cpu_s, 4),
+                    peak_rss_mb=peak_rss_mb(), items=self.items, **fields)
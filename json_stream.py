@@ -0,0 +1,231 @@
+# json_stream.py
+# 流式读取顶层为数组的大 JSON 文件（LiveChat 导出），逐个产出数组元素，
+# 不需要先把整个文件读进内存再 json.load，内存占用与单条对话的大小相当。
+# 安装了 ijson 时使用 ijson，否则使用基于 json.JSONDecoder.raw_decode 的增量解析。
+#
+# 除 JSON 数组外也支持 NDJSON（每行一个 JSON 对象，扩展名 .ndjson / .jsonl），
+# 两种格式都可以再用 gzip (.gz) 或 zstd (.zst / .zstd) 压缩，格式由文件扩展名决定：
+#   iter_json_records(path)         逐条读取
+#   JsonRecordWriter(path)          逐条写入（JSON 数组的输出与 json.dump(..., indent=2) 逐字节相同）
+
+import gzip
+import io
+import json
+import os
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+GZIP_EXTENSIONS = ('.gz',)
+ZSTD_EXTENSIONS = ('.zst', '.zstd')
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+def _split_compression(path):
+    """返回 (去掉压缩扩展名后的路径, 压缩方式 None / 'gzip' / 'zstd')"""
+    root, ext = os.path.splitext(str(path))
+    if ext.lower() in GZIP_EXTENSIONS:
+        return root, 'gzip'
+    if ext.lower() in ZSTD_EXTENSIONS:
+        return root, 'zstd'
+    return str(path), None
+
+def strip_data_extensions(path):
+    """去掉压缩扩展名和数据格式扩展名：'a/report.ndjson.gz' -> 'a/report'"""
+    return os.path.splitext(_split_compression(path)[0])[0]
+
+def is_ndjson_path(path):
+    """按扩展名判断是否为 NDJSON（忽略 .gz / .zst 压缩扩展名）"""
+    return _split_compression(path)[0].lower().endswith(NDJSON_EXTENSIONS)
+
+def is_compressed_path(path):
+    return _split_compression(path)[1] is not None
+
+def open_binary(path, mode='rb'):
+    """按扩展名打开可能压缩过的文件（二进制模式，mode 为 'rb' 或 'wb'）"""
+    compression = _split_compression(path)[1]
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is required for .zst files (pip install zstandard).")
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+def open_text(path, mode='r'):
+    """按扩展名打开可能压缩过的 UTF-8 文本文件（mode 为 'r' 或 'w'）"""
+    if _split_compression(path)[1] is None:
+        return open(path, mode, encoding='utf-8')
+    return io.TextIOWrapper(open_binary(path, mode + 'b'), encoding='utf-8')
+
+def _iter_with_ijson(path):
+    with open_binary(path) as f:
+        try:
+            # use_float=True 让小数与 json.load 一样解析为 float，而不是 Decimal
+            yield from ijson.items(f, 'item', use_float=True)
+        except ijson.JSONError as e:
+            raise json.JSONDecodeError(f"Invalid JSON array: {e}", '', 0) from e
+
+def _iter_with_raw_decode(path, chunk_size):
+    decoder = json.JSONDecoder()
+    with open_text(path) as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def read_more(size):
+            nonlocal buffer, pos, eof
+            chunk = f.read(size)
+            if not chunk:
+                eof = True
+                return False
+            # 丢掉已经解析过的部分，避免缓冲区无限增长
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            return True
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buffer) or not read_more(chunk_size):
+                    return
+
+        def check_end_of_document():
+            # 与 json.load 一致：数组结束后只允许空白
+            nonlocal pos
+            pos += 1
+            skip_whitespace()
+            if pos < len(buffer):
+                raise json.JSONDecodeError("Extra data", buffer, pos)
+
+        skip_whitespace()
+        if pos == len(buffer) or buffer[pos] != '[':
+            raise json.JSONDecodeError("Expecting '[' at start of JSON array", buffer, pos)
+        pos += 1
+
+        skip_whitespace()
+        if pos < len(buffer) and buffer[pos] == ']':
+            check_end_of_document()
+            return
+
+        while True:
+            skip_whitespace()
+            # 当前元素可能跨越多个块：解析失败时成倍读取更多数据再试，总体仍是线性时间
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # 只有数字可能在块边界被截断（如 "1.5e10" 只读到 "1."），需要读到数字之后的字符再确认
+                    is_number = isinstance(item, (int, float)) and not isinstance(item, bool)
+                    if not is_number or (end < len(buffer) and buffer[end] not in _NUMBER_CHARS) \
+                            or eof or not read_more(chunk_size):
+                        break
+                except json.JSONDecodeError:
+                    if eof or not read_more(max(chunk_size, len(buffer) - pos)):
+                        raise
+            pos = end
+            yield item
+
+            skip_whitespace()
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Unterminated JSON array", buffer, pos)
+            if buffer[pos] == ']':
+                check_end_of_document()
+                return
+            if buffer[pos] != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+            pos += 1
+
+def iter_json_array(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    逐个产出 path 中顶层 JSON 数组的元素。
+    文件不是合法的 JSON 数组时抛出 json.JSONDecodeError（可能在已经产出部分元素之后）。
+    """
+    if ijson is not None:
+        return _iter_with_ijson(path)
+    return _iter_with_raw_decode(path, chunk_size)
+
+def iter_ndjson(path):
+    """逐行产出 NDJSON 文件中的 JSON 值，跳过空行；某行格式错误时抛出 json.JSONDecodeError（错误信息包含行号）"""
+    with open_text(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise json.JSONDecodeError(f"Invalid JSON on line {line_number}: {e.msg}", e.doc, e.pos) from e
+
+def iter_json_records(path):
+    """按扩展名逐条读取 JSON 数组或 NDJSON 文件（支持 .gz / .zst 压缩）"""
+    if is_ndjson_path(path):
+        return iter_ndjson(path)
+    return iter_json_array(path)
+
+
+class JsonRecordWriter:
+    """
+    逐条写出记录，格式由 path 的扩展名决定：NDJSON 每行一条；其他扩展名写成 indent=2 的 JSON 数组，
+    与 json.dump(全部记录, f, ensure_ascii=False, indent=2) 逐字节相同。
+    先写入同目录下的临时文件，close() 时才替换为 path；abort() 丢弃已写入的内容。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.count = 0
+        self._ndjson = is_ndjson_path(path)
+        directory, name = os.path.split(self.path)
+        # 临时文件保留原扩展名，压缩方式与目标文件相同
+        self._temp_path = os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+        self._file = open_text(self._temp_path, 'w')
+
+    def write(self, record):
+        if self._ndjson:
+            self._file.write(json.dumps(record, ensure_ascii=False))
+            self._file.write('\n')
+        else:
+            # 字符串中的换行会被转义，所以给每个换行后补两个空格就能得到数组元素的缩进
+            self._file.write('[\n  ' if self.count == 0 else ',\n  ')
+            self._file.write(json.dumps(record, ensure_ascii=False, indent=2).replace('\n', '\n  '))
+        self.count += 1
+
+    def close(self):
+        if not self._ndjson:
+            self._file.write('[]' if self.count == 0 else '\n]')
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def abort(self):
+        try:
+            self._file.close()
+        finally:
+            if os.path.exists(self._temp_path):
+                os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+def write_json_records(path, records):
+    """把 records 全部写入 path（格式见 JsonRecordWriter），返回写入的条数"""
+    with JsonRecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
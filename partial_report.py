@@ -0,0 +1,112 @@
+# partial_report.py
+# 分析过程中的部分结果报告。最终的 Excel 要等所有对话分析完才写出，长时间运行时前端在此之前没有任何可下载的内容；
+# 开启后每条结果一产生就追加到 <输出文件名>.partial.csv，并定期把已完成的结果写成 <输出文件名>.partial.xlsx 快照，
+# 每次更新后输出一行 PYTHON_PARTIAL_REPORT:{json}，Node.js 据此向前端提供“下载部分结果”的链接。
+# 分析正常结束、最终报告写出后部分结果文件会被删除；中途失败时保留，仍可下载已完成的部分。
+
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from json_stream import strip_data_extensions
+
+# 两次 xlsx 快照之间的最短间隔（秒），0 表示只写 CSV、不生成快照
+DEFAULT_SNAPSHOT_SECONDS = float(os.environ.get('ANALYSIS_PARTIAL_SNAPSHOT_SECONDS', '60'))
+
+
+def partial_report_paths(output_file):
+    """返回 (CSV 路径, xlsx 快照路径)，与最终报告放在同一目录；x.ndjson.gz 这类复合扩展名整体去掉"""
+    root = strip_data_extensions(output_file)
+    return f"{root}.partial.csv", f"{root}.partial.xlsx"
+
+
+class PartialReportWriter:
+    """
+    逐条接收结果行：立即追加到 CSV（按完成顺序，utf-8-sig 编码以便 Excel 直接打开），
+    并每隔 snapshot_seconds 调用 write_snapshot(按输入顺序排列的结果行, 路径) 生成 xlsx 快照。
+    快照在后台线程中写出，add() 不会因为重写整个 xlsx 而阻塞调用方（分析流水线的事件循环）；上一次快照还没写完时跳过这一次。
+    快照先写入同目录的临时文件再替换，下载时不会拿到写了一半的文件。
+    """
+
+    def __init__(self, output_file, columns, write_snapshot, snapshot_seconds=None):
+        self.csv_path, self.snapshot_path = partial_report_paths(output_file)
+        self.columns = columns
+        self.write_snapshot = write_snapshot
+        self.snapshot_seconds = DEFAULT_SNAPSHOT_SECONDS if snapshot_seconds is None else snapshot_seconds
+        self.rows_by_index = {}
+        self._snapshot_rows = 0
+        self._last_snapshot = None
+        self._pending_snapshot = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='partial-report') if self.snapshot_seconds > 0 else None
+        os.makedirs(os.path.dirname(os.path.abspath(self.csv_path)), exist_ok=True)
+        self._file = open(self.csv_path, 'w', encoding='utf-8-sig', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction='ignore')
+        self._writer.writeheader()
+        self._file.flush()
+
+    def add(self, index, chat_analysis):
+        """追加一条结果；第一条结果和距上次快照超过间隔时更新 xlsx 快照"""
+        self._writer.writerow(chat_analysis)
+        self._file.flush()
+        self.rows_by_index[index] = chat_analysis
+        if self._last_snapshot is None:
+            # 第一条结果到达时就通知前端，CSV 从此刻起可以下载
+            self._announce(None)
+            self._snapshot()
+        elif time.monotonic() - self._last_snapshot >= self.snapshot_seconds:
+            self._snapshot()
+
+    def _snapshot(self):
+        self._last_snapshot = time.monotonic()
+        if self._executor is None or (self._pending_snapshot is not None and not self._pending_snapshot.done()):
+            return
+        # 只在这里复制 (序号, 结果行)，排序和写文件都在后台线程中进行
+        self._pending_snapshot = self._executor.submit(self._write_snapshot_file, list(self.rows_by_index.items()))
+
+    def _write_snapshot_file(self, indexed_rows):
+        rows = [row for _, row in sorted(indexed_rows, key=lambda item: item[0])]
+        snapshot_path = None
+        directory, name = os.path.split(os.path.abspath(self.snapshot_path))
+        tmp_path = os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+        try:
+            self.write_snapshot(rows, tmp_path)
+            os.replace(tmp_path, self.snapshot_path)
+            snapshot_path = self.snapshot_path
+            self._snapshot_rows = len(rows)
+        except Exception as e:
+            # 快照只是辅助功能，失败时不影响分析本身
+            print(f"PYTHON_WARNING: Could not write partial report snapshot {self.snapshot_path}: {e}", file=sys.stderr)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._announce(snapshot_path)
+
+    def _announce(self, snapshot_path):
+        info = {
+            'rows': len(self.rows_by_index),
+            'csv': self.csv_path,
+            'xlsx': snapshot_path,
+            'xlsx_rows': self._snapshot_rows if snapshot_path else 0,
+        }
+        print(f"PYTHON_PARTIAL_REPORT:{json.dumps(info, ensure_ascii=False)}")
+
+    def close(self, keep_files=True):
+        """关闭 CSV；keep_files=False（最终报告已写出）时删除部分结果文件"""
+        if not self._file.closed:
+            self._file.close()
+        if self._executor is not None:
+            # 等正在写的快照完成后再补写或删除
+            self._executor.shutdown(wait=True)
+        if keep_files:
+            # 中途失败时保留部分结果，快照补齐到最后一条已完成的结果
+            if self._executor is not None and len(self.rows_by_index) > self._snapshot_rows:
+                self._write_snapshot_file(list(self.rows_by_index.items()))
+            return
+        for path in (self.csv_path, self.snapshot_path):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"PYTHON_WARNING: Could not remove partial report {path}: {e}", file=sys.stderr)
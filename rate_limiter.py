@@ -0,0 +1,129 @@
+# rate_limiter.py
+# 自适应令牌桶限流器：同时限制每分钟请求数 (RPM) 和每分钟 token 数 (TPM)。
+# 遇到 429 / RESOURCE_EXHAUSTED 时成倍降速，之后每次成功调用逐步提速，直到配置的上限。
+
+import asyncio
+import os
+import threading
+import time
+
+
+def is_rate_limit_error(e):
+    """判断异常是否为 API 限流 (HTTP 429 / RESOURCE_EXHAUSTED)"""
+    if getattr(e, 'code', None) == 429 or getattr(e, 'status', None) == 'RESOURCE_EXHAUSTED':
+        return True
+    return 'RESOURCE_EXHAUSTED' in str(e)
+
+
+class AdaptiveRateLimiter:
+    """RPM/TPM 双令牌桶限流器，可在线程和 asyncio 中共享使用"""
+
+    def __init__(self, requests_per_minute=10, tokens_per_minute=250000,
+                 max_requests_per_minute=60, min_requests_per_minute=1,
+                 increase_per_success=0.5, decrease_factor=0.5, cooldown_seconds=5.0):
+        self.max_rpm = max(float(max_requests_per_minute), float(requests_per_minute))
+        self.min_rpm = max(0.1, float(min_requests_per_minute))
+        self.current_rpm = min(max(float(requests_per_minute), self.min_rpm), self.max_rpm)
+        self.tpm = float(tokens_per_minute)
+        self.increase_per_success = increase_per_success
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+
+        self._lock = threading.Lock()
+        self._last_refill = time.monotonic()
+        self._request_allowance = 1.0
+        self._token_allowance = self.tpm
+        self._blocked_until = 0.0
+
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.throttle_count = 0
+
+    @classmethod
+    def from_env(cls):
+        """从环境变量 GEMINI_RPM / GEMINI_MAX_RPM / GEMINI_TPM 创建限流器"""
+        return cls(
+            requests_per_minute=float(os.environ.get('GEMINI_RPM', '10')),
+            tokens_per_minute=float(os.environ.get('GEMINI_TPM', '250000')),
+            max_requests_per_minute=float(os.environ.get('GEMINI_MAX_RPM', '60')),
+        )
+
+    def _request_capacity(self):
+        # 允许约 6 秒的突发量，至少 1 个请求
+        return max(1.0, self.current_rpm / 10.0)
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(self._request_capacity(), self._request_allowance + elapsed * self.current_rpm / 60.0)
+        self._token_allowance = min(self.tpm, self._token_allowance + elapsed * self.tpm / 60.0)
+
+    def _try_reserve(self, tokens):
+        """尝试占用一个请求和 tokens 个 token，成功返回 0，否则返回建议等待秒数"""
+        tokens = min(float(tokens or 0), self.tpm)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                return self._blocked_until - now
+
+            request_wait = 0.0
+            if self._request_allowance < 1.0:
+                request_wait = (1.0 - self._request_allowance) * 60.0 / self.current_rpm
+            token_wait = 0.0
+            if self._token_allowance < tokens:
+                token_wait = (tokens - self._token_allowance) * 60.0 / self.tpm
+
+            wait = max(request_wait, token_wait)
+            if wait > 0:
+                return wait
+
+            self._request_allowance -= 1.0
+            self._token_allowance -= tokens
+            self.total_requests += 1
+            self.total_tokens += int(tokens)
+            return 0.0
+
+    def acquire(self, tokens=0):
+        """阻塞直到允许发出一次请求（同步调用使用）"""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        """等待直到允许发出一次请求（asyncio 中使用）"""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_success(self, estimated_tokens=0, actual_tokens=None):
+        """调用成功：按实际 token 用量修正 TPM 额度，并逐步提高请求速率"""
+        with self._lock:
+            if actual_tokens is not None:
+                correction = float(actual_tokens) - float(estimated_tokens or 0)
+                self._token_allowance -= correction
+                self.total_tokens += int(correction)
+            self.current_rpm = min(self.max_rpm, self.current_rpm + self.increase_per_success)
+
+    def record_rate_limited(self):
+        """收到 429：速率减半，清空突发额度，并短暂暂停所有请求"""
+        with self._lock:
+            self.throttle_count += 1
+            now = time.monotonic()
+            if now < self._blocked_until:
+                # 同一波突发中并发请求的多个 429 只降速一次
+                return
+            self.current_rpm = max(self.min_rpm, self.current_rpm * self.decrease_factor)
+            self._request_allowance = min(self._request_allowance, 0.0)
+            self._blocked_until = now + self.cooldown_seconds
+
+    def status_line(self):
+        """当前限流状态，供 PYTHON_STATUS 输出"""
+        with self._lock:
+            return (f"Rate limiter: {self.current_rpm:.1f} RPM (max {self.max_rpm:.0f}), "
+                    f"TPM limit {self.tpm:.0f}, requests sent {self.total_requests}, "
+                    f"tokens used ~{self.total_tokens}, throttled {self.throttle_count} times")
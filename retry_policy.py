@@ -0,0 +1,95 @@
+# retry_policy.py
+# API 调用失败时的重试策略：先把异常分为 限流 / 临时故障 / 不可重试 三类，
+# 对可重试的错误按指数退避 + 随机抖动重试，整次运行的重试次数受一个总预算限制，
+# 避免服务整体故障时每条对话都反复重试把运行时间拖得很长。
+
+import asyncio
+import json
+import os
+import random
+import threading
+
+from rate_limiter import is_rate_limit_error
+
+RATE_LIMIT = 'rate_limit'
+TRANSIENT = 'transient'
+TERMINAL = 'terminal'
+
+# 视为临时故障的 HTTP 状态码（5xx 之外）
+TRANSIENT_STATUS_CODES = {408}
+# 网络层异常（httpx / aiohttp）按类名识别，避免直接依赖这些库
+TRANSIENT_EXCEPTION_NAMES = {
+    'TimeoutException', 'NetworkError', 'TransportError', 'RemoteProtocolError',
+    'ClientConnectionError', 'ServerDisconnectedError', 'ServerTimeoutError',
+}
+
+
+def classify_error(e):
+    """把异常分为 RATE_LIMIT、TRANSIENT 或 TERMINAL"""
+    if is_rate_limit_error(e):
+        return RATE_LIMIT
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        return TRANSIENT if code >= 500 or code in TRANSIENT_STATUS_CODES else TERMINAL
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return TRANSIENT
+    if any(cls.__name__ in TRANSIENT_EXCEPTION_NAMES for cls in type(e).__mro__):
+        return TRANSIENT
+    if isinstance(e, json.JSONDecodeError):
+        # 模型偶尔输出不完整的 JSON，重新生成一次通常就能解析
+        return TRANSIENT
+    return TERMINAL
+
+
+class RetryPolicy:
+    """指数退避 + 抖动的重试策略，带整次运行共享的重试预算，可在线程和 asyncio 中共享使用"""
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=30.0, retry_budget=100, second_pass_delay=10.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.second_pass_delay = second_pass_delay
+        self._lock = threading.Lock()
+        self.retries_used = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        从环境变量创建：ANALYSIS_MAX_RETRIES、
+        ANALYSIS_RETRY_BASE_DELAY、ANALYSIS_RETRY_MAX_DELAY、ANALYSIS_RETRY_BUDGET、ANALYSIS_SECOND_PASS_DELAY
+        """
+        return cls(
+            max_retries=int(os.environ.get('ANALYSIS_MAX_RETRIES', '3')),
+            base_delay=float(os.environ.get('ANALYSIS_RETRY_BASE_DELAY', '1')),
+            max_delay=float(os.environ.get('ANALYSIS_RETRY_MAX_DELAY', '30')),
+            retry_budget=int(os.environ.get('ANALYSIS_RETRY_BUDGET', '100')),
+            second_pass_delay=float(os.environ.get('ANALYSIS_SECOND_PASS_DELAY', '10')),
+        )
+
+    def reset(self):
+        """新一次运行开始时重置已用的重试预算"""
+        with self._lock:
+            self.retries_used = 0
+
+    def reserve_retry(self):
+        """从预算中占用一次重试，预算用完时返回 False"""
+        with self._lock:
+            if self.retries_used >= self.retry_budget:
+                return False
+            self.retries_used += 1
+            return True
+
+    def should_retry(self, kind, attempt):
+        """第 attempt 次（从 0 开始）调用失败后是否应重试；应重试时会占用一次预算"""
+        if kind == TERMINAL or attempt >= self.max_retries:
+            return False
+        return self.reserve_retry()
+
+    def backoff_delay(self, attempt):
+        """第 attempt 次重试前的等待秒数（full jitter）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def status_line(self):
+        with self._lock:
+            return f"Retry policy: {self.retries_used}/{self.retry_budget} retries used, up to {self.max_retries} per request"
@@ -1,15 +1,23 @@
 # run_analysis_workflow.py
-# Usage: python run_analysis_workflow.py <raw_input_json_path> <final_output_excel_path> [limit_number]
+# Usage: python run_analysis_workflow.py <raw_input_json_path> <final_output_excel_path> [limit_number] [--batch] [--batch-stub=<dir>] [--journal=<path>] [--resume] [--dump-cleaned=<path>] [--partial-report] [--formats=csv,parquet,jsonl] [--startup-timing]
+#        python run_analysis_workflow.py --startup-timing   只测量启动耗时（导入模块、加载延迟导入的依赖、创建客户端）后退出
+#   --batch            使用 Gemini Batch API 离线提交整批任务（无逐条实时进度，适合整月导出）
+#   --batch-stub=<dir> 使用本地目录模拟 Batch API 端点（本地测试用，隐含 --batch）
+#   --journal=<path>   检查点日志路径，默认 <final_output_excel_path>.journal.jsonl
+#   --resume           从检查点日志恢复，跳过已成功分析的 chat_id
+#   --dump-cleaned=<path> 额外把清洗后的对话写入该文件（仅供调试，分析本身不需要中间文件；.ndjson / .jsonl 每行一条，可加 .gz / .zst 压缩）
+#   --partial-report   分析进行中把已完成的结果写入 <输出文件名>.partial.csv 并定期生成 .partial.xlsx 快照（Batch API 模式不支持）
+#   --formats=<列表>   额外导出格式，逗号分隔（xlsx / csv / jsonl / parquet），写在输出文件旁边，整体指标和总结写入 .summary.json
+#   --startup-timing   输出 PYTHON_STARTUP_TIMING:{json}，记录本次任务从启动到开始分析的各阶段耗时
 
+import time
+# 脚本开始执行的时间，用于 --startup-timing（在其他导入之前记录）
+SCRIPT_START_TIME = time.perf_counter()
+
+import itertools
 import json
 import os
 import sys # 导入 sys 模块
-import uuid # 导入 uuid 用于生成临时文件名
-from google import genai
-from datetime import datetime
-import time
-from dotenv import load_dotenv
-import pandas as pd
 
 # --- 获取脚本所在的目录并添加到 Python 搜索路径 ---
 # 这允许 Python 找到同目录下的其他脚本 (clean_chat_data.py, analyze_chats.py)
@@ -20,13 +28,19 @@ if script_dir not in sys.path:
 
 # --- 尝试从同目录下的脚本导入函数和变量 ---
 try:
-    # 导入清洗函数 (来自 clean_chat_data.py)
+    # 导入流式清洗函数 (来自 clean_chat_data.py)，清洗结果在进程内直接交给分析步骤
     # 确保 clean_chat_data.py 就在这个 run_analysis_workflow.py 文件旁边
-    from clean_chat_data import clean_chat_data
-    # 从 analyze_chats.py 导入核心分析函数，以及它初始化好的 client 和 MODEL_NAME
-    # analyze_chats.py 在导入时会自动加载 .env 并尝试初始化 client/model
+    from clean_chat_data import iter_cleaned_chats
+    from json_stream import write_json_records
+    # 运行指标：各阶段耗时和资源使用以 PYTHON_METRIC 行输出
+    from instrumentation import IterationTimer, emit_metric, peak_rss_mb
+    # 从 analyze_chats.py 导入核心分析函数、客户端工厂 get_client 和 MODEL_NAME
+    # analyze_chats.py 在导入时会自动加载 .env
     # 确保 analyze_chats.py 就在这个 run_analysis_workflow.py 文件旁边
-    from analyze_chats import run_analysis_process, client, MODEL_NAME
+    # Gemini 客户端由 get_client() 在第一次需要时创建（pandas、google.genai 等也都延迟导入），导入本模块本身很快
+    from analyze_chats import run_analysis_process, parse_export_formats, get_client, MODEL_NAME
+    # 离线 Batch API 模式 (--batch)
+    from batch_analysis import run_batch_analysis_process, GeminiBatchBackend, FileBatchBackend
 
 except ImportError as e:
     # 当作为子进程运行时，直接打印错误并退出，Node.js 会捕获 stderr
@@ -39,9 +53,65 @@ except Exception as e:
     print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
     sys.exit(1)
 
+# 导入本脚本依赖的模块所用的时间 (秒)
+IMPORT_SECONDS = time.perf_counter() - SCRIPT_START_TIME
+
+
+def warm_up():
+    """导入延迟加载的依赖并创建 Gemini 客户端，返回每一步的耗时 (秒)；常驻 worker 启动时调用，任务开始时不再付出这部分开销"""
+    timings = {}
+    start = time.perf_counter()
+    import pandas  # noqa: F401
+    timings['pandas'] = round(time.perf_counter() - start, 4)
+    start = time.perf_counter()
+    get_client()
+    timings['client'] = round(time.perf_counter() - start, 4)
+    return timings
+
+def print_startup_timing(timings):
+    """输出一行机器可读的启动耗时，Node.js 据此记录每个任务的冷启动延迟"""
+    print(f"PYTHON_STARTUP_TIMING:{json.dumps(timings, ensure_ascii=False)}")
+
+def measure_startup():
+    """--startup-timing 单独使用时：测量导入、依赖加载和客户端创建的耗时后退出"""
+    timings = {'imports': round(IMPORT_SECONDS, 4)}
+    timings.update(warm_up())
+    timings['total'] = round(time.perf_counter() - SCRIPT_START_TIME, 4)
+    print_startup_timing(timings)
+    return 0
+
+
+def print_cleaning_summary(cleaning_stats, cleaned_count):
+    """打印清洗步骤的统计信息；设置了 limit 时清洗会提前停止，此时没有原始对话总数"""
+    if 'raw_chats' in cleaning_stats:
+        print(f"PYTHON_STATUS: Read {cleaning_stats['raw_chats']} raw chats, kept {cleaned_count} chats with customer messages.")
+    else:
+        print(f"PYTHON_STATUS: Cleaned the first {cleaned_count} chats with customer messages (limit reached).")
+    print("PYTHON_STATUS: Cleaning step completed.")
+
+def emit_cleaning_metrics(cleaning_stats, cleaning_timer, streamed):
+    """
+    输出读取 (load：读取并解析原始文件) 和清洗 (clean：不含读取) 两个阶段的指标及各条清洗规则的计数。
+    流式模式下清洗与分析交错进行，耗时是在清洗迭代器中累计花费的时间。
+    """
+    load_timer = cleaning_stats.get('load_timer')
+    load_wall = load_cpu = 0.0
+    if load_timer is not None:
+        load_timer.emit('load', streamed=streamed)
+        load_wall, load_cpu = load_timer.wall_s, load_timer.cpu_s
+    emit_metric('stage', 'clean',
+                wall_s=round(max(cleaning_timer.wall_s - load_wall, 0.0), 4),
+                cpu_s=round(max(cleaning_timer.cpu_s - load_cpu, 0.0), 4),
+                peak_rss_mb=peak_rss_mb(), items=cleaning_timer.items,
+                counts=cleaning_stats.get('counts', {}), streamed=streamed)
+
 
-# --- 主函数，现在接受文件路径和可选 limit 作为参数 ---
-def main(raw_input_file_path, final_output_excel_path, limit_value=None):
+# --- 主函数，现在接受文件路径和可选 limit 作为参数，返回进程退出码 ---
+# 常驻 worker (analysis_worker.py) 在同一进程内多次调用 main，所以这里不能直接 sys.exit
+def main(raw_input_file_path, final_output_excel_path, limit_value=None, batch_mode=False, batch_stub_dir=None,
+         journal_path=None, resume=False, dump_cleaned_path=None, partial_report=False,
+         export_formats=None, startup_timing=False):
+    job_start = time.perf_counter()
     # 使用特定的前缀 'PYTHON_STATUS:' 打印状态信息，Node.js 可以捕获并转发到前端
     print("PYTHON_STATUS: Starting chat analysis workflow...")
     print(f"PYTHON_STATUS: Raw input file: {raw_input_file_path}")
@@ -50,65 +120,112 @@ def main(raw_input_file_path, final_output_excel_path, limit_value=None):
         print(f"PYTHON_STATUS: Analysis limit: {limit_value}")
     else:
         print("PYTHON_STATUS: No limit, processing all chats.")
+    if batch_mode:
+        print(f"PYTHON_STATUS: Batch API mode enabled{' (file-backed stub: ' + batch_stub_dir + ')' if batch_stub_dir else ''}.")
 
-    # --- 定义中间文件 ---
-    # 中间文件将保存在原始输入文件所在的目录
-    input_dir = os.path.dirname(raw_input_file_path)
-    intermediate_cleaned_filename = f"temp_cleaned_chats_intermediate_{os.path.basename(raw_input_file_path)}_{uuid.uuid4().hex}.json"
-    intermediate_cleaned_file_path = os.path.join(input_dir, intermediate_cleaned_filename)
-
-    print(f"PYTHON_STATUS: Intermediate cleaned file: {intermediate_cleaned_file_path}")
+    # --- 检查点日志：子进程崩溃后可以用 --resume 继续 ---
+    if journal_path is None:
+        journal_path = f"{final_output_excel_path}.journal.jsonl"
+    if resume and not os.path.exists(journal_path):
+        print(f"PYTHON_WARNING: Journal {journal_path} not found, starting a fresh run.", file=sys.stderr)
+        resume = False
 
     # --- 步骤 1: 清洗原始对话数据 ---
-    print("\nPYTHON_STATUS: Step 1: Cleaning raw chat data...")
-    try:
-        # clean_chat_data 函数本身会处理读取和保存，并在控制台打印进度
-        # 我们需要确保 clean_chat_data 在错误时也使用 PYTHON_FATAL_ERROR 前缀并退出
-        # **请检查 clean_chat_data.py 确保其内部错误处理也遵循这个模式**
-        clean_chat_data(raw_input_file_path, intermediate_cleaned_file_path)
-        print("PYTHON_STATUS: Cleaning step completed.")
-    except Exception as e:
-        print(f"PYTHON_FATAL_ERROR: Error during cleaning step.")
-        print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
-        # 确保在错误时尝试删除可能生成的中间文件
-        if os.path.exists(intermediate_cleaned_file_path):
-            try:
-                os.remove(intermediate_cleaned_file_path)
-            except OSError:
-                pass
-        sys.exit(1)
+    # 清洗结果直接保存在内存中交给分析步骤，不再写入再读回中间 JSON 文件；
+    # 设置了 limit 时只清洗到足够数量的对话为止
+    if not os.path.exists(raw_input_file_path):
+        print(f"PYTHON_FATAL_ERROR: Raw input file not found: {raw_input_file_path}")
+        return 1
+
+    cleaning_stats = {}
+    cleaning_timer = IterationTimer(iter_cleaned_chats(raw_input_file_path, cleaning_stats))
+    cleaned_chat_iter = cleaning_timer
+    if limit_value is not None:
+        cleaned_chat_iter = itertools.islice(cleaned_chat_iter, limit_value)
 
+    # 实时分析模式下清洗与分析组成流水线同时进行（清洗出一条就可以开始分析一条）；
+    # Batch API 模式需要先拿到全部对话再提交，--dump-cleaned 需要完整的清洗结果，这两种情况先完成清洗
+    streaming = not batch_mode and not dump_cleaned_path
+    if streaming:
+        print("\nPYTHON_STATUS: Step 1: Cleaning raw chat data (streamed into the analysis step)...")
+        cleaned_chats = cleaned_chat_iter
+    else:
+        print("\nPYTHON_STATUS: Step 1: Cleaning raw chat data...")
+        try:
+            cleaned_chats = list(cleaned_chat_iter)
+        except json.JSONDecodeError as e:
+            print(f"PYTHON_FATAL_ERROR: Failed to parse raw input file {raw_input_file_path}. Check JSON format.")
+            print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
+            return 1
+        except Exception as e:
+            print(f"PYTHON_FATAL_ERROR: Error during cleaning step.")
+            print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
+            return 1
+        finally:
+            emit_cleaning_metrics(cleaning_stats, cleaning_timer, streamed=False)
 
-    # 检查中间文件是否存在且非空
-    if not os.path.exists(intermediate_cleaned_file_path) or os.path.getsize(intermediate_cleaned_file_path) == 0:
-        print(f"PYTHON_FATAL_ERROR: Cleaning did not produce a valid intermediate file: {intermediate_cleaned_file_path}")
-        # 尝试读取中间文件内容帮助调试
+        print_cleaning_summary(cleaning_stats, len(cleaned_chats))
+
+    if dump_cleaned_path:
+        # 仅用于调试：保存与旧版中间文件相同格式的清洗结果
         try:
-            with open(intermediate_cleaned_file_path, 'r', encoding='utf-8') as f:
-                error_content = f.read(500) # 只读取前500字符
-                print(f"PYTHON_ERROR_INTERMEDIATE_CONTENT:\n{error_content}...", file=sys.stderr)
-        except Exception:
-            pass
-        sys.exit(1)
+            write_json_records(dump_cleaned_path, cleaned_chats)
+            print(f"PYTHON_STATUS: Cleaned chats written to {dump_cleaned_path}")
+        except OSError as e:
+            print(f"PYTHON_WARNING: Could not write cleaned chats to {dump_cleaned_path}: {e}", file=sys.stderr)
 
 
     print("\nPYTHON_STATUS: Step 2: Analyzing cleaned chat data...")
 
     # 调用 analyze_chats.py 中封装好的分析函数
-    # run_analysis_process 会处理加载清洗后的文件，调用API，计算指标，打印进度和原始API回复，
+    # run_analysis_process 会处理清洗后的对话列表，调用API，计算指标，打印进度和原始API回复，
     # 在控制台打印最终结果，并将结果保存到 Excel 文件。
     # 它还会处理 client=None 的情况。
+    # 客户端在这里才创建；limit 为 0 时没有对话需要分析，不创建客户端（也就不导入 google.genai）
+    client_start = time.perf_counter()
+    client = get_client() if limit_value != 0 else None
+    if startup_timing:
+        print_startup_timing({
+            'imports': round(IMPORT_SECONDS, 4),           # 导入本脚本依赖的模块（常驻 worker 中只在启动时发生一次）
+            'client': round(time.perf_counter() - client_start, 4),
+            'ready': round(time.perf_counter() - job_start, 4),  # 任务开始到开始分析
+            'process_uptime': round(time.perf_counter() - SCRIPT_START_TIME, 4),
+        })
     try:
-        # analyze_chats.py 的 client 和 MODEL_NAME 已经在导入时初始化好了
         # run_analysis_process 内部会打印更详细的进度和 API 调用信息
-        analyzed_results = run_analysis_process(
-            cleaned_input_file=intermediate_cleaned_file_path,
-            final_output_file_excel=final_output_excel_path,
-            client_instance=client,      # 使用 analyze_chats.py 导入的 client
-            model_name_str=MODEL_NAME, # 使用 analyze_chats.py 导入的 MODEL_NAME
-            limit=limit_value,           # 使用从命令行参数解析的 limit
-            print_results_to_console=True # 在子进程的控制台也打印进度和结果
-        )
+        if batch_mode:
+            if batch_stub_dir:
+                backend = FileBatchBackend(batch_stub_dir)
+            elif client is not None:
+                backend = GeminiBatchBackend(client)
+            else:
+                raise RuntimeError("Batch mode requires a Gemini client (GOOGLE_API_KEY) or --batch-stub=<dir>.")
+            analyzed_results = run_batch_analysis_process(
+                cleaned_input_file=cleaned_chats,
+                final_output_file_excel=final_output_excel_path,
+                backend=backend,
+                client_instance=client,
+                model_name_str=MODEL_NAME,
+                limit=limit_value,
+                journal_path=journal_path,
+                resume=resume,
+                export_formats=export_formats
+            )
+        else:
+            analyzed_results = run_analysis_process(
+                cleaned_input_file=cleaned_chats,
+                final_output_file_excel=final_output_excel_path,
+                client_instance=client,      # 使用 get_client() 创建的 client
+                model_name_str=MODEL_NAME, # 使用 analyze_chats.py 导入的 MODEL_NAME
+                limit=limit_value,           # 使用从命令行参数解析的 limit
+                print_results_to_console=True, # 在子进程的控制台也打印进度和结果
+                journal_path=journal_path,   # 每条结果立即写入检查点日志
+                resume=resume,
+                partial_report=partial_report,
+                export_formats=export_formats
+            )
+        if streaming:
+            print_cleaning_summary(cleaning_stats, len(analyzed_results))
         print("PYTHON_STATUS: Analysis step completed.")
         # analyze_chats.run_analysis_process 已经打印了总结信息和保存信息
 
@@ -117,63 +234,104 @@ def main(raw_input_file_path, final_output_excel_path, limit_value=None):
             print("PYTHON_WARNING: Analysis completed, but no results were generated.", file=sys.stderr)
 
 
+    except json.JSONDecodeError as e:
+        # 流水线模式下原始文件的格式错误在分析过程中才会暴露
+        print(f"PYTHON_FATAL_ERROR: Failed to parse raw input file {raw_input_file_path}. Check JSON format.")
+        print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
+        return 1
     except Exception as e:
         print(f"PYTHON_FATAL_ERROR: Error during analysis step.")
         print(f"PYTHON_FATAL_ERROR_DETAIL: {e}", file=sys.stderr)
-        # 在分析失败时尝试删除可能生成的中间文件
-        if os.path.exists(intermediate_cleaned_file_path):
-            try:
-                os.remove(intermediate_cleaned_file_path)
-            except OSError:
-                pass
         import traceback
         traceback.print_exc(file=sys.stderr) # 打印完整的错误堆栈到 stderr
-        sys.exit(1) # 分析失败，退出子进程
-
+        return 1 # 分析失败
     finally:
-        # --- 清理中间文件 ---
-        # 无论分析成功或失败，都尝试删除中间文件
-        if os.path.exists(intermediate_cleaned_file_path):
-            print(f"PYTHON_STATUS: Attempting to clean up intermediate file: {intermediate_cleaned_file_path}")
-            try:
-                os.remove(intermediate_cleaned_file_path)
-                print("PYTHON_STATUS: Intermediate file removed.")
-            except OSError as e:
-                print(f"PYTHON_WARNING: Could not remove intermediate file {intermediate_cleaned_file_path}: {e}", file=sys.stderr)
+        if streaming:
+            emit_cleaning_metrics(cleaning_stats, cleaning_timer, streamed=True)
 
 
+    # 工作流成功完成后检查点日志已无用，删除以免占用磁盘
+    if os.path.exists(final_output_excel_path) and os.path.exists(journal_path):
+        try:
+            os.remove(journal_path)
+        except OSError as e:
+            print(f"PYTHON_WARNING: Could not remove journal {journal_path}: {e}", file=sys.stderr)
+
+    emit_metric('stage', 'workflow', wall_s=round(time.perf_counter() - job_start, 4), peak_rss_mb=peak_rss_mb())
     print("PYTHON_STATUS: Chat analysis workflow finished.")
-    sys.exit(0) # 成功完成，退出子进程
+    return 0 # 成功完成
 
 
-# --- 当脚本作为主程序运行 (即被 Node.js 的 child_process 调用) ---
-if __name__ == "__main__":
-    # sys.argv 包含命令行参数列表
-    # sys.argv[0] 是脚本名本身
-    # sys.argv[1] 应该是原始输入文件路径
-    # sys.argv[2] 应该是最终输出 Excel 文件路径
-    # sys.argv[3] (可选) 应该是处理数量限制 (数字字符串)
+def parse_workflow_args(args):
+    """
+    解析命令行参数（不含脚本名），返回 main 的关键字参数 dict；参数不足时打印错误并返回 None。
+    args[0] 是原始输入文件路径，args[1] 是最终输出 Excel 文件路径，args[2] (可选) 是处理数量限制 (数字字符串)，
+    以 -- 开头的参数是开关选项，可以出现在任意位置
+    """
+    positional_args = [arg for arg in args if not arg.startswith('--')]
+    option_args = [arg for arg in args if arg.startswith('--')]
 
-    if len(sys.argv) < 3:
+    if len(positional_args) < 2:
         print("PYTHON_FATAL_ERROR: Missing command line arguments.")
-        print("PYTHON_FATAL_ERROR: Usage: python run_analysis_workflow.py <raw_input_json_path> <final_output_excel_path> [limit]")
-        sys.exit(1)
+        print("PYTHON_FATAL_ERROR: Usage: python run_analysis_workflow.py <raw_input_json_path> <final_output_excel_path> [limit] [--batch] [--batch-stub=<dir>] [--journal=<path>] [--resume] [--dump-cleaned=<path>] [--partial-report] [--formats=csv,parquet,jsonl] [--startup-timing]")
+        return None
 
-    raw_input_path = sys.argv[1]
-    final_output_path = sys.argv[2]
-    limit = None # Default to no limit
+    options = {
+        'raw_input_file_path': positional_args[0],
+        'final_output_excel_path': positional_args[1],
+        'limit_value': None, # Default to no limit
+        'batch_mode': False,
+        'batch_stub_dir': None,
+        'journal_path': None,
+        'resume': False,
+        'dump_cleaned_path': None,
+        'partial_report': False,
+        'export_formats': None,
+        'startup_timing': False,
+    }
+    for option in option_args:
+        if option == '--batch':
+            options['batch_mode'] = True
+        elif option.startswith('--batch-stub='):
+            options['batch_mode'] = True
+            options['batch_stub_dir'] = option.split('=', 1)[1]
+        elif option.startswith('--journal='):
+            options['journal_path'] = option.split('=', 1)[1]
+        elif option == '--resume':
+            options['resume'] = True
+        elif option.startswith('--dump-cleaned='):
+            options['dump_cleaned_path'] = option.split('=', 1)[1]
+        elif option == '--partial-report':
+            options['partial_report'] = True
+        elif option.startswith('--formats='):
+            options['export_formats'] = parse_export_formats(option.split('=', 1)[1])
+        elif option == '--startup-timing':
+            options['startup_timing'] = True
+        else:
+            print(f"PYTHON_WARNING: Unknown option {option} ignored.", file=sys.stderr)
 
-    if len(sys.argv) > 3:
+    if len(positional_args) > 2:
         try:
             # Parse limit argument
-            limit_str = sys.argv[3]
-            limit = int(limit_str)
+            limit = int(positional_args[2])
             if limit < 0:
                  limit = None
                  print("PYTHON_WARNING: Negative limit provided via command line. Processing all chats.", file=sys.stderr)
+            options['limit_value'] = limit
         except ValueError:
             print("PYTHON_WARNING: Invalid limit provided via command line. Processing all chats.", file=sys.stderr)
-            limit = None
+
+    return options
+
+
+# --- 当脚本作为主程序运行 (即被 Node.js 的 child_process 调用) ---
+if __name__ == "__main__":
+    # sys.argv[0] 是脚本名本身，其余参数的含义见 parse_workflow_args
+    if sys.argv[1:] == ['--startup-timing']:
+        sys.exit(measure_startup())
+    workflow_options = parse_workflow_args(sys.argv[1:])
+    if workflow_options is None:
+        sys.exit(1)
 
     # 调用主函数执行工作流
-    main(raw_input_path, final_output_path, limit)
\ No newline at end of file
+    sys.exit(main(**workflow_options))
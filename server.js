@@ -2,6 +2,7 @@
 const express = require('express');
 const multer = require('multer');
 const { spawn } = require('child_process');
+const readline = require('readline');
 const path = require('path');
 const fs = require('fs');
 const SSE = require('express-sse');
@@ -16,6 +17,7 @@ const baseDir = __dirname; // Get directory of server.js
 const uploadDir = path.join(baseDir, 'uploads');
 const outputDir = path.join(baseDir, 'analyzed_results');
 const pythonScriptPath = path.join(baseDir, 'run_analysis_workflow.py');
+const pythonWorkerScriptPath = path.join(baseDir, 'analysis_worker.py');
 
 // Get Python executable path
 const pythonExecutablePath = process.env.PYTHON_EXECUTABLE || 'python';
@@ -37,8 +39,12 @@ const storage = multer.diskStorage({
   },
   filename: function (req, file, cb) {
     const uniqueSuffix = Date.now();
-    // Use original base name + timestamp + original extension
-    cb(null, `${path.parse(file.originalname).name}-${uniqueSuffix}${path.extname(file.originalname)}`);
+    // Use original base name + timestamp + original extension.
+    // Keep compound extensions such as .ndjson.gz intact: Python picks the input format from them.
+    const match = file.originalname.match(/(\.(?:json|ndjson|jsonl))?(\.(?:gz|zst|zstd))$/i);
+    const ext = match ? match[0] : path.extname(file.originalname);
+    const baseName = file.originalname.slice(0, file.originalname.length - ext.length);
+    cb(null, `${baseName}-${uniqueSuffix}${ext}`);
   }
 });
 const upload = multer({ storage: storage, limits: { fileSize: 1024 * 1024 * 50 } }); // Limit file size to 50MB
@@ -88,15 +94,257 @@ origin: function (origin, callback) {
 app.use(express.json());
 app.use(express.urlencoded({ extended: true }));
 
+// --- Python process management ---
+// By default analyses run in a small pool of persistent Python workers (analysis_worker.py) that keep
+// pandas / google.genai imported and the Gemini client warm between uploads. Each worker runs one job at a time.
+// PYTHON_WORKER_POOL_SIZE (default 2) sets the number of warm workers; when all of them are busy, an upload
+// gets its own run_analysis_workflow.py process instead of waiting, so one long analysis never blocks the others.
+// Set PYTHON_WORKER=0 to spawn run_analysis_workflow.py for every upload instead.
+// If the workers cannot be started, we fall back to spawning a process per upload.
+const pythonEnv = { ...process.env, PYTHONIOENCODING: 'utf-8', PYTHONUNBUFFERED: '1' }; // Ensure unbuffered output
+// Set PYTHON_STARTUP_TIMING=1 to log the cold-start latency of every analysis job
+const logStartupTiming = process.env.PYTHON_STARTUP_TIMING === '1';
+const WORKER_POOL_SIZE = Math.max(1, parseInt(process.env.PYTHON_WORKER_POOL_SIZE, 10) || 2);
+// Worker stderr lines written during a job carry its id: PYTHON_JOB_STDERR:<job id>:<line>
+const WORKER_JOB_STDERR_PATTERN = /^PYTHON_JOB_STDERR:([^:]*):(.*)$/;
+
+const workerPool = {
+    disabled: process.env.PYTHON_WORKER === '0',
+    workers: [], // { process, ready, job }
+    queue: [],   // Jobs waiting for a worker that is still starting up
+    nextJobId: 1,
+};
+
+// Spawn run_analysis_workflow.py for a single job (original behaviour, used as fallback)
+const spawnPythonWorkflow = (workflowArgs, handlers) => {
+    const pythonArgs = [pythonScriptPath, ...workflowArgs];
+    console.log(`Spawning Python process: ${pythonExecutablePath} ${pythonArgs.join(' ')}`);
+
+    const spawnedAt = Date.now();
+    let firstOutputSeen = false;
+    const pythonChildProcess = spawn(pythonExecutablePath, pythonArgs, { cwd: baseDir, env: pythonEnv });
+    readline.createInterface({ input: pythonChildProcess.stdout }).on('line', (line) => {
+        if (logStartupTiming && !firstOutputSeen) {
+            // Includes interpreter start-up, which Python cannot measure itself
+            firstOutputSeen = true;
+            console.log(`Python process first output ${Date.now() - spawnedAt} ms after spawn.`);
+        }
+        handlers.onStdoutLine(line);
+    });
+    readline.createInterface({ input: pythonChildProcess.stderr }).on('line', handlers.onStderrLine);
+    pythonChildProcess.on('close', handlers.onExit);
+    pythonChildProcess.on('error', handlers.onStartError);
+};
+
+// Hand every queued job (and the given in-flight jobs) over to one-off processes
+const failOverWorkerJobs = (inFlightJobs = []) => {
+    const jobs = [...inFlightJobs, ...workerPool.queue];
+    workerPool.queue = [];
+    for (const job of jobs) {
+        spawnPythonWorkflow(job.args, job.handlers);
+    }
+};
+
+// A worker job ends once its completion marker has arrived on both stdout and stderr,
+// so stderr lines still in the pipe when stdout reports completion are not lost.
+const finishWorkerJobIfDone = (worker) => {
+    const job = worker.job;
+    if (!job || !job.stdoutDone || !job.stderrDone) return;
+    worker.job = null;
+    job.handlers.onExit(job.exitCode);
+    dispatchWorkerJobs();
+};
+
+const parseWorkerJobDone = (line) => {
+    try {
+        return JSON.parse(line.substring('PYTHON_WORKER_JOB_DONE:'.length).trim());
+    } catch (e) {
+        console.error('Failed to parse worker job completion message:', line);
+        return {};
+    }
+};
+
+const startPythonWorker = () => {
+    console.log(`Starting persistent Python worker: ${pythonExecutablePath} ${pythonWorkerScriptPath}`);
+    const workerProcess = spawn(pythonExecutablePath, [pythonWorkerScriptPath], { cwd: baseDir, env: pythonEnv });
+    const worker = { process: workerProcess, ready: false, job: null };
+    workerPool.workers.push(worker);
+    let exited = false;
+
+    readline.createInterface({ input: workerProcess.stdout }).on('line', (line) => {
+        if (line.startsWith('PYTHON_WORKER_READY')) {
+            console.log(`Persistent Python worker ${workerProcess.pid} is ready.`);
+            worker.ready = true;
+            dispatchWorkerJobs();
+        } else if (line.startsWith('PYTHON_WORKER_JOB_DONE:')) {
+            const done = parseWorkerJobDone(line);
+            if (worker.job && String(done.id) === worker.job.id) {
+                worker.job.exitCode = Number.isInteger(done.exit_code) ? done.exit_code : 1;
+                worker.job.stdoutDone = true;
+                finishWorkerJobIfDone(worker);
+            }
+        } else if (worker.job) {
+            worker.job.handlers.onStdoutLine(line);
+        } else if (line.trim()) {
+            console.log(`Python worker: ${line}`);
+        }
+    });
+
+    readline.createInterface({ input: workerProcess.stderr }).on('line', (line) => {
+        const tagged = line.match(WORKER_JOB_STDERR_PATTERN);
+        if (tagged) {
+            if (worker.job && tagged[1] === worker.job.id) {
+                worker.job.handlers.onStderrLine(tagged[2]);
+            } else {
+                console.error(`Python worker stderr for finished job ${tagged[1]}: ${tagged[2]}`);
+            }
+        } else if (line.startsWith('PYTHON_WORKER_JOB_DONE:')) {
+            const done = parseWorkerJobDone(line);
+            if (worker.job && String(done.id) === worker.job.id) {
+                worker.job.stderrDone = true;
+                finishWorkerJobIfDone(worker);
+            }
+        } else if (worker.job) {
+            // Untagged output during a job (e.g. written by a native library): the worker only runs this job
+            worker.job.handlers.onStderrLine(line);
+        } else if (line.trim()) {
+            console.error(`Python worker stderr: ${line}`);
+        }
+    });
+
+    const onWorkerGone = (code, err) => {
+        if (exited) return;
+        exited = true;
+        workerPool.workers = workerPool.workers.filter((other) => other !== worker);
+        const job = worker.job;
+        worker.job = null;
+        if (!worker.ready) {
+            // Never became ready (missing python, import error...): stop using workers
+            console.error('Persistent Python worker failed to start, falling back to one Python process per upload.', err || `exit code ${code}`);
+            workerPool.disabled = true;
+            failOverWorkerJobs(job ? [job] : []);
+            return;
+        }
+        console.warn(`Persistent Python worker ${workerProcess.pid} exited with code ${code}. It will be restarted.`);
+        if (job) job.handlers.onExit(code === null || code === 0 ? 1 : code);
+        dispatchWorkerJobs();
+    };
+    workerProcess.on('close', (code) => onWorkerGone(code));
+    workerProcess.on('error', (err) => onWorkerGone(null, err));
+};
+
+// Keep the pool at full size and hand queued jobs to idle, ready workers
+const dispatchWorkerJobs = () => {
+    if (workerPool.disabled) {
+        failOverWorkerJobs();
+        return;
+    }
+    while (workerPool.workers.length < WORKER_POOL_SIZE) {
+        startPythonWorker(); // Workers that exited are replaced here
+    }
+    for (const worker of workerPool.workers) {
+        if (workerPool.queue.length === 0) break;
+        if (!worker.ready || worker.job) continue;
+        const job = workerPool.queue.shift();
+        worker.job = job;
+        console.log(`Sending job ${job.id} to persistent Python worker ${worker.process.pid}: ${job.args.join(' ')}`);
+        worker.process.stdin.write(JSON.stringify({ id: job.id, args: job.args }) + '\n');
+    }
+};
+
+// Run one analysis workflow; handlers receive stdout/stderr lines and the exit code
+const runPythonWorkflow = (workflowArgs, handlers) => {
+    if (workerPool.disabled) {
+        spawnPythonWorkflow(workflowArgs, handlers);
+        return;
+    }
+    const job = { id: String(workerPool.nextJobId++), args: workflowArgs, handlers, stdoutDone: false, stderrDone: false, exitCode: null };
+    // Workers without a job are idle or still starting; every other worker is busy with an analysis
+    const freeWorkers = workerPool.workers.filter((worker) => !worker.job).length
+        + Math.max(0, WORKER_POOL_SIZE - workerPool.workers.length);
+    if (workerPool.queue.length >= freeWorkers) {
+        console.log(`All ${WORKER_POOL_SIZE} persistent Python workers are busy, running job ${job.id} in a separate process.`);
+        spawnPythonWorkflow(workflowArgs, handlers);
+        return;
+    }
+    workerPool.queue.push(job);
+    dispatchWorkerJobs();
+};
+// --------------------------------------------------
+
+
+// Extra report formats the upload request may ask for (written next to the Excel report)
+const EXPORT_FORMATS = ['csv', 'jsonl', 'parquet'];
+// Files produced by an analysis run: the report, extra exports, the summary sidecar, partial results and the journal
+const ANALYSIS_RESULT_EXTENSIONS = ['.xlsx', '.csv', '.jsonl', '.parquet', '.summary.json'];
+
+// Output roots (report filename without .xlsx) of jobs that are queued or running.
+// Their files (.partial.csv/.partial.xlsx, .xlsx.journal.jsonl...) are still being written or offered for download.
+const activeOutputRoots = new Set();
+const outputRootOf = (excelFilename) => excelFilename.replace(/\.xlsx$/, '');
+const belongsToOutputRoot = (file, root) => file.startsWith(`${root}.`);
+
+// --- Resumable jobs ---
+// Every job writes uploads/<output root>.job.json with its input path and workflow arguments when it starts.
+// It is removed together with the uploaded input when the job succeeds. If the Python process fails or is killed
+// (crash, deploy restart...), the input, the job file and the checkpoint journal are kept, and
+// POST /resume_analysis re-runs the job with --resume so only the chats that were in flight are analyzed again.
+// Failed jobs stay resumable for ANALYSIS_RESUME_TTL_HOURS (default 24), then the next upload cleans them up.
+const RESUMABLE_JOB_TTL_MS = (parseFloat(process.env.ANALYSIS_RESUME_TTL_HOURS) || 24) * 60 * 60 * 1000;
+const JOB_FILE_SUFFIX = '.job.json';
+const jobFilePath = (outputRoot) => path.join(uploadDir, `${outputRoot}${JOB_FILE_SUFFIX}`);
+
+const removeFileIfExists = async (filePath, description) => {
+    if (!fs.existsSync(filePath)) return;
+    try {
+        await fs.promises.unlink(filePath);
+        console.log(`Removed ${description}: ${filePath}`);
+    } catch (err) {
+        console.error(`Error removing ${description} ${filePath}:`, err);
+    }
+};
+
+const readJobFile = async (outputRoot) => JSON.parse(await fs.promises.readFile(jobFilePath(outputRoot), 'utf-8'));
+
+// Output roots of failed jobs that can still be resumed; expired ones lose their job file and input here
+const collectResumableOutputRoots = async () => {
+    const roots = new Set();
+    const files = await fs.promises.readdir(uploadDir);
+    for (const file of files.filter((name) => name.endsWith(JOB_FILE_SUFFIX))) {
+        const outputRoot = file.slice(0, -JOB_FILE_SUFFIX.length);
+        if (activeOutputRoots.has(outputRoot)) continue;
+        const jobPath = path.join(uploadDir, file);
+        try {
+            // The job file is rewritten when the job fails, so its mtime is the failure time
+            const { mtimeMs } = await fs.promises.stat(jobPath);
+            if (Date.now() - mtimeMs < RESUMABLE_JOB_TTL_MS) {
+                roots.add(outputRoot);
+                continue;
+            }
+            const job = await readJobFile(outputRoot);
+            await removeFileIfExists(job.inputPath, 'expired resumable input file');
+        } catch (err) {
+            console.error(`Error reading resumable job file ${jobPath}:`, err);
+        }
+        await removeFileIfExists(jobPath, 'expired resumable job file');
+    }
+    return roots;
+};
+
 // --- Helper function to delete old analysis files ---
 const cleanupOldAnalysisFiles = async () => {
     console.log(`Attempting to clean up old analysis files in: ${outputDir}`);
     try {
+        const resumableOutputRoots = await collectResumableOutputRoots();
+        const keptOutputRoots = [...activeOutputRoots, ...resumableOutputRoots];
         const files = await fs.promises.readdir(outputDir);
         let deletedCount = 0;
         for (const file of files) {
-            // Only delete files matching the analysis result pattern and with .xlsx extension
-            if (file.startsWith('analysis_result_') && file.endsWith('.xlsx')) {
+            if (keptOutputRoots.some((root) => belongsToOutputRoot(file, root))) {
+                continue; // Never touch the files of a job that is queued, running or can still be resumed
+            }
+            // Only delete files matching the analysis result pattern: reports, extra export formats and partial results
+            if (file.startsWith('analysis_result_') && ANALYSIS_RESULT_EXTENSIONS.some((ext) => file.endsWith(ext))) {
                  const filePath = path.join(outputDir, file);
                  try {
                      await fs.promises.unlink(filePath);
@@ -125,6 +373,207 @@ app.get('/', (req, res) => {
 app.get('/analysis_stream', sse.init);
 
 
+// Run one analysis job and forward its output to SSE clients.
+// job: { inputPath, outputExcelFilename, args } where args are the run_analysis_workflow.py arguments.
+const startAnalysisJob = (job, { resume = false } = {}) => {
+  const inputJsonPath = job.inputPath;
+  const outputExcelFilename = job.outputExcelFilename;
+  const outputExcelPath = path.join(outputDir, outputExcelFilename); // Local path where Python saves
+  const outputRoot = outputRootOf(outputExcelFilename);
+
+  const workflowArgs = [
+    ...job.args,
+    ...(resume ? ['--resume'] : []), // Skip the chats already recorded in the checkpoint journal
+    ...(logStartupTiming ? ['--startup-timing'] : [])
+  ];
+
+  let pythonStdout = '';
+  let pythonStderr = '';
+  const exportFiles = []; // Extra export files reported by Python (PYTHON_EXPORT_FILE)
+
+  // Forward Python's stdout lines to SSE clients
+  const onStdoutLine = (line) => {
+    // console.log(`Python stdout: ${line}`); // Log to Node.js console
+    pythonStdout += line + '\n';
+
+    if (line.startsWith('PYTHON_STATUS:')) {
+        sse.send({ type: 'status', message: line.substring('PYTHON_STATUS:'.length).trim() }, 'message');
+    } else if (line.startsWith('PYTHON_PARSED_CHAT_RESULT:')) {
+         const jsonString = line.substring('PYTHON_PARSED_CHAT_RESULT:'.length).trim();
+         sse.send({ type: 'parsed_result', content: jsonString }, 'message');
+    } else if (line.startsWith('PYTHON_PARTIAL_REPORT:')) {
+         // Partial results written next to the final report; offer them for download while the run continues
+         try {
+             const partial = JSON.parse(line.substring('PYTHON_PARTIAL_REPORT:'.length).trim());
+             const csvFilename = path.basename(partial.csv);
+             const xlsxFilename = partial.xlsx ? path.basename(partial.xlsx) : null;
+             sse.send({
+                 type: 'partial_report',
+                 rows: partial.rows,
+                 csvFilename,
+                 csvDownloadUrl: `/download/${csvFilename}`,
+                 filename: xlsxFilename,
+                 downloadUrl: xlsxFilename ? `/download/${xlsxFilename}` : null,
+                 xlsxRows: partial.xlsx_rows
+             }, 'message');
+         } catch (e) {
+             console.error('Failed to parse partial report message from stdout:', e);
+         }
+    } else if (line.startsWith('PYTHON_METRIC:')) {
+         // Per-stage timing / resource metrics, forwarded as-is for the frontend or external tooling
+         try {
+             sse.send({ type: 'metric', metric: JSON.parse(line.substring('PYTHON_METRIC:'.length).trim()) }, 'message');
+         } catch (e) {
+             console.error('Failed to parse metric line from stdout:', e);
+         }
+    } else if (line.startsWith('PYTHON_STARTUP_TIMING:')) {
+         console.log(`Python startup timing: ${line.substring('PYTHON_STARTUP_TIMING:'.length).trim()}`);
+    } else if (line.startsWith('PYTHON_EXPORT_FILE:')) {
+         try {
+             const exported = JSON.parse(line.substring('PYTHON_EXPORT_FILE:'.length).trim());
+             const filename = path.basename(exported.path);
+             exportFiles.push({ format: exported.format, filename, downloadUrl: `/download/${filename}` });
+         } catch (e) {
+             console.error('Failed to parse export file message from stdout:', e);
+         }
+    } else if (line.startsWith('PYTHON_RESULT_JSON:')) {
+         const jsonContent = line.substring('PYTHON_RESULT_JSON:'.length).trim();
+         try {
+             const finalResult = JSON.parse(jsonContent);
+             sse.send({ type: 'final_result_json', content: finalResult }, 'message');
+         } catch (e) {
+             console.error('Failed to parse final JSON result from stdout:', e);
+             sse.send({ type: 'log_error', message: `Failed to parse final JSON result: ${e}. Raw content: ${jsonContent.substring(0, 200)}...` }, 'message');
+         }
+    } else {
+         if (line.trim()) {
+            sse.send({ type: 'log', message: line.trim() }, 'message');
+         }
+    }
+  };
+
+  // Forward Python's stderr lines to SSE clients
+  const onStderrLine = (line) => {
+    // console.error(`Python stderr: ${line}`); // Log to Node.js console
+    pythonStderr += line + '\n';
+
+     if (line.startsWith('PYTHON_FATAL_ERROR:')) {
+         sse.send({ type: 'fatal_error', message: line.substring('PYTHON_FATAL_ERROR:'.length).trim(), details: pythonStderr }, 'message');
+     } else if (line.startsWith('PYTHON_ERROR:')) {
+          sse.send({ type: 'error', message: line.substring('PYTHON_ERROR:'.length).trim() }, 'message');
+     } else if (line.startsWith('PYTHON_WARNING:')) {
+          sse.send({ type: 'warning', message: line.substring('PYTHON_WARNING:'.length).trim() }, 'message');
+     } else if (line.trim()) {
+         sse.send({ type: 'log_error', message: line.trim() }, 'message');
+     }
+  };
+
+  // Called when the workflow finishes (process exit, or job completion in the persistent worker)
+  const onExit = async (code) => {
+    console.log(`Python workflow exited with code ${code}`);
+    activeOutputRoots.delete(outputRoot);
+
+    // Use collected stdout/stderr for final error report if needed
+    const finalStdout = pythonStdout;
+    const finalStderr = pythonStderr;
+
+    if (code === 0) {
+      // The job is finished: it no longer needs the uploaded input or its job file
+      await removeFileIfExists(inputJsonPath, 'temporary input file');
+      await removeFileIfExists(jobFilePath(outputRoot), 'job file');
+
+      // Python script finished successfully
+      // Check if the expected output file was created
+      if (fs.existsSync(outputExcelPath)) {
+        console.log(`Python generated output file: ${outputExcelPath}`);
+
+        // --- Send 'complete' SSE event with the LOCAL download URL ---
+        // Frontend will download this file from *this* Render backend instance
+        sse.send({ // Data payload for the 'complete' event
+          status: 'Analysis complete',
+          filename: outputExcelFilename,
+          // The frontend will use its backendUrl + this relative path to download
+          downloadUrl: `/download/${outputExcelFilename}`,
+          // Extra formats requested in the upload (csv / jsonl / parquet) plus the summary JSON
+          exports: exportFiles,
+          // Optional: Include captured output in complete event data for debugging
+          // stdout: finalStdout,
+          // stderr: finalStderr
+        }, 'complete'); // <-- THIS is the SSE event name
+        // -------------------------------------------------------------
+
+        console.log(`Analysis complete. Local Download URL sent.`);
+
+        // *** Removed immediate deletion here ***
+        // The file will remain until the *next* upload triggers cleanupOldAnalysisFiles
+        // or the Render instance restarts/cleans its ephemeral storage.
+
+
+      } else {
+        // Python exited with 0, but output file is missing - indicates a problem in Python's saving logic
+        const errorMessage = 'Analysis completed (Python exit code 0), but output file was not found.';
+        console.error(errorMessage);
+         sse.send({
+             type: 'error', // Data payload type
+             message: errorMessage,
+             details: `Expected file: ${outputExcelPath}\n` + finalStdout + finalStderr
+         }, 'error'); // Send as 'error' event
+      }
+    } else {
+      // Python script failed (non-zero exit code)
+      const errorMessage = `Analysis failed during Python execution. Exit code: ${code}.`;
+      console.error(errorMessage);
+       // Send an 'error' or 'fatal_error' event for process failure
+       // Check if a fatal error was already reported by PythonStderr
+       if (!finalStderr.includes('PYTHON_FATAL_ERROR:')) {
+          sse.send({
+              type: 'fatal_error', // Use fatal_error for process termination
+              message: errorMessage,
+              details: finalStdout + finalStderr
+          }, 'fatal_error');
+       }
+
+      // Keep the input, job file and journal so the job can be resumed; rewriting the job file restarts its expiry
+      try {
+          await fs.promises.writeFile(jobFilePath(outputRoot), JSON.stringify({ ...job, failedAt: new Date().toISOString(), exitCode: code }));
+          sse.send({
+              type: 'resumable',
+              message: 'Analysis can be resumed; chats already analyzed will not be analyzed again.',
+              outputFilename: outputExcelFilename,
+              resumeUrl: '/resume_analysis'
+          }, 'message');
+      } catch (err) {
+          console.error(`Error updating job file for ${outputExcelFilename}:`, err);
+      }
+    }
+  };
+
+  // Called when the Python process cannot be spawned (e.g., python command not found)
+  const onStartError = async (err) => {
+     const errorMessage = 'Failed to spawn python process. Check if python executable is in PATH or configured correctly via PYTHON_EXECUTABLE env var.';
+     console.error(errorMessage, err);
+     activeOutputRoots.delete(outputRoot);
+     // Nothing ran, so there is nothing to resume: clean up the input file and job file
+     await removeFileIfExists(inputJsonPath, 'input file after spawn error');
+     await removeFileIfExists(jobFilePath(outputRoot), 'job file after spawn error');
+     // Send a fatal error event to the frontend
+     sse.send({
+         type: 'fatal_error',
+         message: errorMessage,
+         details: err.message
+     }, 'fatal_error');
+  };
+
+  activeOutputRoots.add(outputRoot);
+  try {
+      runPythonWorkflow(workflowArgs, { onStdoutLine, onStderrLine, onExit, onStartError });
+  } catch (error) {
+      activeOutputRoots.delete(outputRoot);
+      throw error;
+  }
+};
+
+
 // File upload and analysis initiation endpoint
 app.post('/upload_and_analyze', upload.single('chatFile'), async (req, res) => { // Made route handler async
   if (!req.file) {
@@ -152,168 +601,37 @@ app.post('/upload_and_analyze', upload.single('chatFile'), async (req, res) => {
       }
   }
 
-  const pythonArgs = [
-    pythonScriptPath,
-    inputJsonPath,       // Arg 1: Input JSON path (temporary file on Render)
-    outputExcelPath,     // Arg 2: Output Excel path (local path on Render)
-    ...limitArgs         // Arg 3 (optional): Limit value
-  ];
-
-  console.log(`Spawning Python process: ${pythonExecutablePath} ${pythonArgs.join(' ')}`);
+  // Optional extra export formats: "csv,parquet" or repeated form fields
+  const requestedFormats = [].concat(req.body.formats || [])
+      .flatMap((value) => String(value).split(','))
+      .map((value) => value.trim().toLowerCase())
+      .filter((value) => value);
+  const exportFormats = [...new Set(requestedFormats)].filter((format) => EXPORT_FORMATS.includes(format));
+  if (exportFormats.length < new Set(requestedFormats).size) {
+      console.warn(`Ignoring unsupported export formats in: ${requestedFormats.join(',')}`);
+  }
+  const formatArgs = exportFormats.length > 0 ? [`--formats=${exportFormats.join(',')}`] : [];
 
-  let pythonStdout = '';
-  let pythonStderr = '';
+  const job = {
+    inputPath: inputJsonPath,
+    outputExcelFilename,
+    args: [
+      inputJsonPath,       // Arg 1: Input JSON path (temporary file on Render)
+      outputExcelPath,     // Arg 2: Output Excel path (local path on Render)
+      ...limitArgs,        // Arg 3 (optional): Limit value
+      '--partial-report',  // Write partial results while the analysis is running
+      ...formatArgs        // Extra export formats requested by the client
+    ]
+  };
 
 
   try {
-      const pythonChildProcess = spawn(pythonExecutablePath, pythonArgs, {
-          cwd: baseDir,
-          env: { ...process.env, PYTHONIOENCODING: 'utf-8', PYTHONUNBUFFERED: '1' } // Ensure unbuffered output
-      });
+      // Record how to resume this job before Python starts, so even a server restart mid-run leaves it resumable
+      await fs.promises.writeFile(jobFilePath(outputRootOf(outputExcelFilename)), JSON.stringify(job));
+      startAnalysisJob(job);
 
-      // Capture and forward Python's stdout to SSE clients
-      pythonChildProcess.stdout.on('data', (data) => {
-        const dataString = data.toString();
-        // console.log(`Python stdout: ${dataString.trim()}`); // Log to Node.js console
-        pythonStdout += dataString;
-
-        dataString.split('\n').forEach(line => {
-            if (line.startsWith('PYTHON_STATUS:')) {
-                sse.send({ type: 'status', message: line.substring('PYTHON_STATUS:'.length).trim() }, 'message');
-            } else if (line.startsWith('PYTHON_PARSED_CHAT_RESULT:')) {
-                 const jsonString = line.substring('PYTHON_PARSED_CHAT_RESULT:'.length).trim();
-                 sse.send({ type: 'parsed_result', content: jsonString }, 'message');
-            } else if (line.startsWith('PYTHON_RESULT_JSON:')) {
-                 const jsonContent = line.substring('PYTHON_RESULT_JSON:'.length).trim();
-                 try {
-                     const finalResult = JSON.parse(jsonContent);
-                     sse.send({ type: 'final_result_json', content: finalResult }, 'message');
-                 } catch (e) {
-                     console.error('Failed to parse final JSON result from stdout:', e);
-                     sse.send({ type: 'log_error', message: `Failed to parse final JSON result: ${e}. Raw content: ${jsonContent.substring(0, 200)}...` }, 'message');
-                 }
-            } else {
-                 if (line.trim()) {
-                    sse.send({ type: 'log', message: line.trim() }, 'message');
-                 }
-            }
-        });
-      });
-
-      // Capture and forward Python's stderr to SSE clients
-      pythonChildProcess.stderr.on('data', (data) => {
-        const dataString = data.toString();
-        // console.error(`Python stderr: ${dataString.trim()}`); // Log to Node.js console
-        pythonStderr += dataString;
-
-         dataString.split('\n').forEach(line => {
-             if (line.startsWith('PYTHON_FATAL_ERROR:')) {
-                 sse.send({ type: 'fatal_error', message: line.substring('PYTHON_FATAL_ERROR:'.length).trim(), details: pythonStderr }, 'message');
-             } else if (line.startsWith('PYTHON_ERROR:')) {
-                  sse.send({ type: 'error', message: line.substring('PYTHON_ERROR:'.length).trim() }, 'message');
-             } else if (line.startsWith('PYTHON_WARNING:')) {
-                  sse.send({ type: 'warning', message: line.substring('PYTHON_WARNING:'.length).trim() }, 'message');
-             } else if (line.trim()) {
-                 sse.send({ type: 'log_error', message: line.trim() }, 'message');
-             }
-         });
-      });
 
-      // Listen for Python process exit
-      pythonChildProcess.on('close', async (code) => { // Made the close listener async
-        console.log(`Python process exited with code ${code}`);
-
-        // Clean up temporary uploaded JSON file immediately after process finishes
-        if (fs.existsSync(inputJsonPath)) {
-             console.log(`Attempting to remove temporary input file: ${inputJsonPath}`);
-             try {
-                 await fs.promises.unlink(inputJsonPath); // Use async unlink
-                 console.log(`Temporary input file ${inputJsonPath} removed.`);
-             } catch (err) {
-                  console.error(`Error removing temporary input file ${inputJsonPath}:`, err);
-             }
-        }
-
-        // Use collected stdout/stderr for final error report if needed
-        const finalStdout = pythonStdout;
-        const finalStderr = pythonStderr;
-
-        if (code === 0) {
-          // Python script finished successfully
-          // Check if the expected output file was created
-          if (fs.existsSync(outputExcelPath)) {
-            console.log(`Python generated output file: ${outputExcelPath}`);
-
-            // --- Send 'complete' SSE event with the LOCAL download URL ---
-            // Frontend will download this file from *this* Render backend instance
-            sse.send({ // Data payload for the 'complete' event
-              status: 'Analysis complete',
-              filename: outputExcelFilename,
-              // The frontend will use its backendUrl + this relative path to download
-              downloadUrl: `/download/${outputExcelFilename}`,
-              // Optional: Include captured output in complete event data for debugging
-              // stdout: finalStdout,
-              // stderr: finalStderr
-            }, 'complete'); // <-- THIS is the SSE event name
-            // -------------------------------------------------------------
-
-            console.log(`Analysis complete. Local Download URL sent.`);
-
-            // *** Removed immediate deletion here ***
-            // The file will remain until the *next* upload triggers cleanupOldAnalysisFiles
-            // or the Render instance restarts/cleans its ephemeral storage.
-
-
-          } else {
-            // Python exited with 0, but output file is missing - indicates a problem in Python's saving logic
-            const errorMessage = 'Analysis completed (Python exit code 0), but output file was not found.';
-            console.error(errorMessage);
-             sse.send({
-                 type: 'error', // Data payload type
-                 message: errorMessage,
-                 details: `Expected file: ${outputExcelPath}\n` + finalStdout + finalStderr
-             }, 'error'); // Send as 'error' event
-          }
-        } else {
-          // Python script failed (non-zero exit code)
-          const errorMessage = `Analysis failed during Python execution. Exit code: ${code}.`;
-          console.error(errorMessage);
-           // Send an 'error' or 'fatal_error' event for process failure
-           // Check if a fatal error was already reported by PythonStderr
-           if (!finalStderr.includes('PYTHON_FATAL_ERROR:')) {
-              sse.send({
-                  type: 'fatal_error', // Use fatal_error for process termination
-                  message: errorMessage,
-                  details: finalStdout + finalStderr
-              }, 'fatal_error');
-           }
-        }
-      });
-
-      // Listen for process spawn errors (e.g., python command not found)
-      pythonChildProcess.on('error', async (err) => { // Made the error listener async
-         const errorMessage = 'Failed to spawn python process. Check if python executable is in PATH or configured correctly via PYTHON_EXECUTABLE env var.';
-         console.error(errorMessage, err);
-         // Clean up input file in case of spawn error
-         if (req.file && req.file.path && fs.existsSync(req.file.path)) {
-             console.log(`Attempting to remove input file after spawn error: ${req.file.path}`);
-             try {
-                await fs.promises.unlink(req.file.path); // Use async unlink
-                console.log(`Input file ${req.file.path} removed after spawn error.`);
-             } catch (unlinkErr) {
-                 console.error(`Error removing input file ${req.file.path} after spawn error:`, unlinkErr);
-             }
-         }
-         // Send a fatal error event to the frontend
-         sse.send({
-             type: 'fatal_error',
-             message: errorMessage,
-             details: err.message
-         }, 'fatal_error');
-      });
-
-
-      // Send initial success response to the frontend immediately after spawning
+      // Send initial success response to the frontend immediately after starting the job
       res.status(202).json({
           status: 'File uploaded and analysis initiated. Connect to /analysis_stream for progress.',
           outputFilename: outputExcelFilename // Send the expected output filename (for frontend reference)
@@ -323,21 +641,49 @@ app.post('/upload_and_analyze', upload.single('chatFile'), async (req, res) => {
       // Catch synchronous errors during file upload or initial spawn setup
       console.error('Synchronous error during upload/spawn:', error);
       // Clean up input file in case of synchronous error
-      if (req.file && req.file.path && fs.existsSync(req.file.path)) {
-          console.log(`Attempting to remove input file after synchronous error: ${req.file.path}`);
-          try {
-             await fs.promises.unlink(req.file.path); // Use async unlink
-             console.log(`Input file ${req.file.path} removed after synchronous error.`);
-          } catch (unlinkErr) {
-              console.error(`Error removing input file ${req.file.path} after synchronous error:`, unlinkErr);
-          }
-      }
+      await removeFileIfExists(inputJsonPath, 'input file after synchronous error');
+      await removeFileIfExists(jobFilePath(outputRootOf(outputExcelFilename)), 'job file after synchronous error');
       // Send error response to frontend
       res.status(500).json({ error: 'Server failed to initiate analysis.', details: error.message });
   }
 
 });
 
+// Resume a failed or interrupted analysis: body { outputFilename } as returned by /upload_and_analyze.
+// The job runs again with the same input and output name plus --resume; progress is sent over /analysis_stream.
+app.post('/resume_analysis', async (req, res) => {
+  const outputExcelFilename = path.basename(String(req.body.outputFilename || ''));
+  const outputRoot = outputRootOf(outputExcelFilename);
+  if (!outputExcelFilename.startsWith('analysis_result_')) {
+      return res.status(400).json({ error: 'Missing or invalid outputFilename.' });
+  }
+  if (activeOutputRoots.has(outputRoot)) {
+      return res.status(409).json({ error: 'This analysis is still queued or running.' });
+  }
+
+  let job;
+  try {
+      job = await readJobFile(outputRoot);
+  } catch (err) {
+      return res.status(404).json({ error: 'No resumable analysis found (it completed, expired or was never started).' });
+  }
+  if (!fs.existsSync(job.inputPath)) {
+      return res.status(404).json({ error: 'The uploaded input of this analysis is no longer available.' });
+  }
+
+  try {
+      console.log(`Resuming analysis ${outputExcelFilename} from its checkpoint journal.`);
+      startAnalysisJob(job, { resume: true });
+      res.status(202).json({
+          status: 'Analysis resumed. Connect to /analysis_stream for progress.',
+          outputFilename: outputExcelFilename
+      });
+  } catch (error) {
+      console.error('Synchronous error while resuming analysis:', error);
+      res.status(500).json({ error: 'Server failed to resume analysis.', details: error.message });
+  }
+});
+
 // --- File download endpoint (serving from local disk) ---
 app.get('/download/:filename', (req, res) => {
   const filename = req.params.filename;
@@ -384,6 +730,10 @@ app.listen(port, () => {
        console.error(`FATAL: Python workflow script not found at ${pythonScriptPath}. Analysis will fail.`);
    }
    console.log(`Using Python executable: ${pythonExecutablePath}`);
+   // Warm up the persistent workers so the first uploads don't pay the import cost
+   if (!workerPool.disabled) {
+       dispatchWorkerJobs();
+   }
    // publicDownloadUrlBase is not used anymore for link construction, frontend uses its own backendUrl + relative path
 
 });
\ No newline at end of file
@@ -0,0 +1,70 @@
+# tests/test_analysis_pipeline.py
+# 流水线分析引擎：结果阶段出错时应抛出异常，而不是因为结果队列无人读取而一直等待。
+# 运行：python -m unittest discover tests
+
+import asyncio
+import os
+import sys
+import unittest
+
+os.environ.setdefault('ANALYSIS_CACHE_PATH', 'off')
+os.environ.setdefault('ANALYSIS_METRICS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analyze_chats
+
+
+class DiskFullError(OSError):
+    """与 wait_for 超时抛出的 TimeoutError（也是 OSError 的子类）区分开"""
+
+
+class FailingReportSink:
+    """模拟部分结果写入失败（如磁盘已满）：第 fail_after 条结果起抛出 OSError"""
+
+    def __init__(self, fail_after):
+        self.fail_after = fail_after
+        self.rows = 0
+
+    def add(self, index, chat_analysis):
+        self.rows += 1
+        if self.rows >= self.fail_after:
+            raise DiskFullError(28, 'No space left on device')
+
+
+def make_chats(count):
+    return [
+        {
+            'chat_id': f'chat-{i}',
+            'messages': [
+                {'sender': 'customer', 'time': '2025-08-01 10:00:00', 'text': f'hello {i}'},
+                {'sender': 'agent', 'time': '2025-08-01 10:00:20', 'text': 'hi'},
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+class SinkFailureTest(unittest.TestCase):
+
+    def run_pipeline(self, chats, report_sink):
+        coro = analyze_chats._analyze_chats_concurrently(chats, None, analyze_chats.MODEL_NAME, 1, report_sink=report_sink)
+        # 修复前这里会永远等待；超时说明流水线卡住了
+        return asyncio.run(asyncio.wait_for(coro, timeout=20))
+
+    def test_sink_error_is_raised(self):
+        # 对话数远大于队列容量（并发数的两倍），结果阶段退出后上游一定会阻塞在已满的队列上
+        with self.assertRaises(DiskFullError):
+            self.run_pipeline(make_chats(200), FailingReportSink(fail_after=3))
+
+    def test_sink_error_from_iterator_input(self):
+        # 流式输入（生成器）时读取线程同样需要被唤醒退出
+        with self.assertRaises(DiskFullError):
+            self.run_pipeline(iter(make_chats(200)), FailingReportSink(fail_after=1))
+
+    def test_pipeline_without_failure(self):
+        results = self.run_pipeline(make_chats(50), FailingReportSink(fail_after=10 ** 6))
+        self.assertEqual([row['chat_id'] for row, _ in results], [f'chat-{i}' for i in range(50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
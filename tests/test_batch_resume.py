@@ -0,0 +1,102 @@
+# tests/test_batch_resume.py
+# Batch API 模式断点续跑：提交后进程退出，resume 时应继续轮询原任务而不是重新提交。
+# 运行：python -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('ANALYSIS_CACHE_PATH', 'off')
+os.environ.setdefault('ANALYSIS_METRICS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_analysis
+
+
+class ProcessKilled(Exception):
+    """模拟轮询过程中进程被终止"""
+
+
+class RecordingBackend(batch_analysis.FileBatchBackend):
+    """记录 submit 次数；kill_on_poll 为 True 时第一次轮询就抛出异常"""
+
+    def __init__(self, root_dir, kill_on_poll=False):
+        super().__init__(root_dir)
+        self.kill_on_poll = kill_on_poll
+        self.submitted = []
+
+    def submit(self, requests_path, model_name, display_name):
+        job_name = super().submit(requests_path, model_name, display_name)
+        self.submitted.append(job_name)
+        return job_name
+
+    def poll(self, job_name):
+        if self.kill_on_poll:
+            raise ProcessKilled()
+        return super().poll(job_name)
+
+
+def write_chats(path, count):
+    chats = [
+        {
+            'chat_id': f'chat-{i}',
+            'messages': [
+                {'sender': 'customer', 'time': '2025-08-01 10:00:00', 'text': f'hello {i}'},
+                {'sender': 'agent', 'time': '2025-08-01 10:00:20', 'text': 'hi'},
+            ],
+        }
+        for i in range(count)
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chats, f)
+
+
+class BatchResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.work_dir, 'cleaned.json')
+        self.output_path = os.path.join(self.work_dir, 'report.xlsx')
+        self.journal_path = f"{self.output_path}.journal.jsonl"
+        self.stub_dir = os.path.join(self.work_dir, 'stub')
+        write_chats(self.input_path, 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run_batch(self, backend, resume):
+        return batch_analysis.run_batch_analysis_process(
+            self.input_path, self.output_path, backend, None, 'test-model',
+            poll_interval=0, journal_path=self.journal_path, resume=resume)
+
+    def test_resume_reattaches_to_submitted_job(self):
+        interrupted = RecordingBackend(self.stub_dir, kill_on_poll=True)
+        with self.assertRaises(ProcessKilled):
+            self.run_batch(interrupted, resume=False)
+        self.assertEqual(len(interrupted.submitted), 1)
+        batch_job_path = batch_analysis._batch_job_path(self.journal_path)
+        self.assertTrue(os.path.exists(batch_job_path))
+
+        resumed = RecordingBackend(self.stub_dir)
+        results = self.run_batch(resumed, resume=True)
+        self.assertEqual(resumed.submitted, [])
+        self.assertEqual([row['chat_id'] for row in results], [f'chat-{i}' for i in range(5)])
+        self.assertTrue(all(not row.get('API分析错误') for row in results))
+        self.assertFalse(os.path.exists(batch_job_path))
+
+    def test_fresh_run_submits_new_job(self):
+        interrupted = RecordingBackend(self.stub_dir, kill_on_poll=True)
+        with self.assertRaises(ProcessKilled):
+            self.run_batch(interrupted, resume=False)
+
+        rerun = RecordingBackend(self.stub_dir)
+        self.run_batch(rerun, resume=False)
+        self.assertEqual(len(rerun.submitted), 1)
+        self.assertNotEqual(rerun.submitted, interrupted.submitted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# tests/test_timing_metrics.py
+# 按表计算的时间指标 (calculate_timing_metrics_batch) 必须与逐条计算的 calculate_timing_metrics 结果完全相同。
+# 运行：python -m unittest discover tests
+
+import os
+import random
+import sys
+import unittest
+
+os.environ.setdefault('ANALYSIS_CACHE_PATH', 'off')
+os.environ.setdefault('ANALYSIS_METRICS', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analyze_chats import calculate_timing_metrics, calculate_timing_metrics_batch
+
+
+def message(sender, time):
+    return {'sender': sender, 'time': time, 'content': 'hi'}
+
+
+CASES = {
+    'unanswered': [message('Customer', '2024-01-01 10:00:00'), message('Customer', '2024-01-01 10:00:05')],
+    'agent_before_customer': [message('Agent', '2024-01-01 09:59:00'), message('Customer', '2024-01-01 10:00:00'),
+                              message('Agent', '2024-01-01 10:00:40')],
+    'agent_only': [message('Agent', '2024-01-01 10:00:00')],
+    'qualified': [message('Customer', '2024-01-01 10:00:00'), message('Agent', '2024-01-01 10:00:30')],
+    'reply_earlier_than_customer': [message('Customer', '2024-01-01 10:00:00'), message('Agent', '2024-01-01 09:00:00'),
+                                    message('Agent', '2024-01-01 10:02:00')],
+    'tz_aware': [message('Customer', '2024-01-01T10:00:00Z'), message('Agent', '2024-01-01T18:00:12+08:00')],
+    'aware_and_naive': [message('Customer', '2024-01-01T10:00:00+00:00'), message('Agent', '2024-01-01 10:00:10'),
+                        message('Agent', '2024-01-01T10:00:20+00:00')],
+    'fractional_seconds': [message('Customer', '2024-01-01 10:00:00.250'), message('Agent', '2024-01-01 10:00:30.251')],
+    'unparseable': [message('Customer', 'yesterday'), message('Customer', '2024-01-01 10:00:00'),
+                    message('Agent', 'not a time'), message('Agent', '2024-01-01 10:01:00')],
+    'missing_time': [message('Customer', ''), message('Customer', '2024-01-01 10:00:00'), message('Agent', None)],
+    'empty': [],
+}
+
+TIME_CHOICES = [
+    '2024-01-01 10:00:00', '2024-01-01 10:00:30', '2024-01-01 10:00:31', '2024-01-01 09:59:59', '2024-01-01 10:05:00',
+    '2024-01-01 10:00:10.5', '2024-01-01T10:00:20Z', '2024-01-01T18:00:40+08:00', '0999-01-01 00:00:00',
+    'garbage', '', None,
+]
+
+
+class TimingMetricsBatchTest(unittest.TestCase):
+
+    def assert_matches(self, message_lists):
+        expected = [calculate_timing_metrics(messages) for messages in message_lists]
+        self.assertEqual(calculate_timing_metrics_batch(message_lists), expected)
+
+    def test_each_case_alone(self):
+        # 单条对话的批次最容易出现整张表没有客服回复的情况
+        for name, messages in CASES.items():
+            with self.subTest(name):
+                self.assert_matches([messages])
+
+    def test_all_cases_together(self):
+        self.assert_matches(list(CASES.values()))
+
+    def test_batch_without_any_agent_reply(self):
+        self.assert_matches([CASES['unanswered'], CASES['empty'], [message('Customer', '2024-01-01 11:00:00')]])
+
+    def test_random_batches(self):
+        rng = random.Random(20240101)
+        for _ in range(300):
+            message_lists = [
+                [message(rng.choice(['Customer', 'Agent', 'System']), rng.choice(TIME_CHOICES))
+                 for _ in range(rng.randint(0, 5))]
+                for _ in range(rng.randint(1, 4))
+            ]
+            self.assert_matches(message_lists)
+
+
+if __name__ == '__main__':
+    unittest.main()
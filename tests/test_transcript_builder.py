@@ -0,0 +1,65 @@
+# tests/test_transcript_builder.py
+# 按 token 预算构造对话文本：截断后不超出预算、折叠标记不依赖行号。
+# 运行：python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcript_builder import build_transcript, estimate_tokens
+
+CANNED_MESSAGES = [
+    "Thank you for contacting VERTU customer service, our consultant will get back to you within one working day. " * 3,
+    "您好，感谢您联系 VERTU 客服中心，我们的顾问会在一个工作日内与您联系，请保持电话畅通，谢谢您的耐心等待。",
+    "Please leave your phone number and email address so that our sales team can send you the latest catalogue.",
+]
+
+
+def message(sender, minute, content):
+    return {'sender': sender, 'time': f'2025-08-01 10:{minute:02d}:00', 'content': content}
+
+
+def make_messages():
+    """前 10 条是普通对话；话术第一次出现在中间（截断时会被省略）；结尾部分反复引用这些话术"""
+    messages = [message('Visitor' if i % 2 == 0 else 'Agent', i, f'question or answer number {i} about the phone') for i in range(10)]
+    minute = 10
+    for canned in CANNED_MESSAGES:
+        messages.append(message('Agent', minute, canned))
+        messages.append(message('Visitor', minute + 1, 'ok, what else?'))
+        minute += 2
+    for round_index in range(6):
+        for canned in CANNED_MESSAGES:
+            messages.append(message('Visitor', minute % 60, f'follow-up {round_index}'))
+            messages.append(message('Agent', (minute + 1) % 60, canned))
+            minute += 2
+    return messages
+
+
+class TranscriptBudgetTest(unittest.TestCase):
+
+    def test_transcript_stays_within_budget(self):
+        messages = make_messages()
+        full_transcript, full_stats = build_transcript(messages)
+        self.assertGreater(full_stats['collapsed_messages'], 0)
+        for token_budget in range(150, full_stats['transcript_tokens'] + 50, 10):
+            transcript, stats = build_transcript(messages, token_budget)
+            self.assertEqual(stats['transcript_tokens'], estimate_tokens(transcript))
+            self.assertLessEqual(stats['transcript_tokens'], token_budget, f"budget {token_budget}")
+
+    def test_collapsed_message_quotes_original_text(self):
+        transcript, stats = build_transcript(make_messages())
+        self.assertNotIn('同第', transcript)
+        for canned in CANNED_MESSAGES:
+            self.assertIn(f'(重复话术：「{canned[:20]}…」)', transcript)
+
+    def test_short_messages_are_not_collapsed(self):
+        messages = [message('Agent', i, 'ok, thanks for your message') for i in range(5)]
+        transcript, stats = build_transcript(messages)
+        self.assertEqual(stats['collapsed_messages'], 0)
+        self.assertEqual(transcript.count('ok, thanks for your message'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
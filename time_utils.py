@@ -0,0 +1,65 @@
+# time_utils.py
+# LiveChat 导出中事件时间的转换：UTC ISO 时间 -> 香港时间字符串 'YYYY-MM-DD HH:MM:SS'。
+# 清洗时每个事件都要转换一次，而同一秒内往往有多个事件，所以对 LiveChat 固定的
+# 'YYYY-MM-DDTHH:MM:SS.ffffffZ' 格式使用专门的快速解析，并按原始字符串缓存转换结果；
+# 其他格式回退到 datetime.fromisoformat 的通用转换，结果与原来的实现完全相同。
+
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+
+# 定义香港时区 (UTC+8)
+HKT = timezone(timedelta(hours=8))
+HKT_OFFSET = timedelta(hours=8)
+
+# 缓存的不同时间字符串数量上限
+TIME_CACHE_SIZE = 65536
+
+# 与 fromisoformat 一致（Python 3.11 之前只接受 3 位或 6 位小数秒）
+_FAST_PATH_LENGTHS = (20, 24, 27)
+
+
+def _format_hkt_time_general(created_at):
+    """通用转换：兼容 'Z' 和非 'Z' 的 ISO 格式，无时区信息时视为 UTC"""
+    dt_original = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+    if dt_original.tzinfo is None:
+        dt_utc = dt_original.replace(tzinfo=timezone.utc)
+    else:
+        dt_utc = dt_original
+    return dt_utc.astimezone(HKT).strftime('%Y-%m-%d %H:%M:%S')
+
+def _parse_livechat_utc(created_at):
+    """解析 'YYYY-MM-DDTHH:MM:SS[.fff|.ffffff]Z'，格式不符时返回 None"""
+    if len(created_at) not in _FAST_PATH_LENGTHS or not created_at.isascii():
+        return None
+    if created_at[4] != '-' or created_at[7] != '-' or created_at[10] != 'T' \
+            or created_at[13] != ':' or created_at[16] != ':' or created_at[-1] != 'Z':
+        return None
+    if len(created_at) > 20 and (created_at[19] != '.' or not created_at[20:-1].isdigit()):
+        return None
+    parts = (created_at[0:4], created_at[5:7], created_at[8:10], created_at[11:13], created_at[14:16], created_at[17:19])
+    if not all(part.isdigit() for part in parts):
+        return None
+    try:
+        return datetime(*(int(part) for part in parts))
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def _format_hkt_time_cached(created_at):
+    dt_utc = _parse_livechat_utc(created_at)
+    if dt_utc is None:
+        return _format_hkt_time_general(created_at)
+    # 偏移是整小时，直接加 8 小时即可，小数秒与 strftime 一样舍去
+    dt_hkt = dt_utc + HKT_OFFSET
+    return f"{dt_hkt.year:04d}-{dt_hkt.month:02d}-{dt_hkt.day:02d} {dt_hkt.hour:02d}:{dt_hkt.minute:02d}:{dt_hkt.second:02d}"
+
+def format_hkt_time(created_at):
+    """
+    把事件时间转换为香港时间字符串 'YYYY-MM-DD HH:MM:SS'，空值返回 ''。
+    无法解析时抛出与 datetime.fromisoformat 相同的异常，由调用方决定如何处理。
+    """
+    if not created_at:
+        return ''
+    if isinstance(created_at, str):
+        return _format_hkt_time_cached(created_at)
+    return _format_hkt_time_general(created_at)
@@ -0,0 +1,205 @@
+# transcript_builder.py
+# 按 token 预算构造发给 Gemini 的对话文本：
+# - 本地估算 token 数（不调用 API）
+# - 时间戳改为相对对话开始的偏移量，只在开头保留一次完整时间
+# - 客服重复发送的固定话术只保留第一次，之后用引用开头几个字的简短标记代替
+# - 超出预算时保留开头和结尾的若干轮对话，省略中间部分
+# 同时返回统计信息，记录每个对话被截断了多少。
+
+from datetime import datetime
+
+# 客服消息至少这么长才视为可折叠的固定话术，避免把 "ok"、"thanks" 之类的短回复当成重复话术
+CANNED_MESSAGE_MIN_CHARS = 20
+# 折叠标记引用话术开头的字符数：标记本身就能看出是哪条话术，不依赖行号（截断后行的位置会变）
+CANNED_MESSAGE_QUOTE_CHARS = 20
+# 超出预算时，预算中分给开头部分的比例，其余留给结尾
+HEAD_BUDGET_SHARE = 0.5
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk_chars = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uff00' <= ch <= '\uffef')
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+def _parse_message_time(time_str):
+    if not time_str:
+        return None
+    try:
+        return datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(time_str.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (ValueError, TypeError):
+        return None
+
+def _format_offset(seconds):
+    seconds = max(0, int(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
+    if hours:
+        return f"+{hours}:{minutes:02d}:{secs:02d}"
+    return f"+{minutes:02d}:{secs:02d}"
+
+def _line_tokens(line):
+    # 按带换行符的行估算：逐行相加的结果不小于整段文本的估算值，按行分配预算时不会超出
+    return estimate_tokens(line + "\n")
+
+def _truncate_to_tokens(text, max_tokens):
+    """把单条过长的文本截短，使加上截断标记后不超过 max_tokens 个 token"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    suffix = "…(内容过长已截断)"
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid] + suffix) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + suffix
+
+def _canned_reference(content):
+    quote = content[:CANNED_MESSAGE_QUOTE_CHARS]
+    if len(content) > CANNED_MESSAGE_QUOTE_CHARS:
+        quote += "…"
+    return f"(重复话术：「{quote}」)"
+
+def _omission_marker(omitted, omitted_tokens):
+    return f"…… 中间省略 {omitted} 条消息（约 {omitted_tokens} tokens）……"
+
+def build_transcript(messages, token_budget=None):
+    """
+    构造对话文本，返回 (transcript, stats)。
+    stats 包含: total_messages, kept_messages, omitted_messages, collapsed_messages,
+               original_tokens (完整逐条输出时的估算 token 数), transcript_tokens
+    设置 token_budget 时 transcript_tokens 不超过预算（预算小于开头时间行和省略标记本身时除外）。
+    """
+    start_time = None
+    for message in messages:
+        start_time = _parse_message_time(message.get('time'))
+        if start_time is not None:
+            break
+
+    lines = []
+    full_lines = {}  # 被折叠的行号 -> (首次出现的行号, 原始行)
+    seen_agent_messages = {}
+    collapsed_messages = 0
+    original_tokens = 0
+    for message in messages:
+        time_str = message.get('time', '')
+        sender = message.get('sender', '未知发送者')
+        content = message.get('content', '')
+        original_tokens += estimate_tokens(f"[{time_str or '未知时间'}] {sender}: {content}")
+
+        msg_time = _parse_message_time(time_str)
+        if msg_time is not None and start_time is not None:
+            time_label = _format_offset((msg_time - start_time).total_seconds())
+        else:
+            time_label = time_str or '未知时间'
+
+        if sender == 'Agent' and len(content) >= CANNED_MESSAGE_MIN_CHARS:
+            if content in seen_agent_messages:
+                reference = _canned_reference(content)
+                if estimate_tokens(reference) < estimate_tokens(content):
+                    full_lines[len(lines)] = (seen_agent_messages[content], f"[{time_label}] {sender}: {content}")
+                    content = reference
+                    collapsed_messages += 1
+            else:
+                seen_agent_messages[content] = len(lines)
+
+        lines.append(f"[{time_label}] {sender}: {content}")
+
+    header = f"对话开始时间: {start_time.strftime('%Y-%m-%d %H:%M:%S')}（以下时间为相对开始时间的偏移）" if start_time else None
+    header_tokens = _line_tokens(header) if header else 0
+    line_tokens = [_line_tokens(line) for line in lines]
+    total_tokens = header_tokens + sum(line_tokens)
+    full_text_tokens = estimate_tokens("\n".join(([header] if header else []) + lines))
+
+    stats = {
+        'total_messages': len(messages),
+        'kept_messages': len(lines),
+        'omitted_messages': 0,
+        'collapsed_messages': collapsed_messages,
+        'original_tokens': original_tokens,
+    }
+
+    if token_budget and token_budget > 0 and full_text_tokens > token_budget and lines:
+        # 省略标记行按最大可能的数字预留
+        marker_tokens = _line_tokens(_omission_marker(len(lines), total_tokens))
+        available = max(1, token_budget - header_tokens - marker_tokens)
+        head_budget = int(available * HEAD_BUDGET_SHARE)
+
+        head_count, head_used = 0, 0
+        while head_count < len(lines) and head_used + line_tokens[head_count] <= head_budget:
+            head_used += line_tokens[head_count]
+            head_count += 1
+        if head_count == 0:
+            # 第一条消息本身就超出预算的一半，截短后保留（留出换行符的 1 个 token）
+            lines[0] = _truncate_to_tokens(lines[0], head_budget - 1)
+            line_tokens[0] = _line_tokens(lines[0])
+            head_used, head_count = line_tokens[0], 1
+
+        # 结尾部分引用的话术首次出现在被省略的中间部分时，在第一次引用处恢复原文。
+        # 结尾从后往前逐行扩展，累计 token 数并只更新恢复原文带来的差值，保证整段文本不超出预算；
+        # restored_by_first 记录 {话术首次出现的行: 恢复原文的结尾行}
+        restored_by_first = {}
+        tail_used = 0
+
+        def restore_delta(line_index):
+            return _line_tokens(full_lines[line_index][1]) - line_tokens[line_index]
+
+        tail_count = 0
+        while head_count + tail_count < len(lines):
+            tail_start = len(lines) - tail_count - 1
+            new_used = tail_used + line_tokens[tail_start]
+            # 新加入结尾的这一行不再被省略，以它为首次出现位置的引用不需要再恢复原文
+            if tail_start in restored_by_first:
+                new_used -= restore_delta(restored_by_first[tail_start])
+            # 这一行成为该话术在结尾部分的第一次引用时在这里恢复原文，原来恢复的后一次引用改回折叠形式
+            first_index = full_lines[tail_start][0] if tail_start in full_lines else None
+            if first_index is not None and head_count <= first_index < tail_start:
+                if first_index in restored_by_first:
+                    new_used -= restore_delta(restored_by_first[first_index])
+                new_used += restore_delta(tail_start)
+            else:
+                first_index = None
+            if head_used + new_used > available:
+                break
+            restored_by_first.pop(tail_start, None)
+            if first_index is not None:
+                restored_by_first[first_index] = tail_start
+            tail_used = new_used
+            tail_count += 1
+
+        omitted = len(lines) - head_count - tail_count
+        if omitted > 0:
+            tail_start = len(lines) - tail_count
+            omitted_tokens = sum(line_tokens[head_count:tail_start])
+            restored = {line_index: full_lines[line_index][1] for line_index in restored_by_first.values()}
+            for line_index, full_line in restored.items():
+                lines[line_index] = full_line
+            stats['collapsed_messages'] = collapsed_messages - len(restored)
+            lines = lines[:head_count] + [_omission_marker(omitted, omitted_tokens)] + lines[tail_start:]
+            stats['kept_messages'] = head_count + tail_count
+            stats['omitted_messages'] = omitted
+
+    transcript = "\n".join(([header] if header else []) + lines)
+    stats['transcript_tokens'] = estimate_tokens(transcript)
+    return transcript, stats
+
+def describe_truncation(stats):
+    """把截断统计转换为写入报告的简短说明；没有省略或折叠时返回空字符串"""
+    if not stats or (not stats.get('omitted_messages') and not stats.get('collapsed_messages')):
+        return ""
+    parts = []
+    if stats.get('omitted_messages'):
+        parts.append(f"省略 {stats['omitted_messages']}/{stats['total_messages']} 条消息")
+    if stats.get('collapsed_messages'):
+        parts.append(f"折叠 {stats['collapsed_messages']} 条重复话术")
+    if stats.get('original_tokens'):
+        kept_ratio = min(1.0, stats['transcript_tokens'] / stats['original_tokens'])
+        parts.append(f"保留约 {kept_ratio:.0%} tokens")
+    return "，".join(parts)